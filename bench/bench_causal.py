@@ -0,0 +1,164 @@
+'''Added latency and memory of causal delivery under reordering.
+
+--senders chat servers send --messages chat messages in total to the leader,
+--rate a second. Each one depends on the last message of another sender with
+chance --cross. The network delays every message by a random exponential
+jitter of mean --jitter ms, so they arrive reordered, and loses --loss of
+them. The arrivals, in virtual time, go through the CausalQueue and through
+a hold-back buffer that rescans everything it holds on every arrival.
+Reports
+
+    added_p50_ms, ..    time from arrival to delivery, p50, p99 and p999
+    forced              messages delivered after CAUSAL_TIMEOUT without
+                        their lost dependencies
+    max_held            most messages held back at once
+    peak_kb             peak memory of the held messages, by tracemalloc
+    indexed_us          CPU time per message of the CausalQueue
+    rescan_us           and of the rescanning buffer
+
+    python -m bench.bench_causal --messages 100000 --jitter 20
+'''
+
+from array import array
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+from lib.causal import CausalQueue
+from lib.clock import ClockIndex, VectorClock
+
+
+def _arrivals(args):
+    # (arrival, entries, send time) in order of arrival, entries as slots
+    rng = random.Random(args.seed)
+    counters = [0] * args.senders
+    arrivals = []
+    last = None
+    for i in range(args.messages):
+        sender = rng.randrange(args.senders)
+        counters[sender] += 1
+        # Slot 0 is the leader
+        entries = [(sender + 1, counters[sender])]
+        if last is not None and last[0] != sender + 1 and rng.random() < args.cross:
+            entries.append(last)
+        last = entries[0]
+        sent = i / args.rate
+        if counters[sender] > 1 and rng.random() < args.loss:
+            continue
+        arrivals.append((sent + rng.expovariate(1000 / args.jitter), entries, sent))
+    arrivals.sort(key=lambda arrival: arrival[0])
+    return arrivals
+
+
+def _index():
+    index = ClockIndex()
+    index.slot('leader')
+    return index
+
+
+class _Rescan():
+    # Hold-back buffer that tries every held message on each arrival
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self.counters = {}
+        self.held = []
+
+    def push(self, entries, message):
+        self.held.append((entries, message))
+        progress = True
+        while progress:
+            progress = False
+            for item in list(self.held):
+                entries, message = item
+                sender, counter = entries[0]
+                if (self.counters.get(sender, counter - 1) == counter - 1 and
+                        all(self.counters.get(slot, 0) >= c for slot, c in entries[1:])):
+                    self.held.remove(item)
+                    for slot, c in entries:
+                        self.counters[slot] = max(self.counters.get(slot, 0), c)
+                    self.deliver(message)
+                    progress = True
+
+
+def _percentile(values, fraction):
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 2)
+
+
+def run(args):
+    arrivals = _arrivals(args)
+
+    # Allocated up front, so tracemalloc only sees the queue
+    added = array('d', bytes(8 * len(arrivals)))
+    delivered = [0]
+    now = [0]
+
+    def deliver(index):
+        added[delivered[0]] = now[0] - arrivals[index][0]
+        delivered[0] += 1
+
+    max_held = 0
+    queue = CausalQueue(VectorClock('leader', _index()), deliver, timeout=args.timeout)
+    tracemalloc.start()
+    for index, (arrival, entries, sent) in enumerate(arrivals):
+        now[0] = arrival
+        queue.push(entries, index, now=arrival)
+        max_held = max(max_held, len(queue))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # The last ones wait for lost messages until the timeout
+    now[0] += args.timeout
+    queue.expire(now[0])
+    added = sorted(added[:delivered[0]])
+
+    queue = CausalQueue(VectorClock('leader', _index()), lambda message: None,
+                        timeout=args.timeout)
+    started = time.process_time()
+    for arrival, entries, sent in arrivals:
+        queue.push(entries, sent, now=arrival)
+    indexed = time.process_time() - started
+
+    rescan = _Rescan(lambda message: None)
+    count = min(len(arrivals), args.rescan_messages)
+    started = time.process_time()
+    for arrival, entries, sent in arrivals[:count]:
+        rescan.push(entries, sent)
+    rescanned = time.process_time() - started
+
+    return {
+        'messages': len(arrivals),
+        'senders': args.senders,
+        'jitter_ms': args.jitter,
+        'loss': args.loss,
+        'delivered': delivered[0],
+        'added_p50_ms': _percentile(added, 0.5),
+        'added_p99_ms': _percentile(added, 0.99),
+        'added_p999_ms': _percentile(added, 0.999),
+        'forced': queue.counts['forced'],
+        'max_held': max_held,
+        'peak_kb': round(peak / 1024, 1),
+        'indexed_us': round(indexed / len(arrivals) * 1e6, 2),
+        'rescan_us': round(rescanned / count * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--senders', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=10000,
+                        help='messages a second of all senders')
+    parser.add_argument('--jitter', type=float, default=20, help='mean jitter in ms')
+    parser.add_argument('--cross', type=float, default=0.5)
+    parser.add_argument('--loss', type=float, default=0)
+    parser.add_argument('--timeout', type=float, default=1)
+    parser.add_argument('--rescan-messages', type=int, default=20000,
+                        help='the rescanning buffer only gets the first ones')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+'''End-to-end latency and reconnect time of the chat client.
+
+Starts two chat servers (AsyncChatServer) on localhost, the second one also
+answering client discovery as the leader. A sender and a receiver client
+connect to the first server. Reports
+
+    latency_p50_ms, ..  time from send_message on the sender to the message
+                        on the receiver, p50, p99 and p999 of --messages
+                        sent one at a time
+    burst_msg_s         messages a second through the server when the
+                        sender queues --burst at once, sent in batches
+    reconnect_ms        time from killing the first server until a message
+                        sent by the sender arrives again at the receiver,
+                        both reconnected to the leader, median of --kills
+
+    python -m bench.bench_client --messages 10000
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+from client import Client
+from lib.address import Address
+from lib.async_server import AsyncChatServer
+from lib.discovery import Discovery
+from lib import logger
+
+
+class _Server():
+    def __init__(self, port=0):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', port))
+        sock.listen()
+        self.address = Address(*sock.getsockname())
+        self.server = AsyncChatServer(sock)
+        self.loop = asyncio.new_event_loop()
+        self.task = self.loop.create_task(self.server.serve())
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+
+    def kill(self):
+        def kill():
+            for connection in list(self.server._clients):
+                connection.transport.abort()
+            self.task.cancel()
+        self.loop.call_soon_threadsafe(kill)
+        self.thread.join()
+
+
+def _free_udp_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 3)
+
+
+def _poll(clients, done, timeout):
+    # Polls the clients until done() or the timeout, returns done()
+    deadline = time.perf_counter() + timeout
+    while not done() and time.perf_counter() < deadline:
+        for client in clients:
+            client.poll(0)
+    return done()
+
+
+def _wait(clients, done):
+    if not _poll(clients, done, timeout=10):
+        raise TimeoutError('Message did not arrive')
+
+
+def run(args):
+    servers = [_Server(), _Server()]
+    broadcast_port = _free_udp_port()
+    leader = servers[1].address
+    discovery = Discovery(leader.host, leader.port, broadcast_port)
+    discovery.set_replica_address(Address(leader.host, 1))
+    discovery.set_get_members(lambda: [])
+    discovery.set_get_leader(lambda: leader)
+    threading.Thread(target=discovery.listen, daemon=True).start()
+
+    received = []
+    sender = Client(servers[0].address.host, servers[0].address.port, 'sender',
+                    broadcast_ip='127.0.0.1', broadcast_port=broadcast_port)
+    receiver = Client(servers[0].address.host, servers[0].address.port, 'receiver',
+                      broadcast_ip='127.0.0.1', broadcast_port=broadcast_port)
+    sender.on_message = lambda message: None
+    receiver.on_message = lambda message: received.append(message.message)
+    sender.connect()
+    receiver.connect()
+    clients = [sender, receiver]
+    _wait(clients, lambda: servers[0].server.client_count() == 2)
+
+    latencies = []
+    for i in range(args.messages):
+        started = time.perf_counter()
+        sender.send_message(str(i))
+        _wait(clients, lambda: len(received) > i)
+        latencies.append(time.perf_counter() - started)
+
+    del received[:]
+    started = time.perf_counter()
+    for i in range(args.burst):
+        sender.send_message(str(i))
+    _wait(clients, lambda: len(received) >= args.burst)
+    burst = time.perf_counter() - started
+
+    reconnects = []
+    for kill in range(args.kills):
+        del received[:]
+        # The clients are on the server that is killed, the other one leads
+        victim = servers[0] if sender.address == servers[0].address else servers[1]
+        survivor = servers[1] if victim is servers[0] else servers[0]
+        discovery.set_get_leader(lambda survivor=survivor: survivor.address)
+        started = time.perf_counter()
+        victim.kill()
+        # Until the receiver is back as well, earlier messages reach nobody
+        while not received:
+            sender.send_message('after kill {}'.format(kill))
+            _poll(clients, lambda: received, timeout=0.001)
+        reconnects.append(time.perf_counter() - started)
+        assert sender.address == survivor.address
+        # Bring the victim back on its port for the next round
+        servers[servers.index(victim)] = _Server(victim.address.port)
+
+    for client in clients:
+        client.shutdown()
+    for server in servers:
+        server.kill()
+    return {
+        'messages': args.messages,
+        'latency_p50_ms': _percentile(latencies, 0.5),
+        'latency_p99_ms': _percentile(latencies, 0.99),
+        'latency_p999_ms': _percentile(latencies, 0.999),
+        'burst_msg_s': round(args.burst / burst),
+        'reconnect_ms': _percentile(reconnects, 0.5),
+        'reconnect_max_ms': _percentile(reconnects, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--burst', type=int, default=100000)
+    parser.add_argument('--kills', type=int, default=10)
+    args = parser.parse_args()
+    stdout = sys.stdout
+    # Keep the connection messages of the clients out of the JSON
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        result = run(args)
+    finally:
+        logger.flush()
+        sys.stdout = stdout
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
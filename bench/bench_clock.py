@@ -0,0 +1,92 @@
+'''Microbenchmark of the vector clock.
+
+Compares the old clock, a dict keyed by the JSON node ids ('dict'), with
+the array of counters indexed by node slot ('array') for clusters of 8, 64
+and 512 nodes:
+
+    merge_us            merging a clock with every entry set
+    compare_us          happens-before check of two clocks
+    compare_many_us     comparing one clock with 1000 others, per clock,
+                        with NumPy when installed
+    full_bytes          the whole clock on the wire: the dict as JSON, the
+                        array as digest and varint counter per node
+    delta_bytes         the entries of one message that changed one entry
+
+    python -m bench.bench_clock --number 2000
+'''
+
+import argparse
+import json
+import random
+import timeit
+
+from lib import clock
+from lib.address import Address
+from lib.clock import ClockIndex, DeltaEncoder, VectorClock, compare_many
+from lib.election import Node
+
+
+def _legacy_merge(mine, other):
+    # VectorClock.merge before the array of counters
+    for key in other:
+        if key not in mine:
+            mine[key] = other[key]
+        else:
+            mine[key] = max(mine[key], other[key])
+
+
+def _legacy_happens_before(a, b):
+    keys = set(a) | set(b)
+    return (all(a.get(key, 0) <= b.get(key, 0) for key in keys) and
+            any(a.get(key, 0) < b.get(key, 0) for key in keys))
+
+
+def _us_per_op(function, number):
+    return round(min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6, 3)
+
+
+def run(nr_nodes, number):
+    rng = random.Random(nr_nodes)
+    ids = [Node(Address('10.0.{}.{}'.format(i // 250, i % 250 + 1), 3000),
+                Address('10.0.{}.{}'.format(i // 250, i % 250 + 1), 5970)).id
+           for i in range(nr_nodes)]
+    index = ClockIndex()
+    clocks = []
+    for _ in range(2):
+        vc = VectorClock(ids[0], index)
+        for id in ids:
+            for _ in range(rng.randrange(1, 1000)):
+                vc.increment(id)
+        clocks.append(vc)
+    a, b = clocks
+    dicts = [dict(vc.vcDictionary) for vc in clocks]
+    others = [b.copy() for _ in range(1000)]
+
+    deltas = DeltaEncoder(a)
+    deltas.encode('peer')
+    a.increment()
+    return {
+        'nodes': nr_nodes,
+        'numpy': clock.numpy is not None,
+        'dict_merge_us': _us_per_op(lambda: _legacy_merge(dict(dicts[0]), dicts[1]), number),
+        'array_merge_us': _us_per_op(lambda: a.copy().merge(b), number),
+        'dict_compare_us': _us_per_op(lambda: _legacy_happens_before(dicts[0], dicts[1]), number),
+        'array_compare_us': _us_per_op(lambda: a.happens_before(b), number),
+        'compare_many_us': round(_us_per_op(lambda: compare_many(a, others),
+                                            max(1, number // 100)) / len(others), 3),
+        'dict_full_bytes': len(json.dumps(dicts[0])),
+        'array_full_bytes': len(a.encode_delta()),
+        'delta_bytes': len(deltas.encode('peer')),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--nodes', default='8,64,512')
+    args = parser.parse_args()
+    print(json.dumps([run(int(n), args.number) for n in args.nodes.split(',')], indent=2))
+
+
+if __name__ == '__main__':
+    main()
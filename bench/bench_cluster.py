@@ -0,0 +1,95 @@
+'''Convergence time, message counts and CPU of simulated clusters.
+
+Runs whole clusters in process with lib.sim: the real discovery, ring and
+gossip code of every server on a virtual clock and an in-memory network.
+Reports per scenario, membership mode and cluster size
+
+    convergence_s    virtual seconds until every live server has the same
+                     members and leader, null if not within --timeout
+    messages         datagrams sent, by message type
+    cpu_ms_per_node  CPU time spent in the handlers of one server, average
+    wall_s           real time the run took
+
+Scenarios:
+
+    join   the servers start --stagger seconds apart and discover each
+           other, discovery is O(N^2) so keep it to a few hundred servers
+    crash  the servers start with full membership, the leader crashes
+           after --warmup seconds
+
+    python -m bench.bench_cluster --scenario crash --nodes 10,100,1000
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from lib.sim import SimCluster
+
+
+def run(scenario, mode, nr_nodes, args):
+    started = time.time()
+    cluster = SimCluster(nr_nodes, seed=args.seed, latency=args.latency, jitter=args.jitter,
+                         loss=args.loss, mode=mode, heartbeat_interval=args.interval,
+                         gossip_interval=args.interval)
+    try:
+        if scenario == 'join':
+            cluster.start(stagger=args.stagger)
+        else:
+            cluster.bootstrap()
+            cluster.sim.run(until=args.warmup)
+            leader = next(node for node in cluster.nodes if node.election.is_leader())
+            leader.crash()
+        convergence = cluster.run_until(cluster.converged, timeout=args.timeout,
+                                        resolution=args.resolution)
+        report = cluster.report()
+    finally:
+        cluster.close()
+    return dict({
+        'scenario': scenario,
+        'mode': mode,
+        'convergence_s': None if convergence is None else round(convergence, 3),
+        'wall_s': round(time.time() - started, 2),
+    }, **report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=('join', 'crash'), default='crash')
+    parser.add_argument('--modes', default='ring,gossip')
+    parser.add_argument('--nodes', default='10,100')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0005,
+                        help='one way latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='extra random latency in seconds, at most')
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help='fraction of datagrams dropped')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='heartbeat and gossip interval in seconds')
+    parser.add_argument('--stagger', type=float, default=0.05,
+                        help='seconds between server starts, join scenario')
+    parser.add_argument('--warmup', type=float, default=5.0,
+                        help='seconds before the leader crashes, crash scenario')
+    parser.add_argument('--timeout', type=float, default=300.0,
+                        help='virtual seconds to wait for convergence')
+    parser.add_argument('--resolution', type=float, default=0.1,
+                        help='virtual seconds between convergence checks')
+    args = parser.parse_args()
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    logging.disable(logging.CRITICAL)
+    try:
+        results = [run(args.scenario, mode, int(n), args)
+                   for n in args.nodes.split(',')
+                   for mode in args.modes.split(',')]
+    finally:
+        sys.stdout = stdout
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''Benchmark of replica message handling in InternalMessageHandler.
+
+Compares the old listener, which forks and joins a process per datagram
+('fork'), with the in-process dispatcher ('dispatch'). A client keeps a
+window of requests in flight through a ReplicaChannel and reports control
+messages/sec and the p50/p99 handling latency (request to response).
+
+    python -m bench.bench_dispatch --requests 2000 --window 16
+'''
+
+import argparse
+import json
+from multiprocessing import Process
+from multiprocessing.shared_memory import ShareableList
+import os
+import socket
+import sys
+import threading
+import time
+
+from lib import wire
+from lib.address import Address
+from lib.channel import ReplicaChannel
+from lib.internal_handler import InternalMessageHandler
+from lib.membership import MembershipTable
+from lib.message import Message, MessageType
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _legacy_listen(handler):
+    # The listener loop before the dispatcher: one fork per datagram, with
+    # the handler run synchronously in the child
+    while True:
+        data, address = handler.sock.recvfrom(65535)
+        message = wire.loads(data)
+        p = Process(target=handler.dispatcher.dispatch,
+                    args=(message, address, True))
+        p.start()
+        p.join()
+
+
+def _serve(handler, mode):
+    sys.stdout = open(os.devnull, 'w')
+    if mode == 'fork':
+        _legacy_listen(handler)
+    else:
+        handler.listen_message()
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(mode, type, nr_requests, window):
+    port = _free_port()
+    os.environ['REPLICA_PORT'] = str(_free_port())
+    membership = MembershipTable("membership" + str(port), capacity=5, create=True)
+    leader_id = ShareableList([" " * 256], name="leader_id" + str(port))
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        handler = InternalMessageHandler(
+            server_address=Address('127.0.0.1', port), membership=membership)
+    finally:
+        sys.stdout = stdout
+    listener = Process(target=_serve, args=(handler, mode))
+    listener.start()
+    handler.sock.close()
+    time.sleep(0.3)
+
+    channel = ReplicaChannel(host='127.0.0.1')
+    address = Address('127.0.0.1', handler.port)
+    latencies = []
+    slots = threading.Semaphore(window)
+    done = threading.Event()
+
+    def on_done(future, sent_at):
+        latencies.append(time.perf_counter() - sent_at)
+        slots.release()
+        if len(latencies) == nr_requests:
+            done.set()
+
+    start = time.perf_counter()
+    for _ in range(nr_requests):
+        slots.acquire()
+        sent_at = time.perf_counter()
+        future = channel.request(Message(message=handler.election.id, type=type,
+                                         host='127.0.0.1', port=port), address)
+        future.add_done_callback(lambda f, sent_at=sent_at: on_done(f, sent_at))
+    done.wait()
+    elapsed = time.perf_counter() - start
+
+    listener.kill()
+    listener.join()
+    channel.close()
+    membership.close()
+    membership.unlink()
+    leader_id.shm.close()
+    leader_id.shm.unlink()
+
+    return {
+        'mode': mode,
+        'type': type.name,
+        'requests': nr_requests,
+        'window': window,
+        'messages_per_sec': round(nr_requests / elapsed, 1),
+        'p50_ms': round(_percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(_percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--window', type=int, default=16)
+    parser.add_argument('--modes', default='fork,dispatch')
+    args = parser.parse_args()
+
+    results = []
+    for type in (MessageType.PING_REQ, MessageType.LEADER_REQ):
+        for mode in args.modes.split(','):
+            results.append(run(mode, type, args.requests, args.window))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
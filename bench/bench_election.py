@@ -0,0 +1,89 @@
+'''Time to leader and message count of the election strategies.
+
+Runs the election of RingMember in process, with every message delivered
+after a fixed one way latency on a virtual clock and blocking requests to
+crashed members taking the request timeout. The leader crashes and either
+its predecessor in the ring ('one', ring failure detection) or every member
+at once ('all', gossip failure detection) starts an election. Reports per
+strategy and ring size
+
+    time_to_leader_ms  from the start until every member knows the leader
+    messages           election and leader requests sent
+    epochs             elections started, concurrent ones coalesce into one
+
+    python -m bench.bench_election --members 4,16,64,256
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+from unittest import mock
+
+from lib.address import Address
+from lib.sim import SimLinks, SimRingMember
+
+
+def run(strategy, nr_members, detectors, latency, timeout):
+    with mock.patch.dict(os.environ, {'ELECTION_STRATEGY': strategy}):
+        cluster = SimLinks(latency=latency, timeout=timeout)
+        try:
+            table = cluster.table()
+            # Join in a shuffled order, the ring is sorted anyway
+            order = [(i * 7919) % nr_members for i in range(nr_members)]
+            members = [SimRingMember(cluster, Address('10.0.{}.{}'.format(i // 250, i % 250 + 1),
+                                                      3000), membership=table) for i in order]
+            leader = max(members, key=lambda member: member.key)
+            for member in members:
+                member.leader_id[0] = leader.id
+            cluster.down.add(leader.replica_address)
+            table.remove(leader)
+            alive = [member for member in members if member is not leader]
+
+            if detectors == 'one':
+                # The predecessor of the leader pings it in ring mode
+                ring = sorted(alive + [leader], key=lambda member: member.key)
+                cluster.sim.at(0, alive[alive.index(ring[-2])].inititate_election)
+            else:
+                for member in alive:
+                    cluster.sim.at(0, member.inititate_election)
+            cluster.run()
+
+            expected = max(alive, key=lambda member: member.key).id
+            assert all(member.leader_id[0] == expected for member in alive)
+            return {
+                'strategy': strategy,
+                'members': nr_members,
+                'detectors': detectors,
+                'time_to_leader_ms': round(max(member.known_at for member in alive) * 1e3, 2),
+                'messages': cluster.messages,
+                'epochs': max(member.election_epoch for member in alive),
+            }
+        finally:
+            cluster.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--members', default='4,16,64,256')
+    parser.add_argument('--latency', type=float, default=0.0005,
+                        help='one way latency in seconds')
+    parser.add_argument('--timeout', type=float, default=0.2,
+                        help='request timeout in seconds')
+    args = parser.parse_args()
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    logging.disable(logging.CRITICAL)
+    try:
+        results = [run(strategy, int(n), detectors, args.latency, args.timeout)
+                   for n in args.members.split(',')
+                   for detectors in ('one', 'all')
+                   for strategy in ('ring', 'bully')]
+    finally:
+        sys.stdout = stdout
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+'''Throughput benchmark of the length prefixed frame codec in lib.framing.
+
+Measures pipelined small messages (many frames per read) and multi-MB
+messages (many reads per frame), both from memory and through a socket pair
+read with recv_into.
+
+    python -m bench.bench_framing --small 200000 --large-size 8 --large 20
+'''
+
+import argparse
+import json
+import socket
+import threading
+import time
+
+from lib.framing import FrameDecoder, encode_frame, encode_message
+from lib.message import ChatMessage
+
+
+def _stream(nr_messages, size):
+    message = ChatMessage(sender='bench', message='x' * size)
+    return encode_message(message) * nr_messages
+
+
+def bench_feed(data, nr_messages, chunk_size, decode):
+    decoder = FrameDecoder()
+    view = memoryview(data)
+    count = 0
+    start = time.perf_counter()
+    for i in range(0, len(data), chunk_size):
+        decoder.feed(view[i:i + chunk_size])
+        count += sum(1 for _ in (decoder.messages() if decode else decoder.frames()))
+    elapsed = time.perf_counter() - start
+    assert count == nr_messages
+    return elapsed
+
+
+def bench_socket(data, nr_messages, decode):
+    reader, writer = socket.socketpair()
+    sender = threading.Thread(target=lambda: (writer.sendall(data), writer.close()))
+    decoder = FrameDecoder()
+    count = 0
+    start = time.perf_counter()
+    sender.start()
+    while decoder.recv_into(reader):
+        count += sum(1 for _ in (decoder.messages() if decode else decoder.frames()))
+    elapsed = time.perf_counter() - start
+    sender.join()
+    reader.close()
+    assert count == nr_messages
+    return elapsed
+
+
+def _result(name, data, nr_messages, elapsed):
+    return {
+        'case': name,
+        'messages': nr_messages,
+        'bytes': len(data),
+        'messages_per_sec': round(nr_messages / elapsed, 1),
+        'mb_per_sec': round(len(data) / elapsed / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--small', type=int, default=200000,
+                        help='number of pipelined small messages')
+    parser.add_argument('--small-size', type=int, default=64)
+    parser.add_argument('--large', type=int, default=20,
+                        help='number of large messages')
+    parser.add_argument('--large-size', type=int, default=8,
+                        help='size of a large message in MB')
+    args = parser.parse_args()
+
+    results = []
+    small = _stream(args.small, args.small_size)
+    large = encode_frame(b'x' * (args.large_size * 1024 * 1024)) * args.large
+    for chunk_size in (1024, 65536):
+        results.append(_result('small/feed/frames/{}'.format(chunk_size), small, args.small,
+                               bench_feed(small, args.small, chunk_size, False)))
+        results.append(_result('small/feed/messages/{}'.format(chunk_size), small, args.small,
+                               bench_feed(small, args.small, chunk_size, True)))
+    results.append(_result('small/socket/messages', small, args.small,
+                           bench_socket(small, args.small, True)))
+    results.append(_result('large/feed/frames/65536', large, args.large,
+                           bench_feed(large, args.large, 65536, False)))
+    results.append(_result('large/socket/frames', large, args.large,
+                           bench_socket(large, args.large, False)))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+'''Append rate and replay throughput of the on-disk chat log.
+
+Appends --messages ChatMessage records to a SegmentLog in a temporary
+directory, then replays them: all from the start, from an offset in the
+middle, and since a timestamp in the middle. Reports
+
+    append_msg_s        appended records per second, with fsync every
+                        --fsync-messages records (0: once a second)
+    replay_msg_s        records read back per second, from the start
+    seek_offset_us      time to the first record from a random offset,
+    seek_time_us        or from a random timestamp, median of --seeks
+    segments, mb        segment files and bytes on disk
+    index_kb            size of the sparse indexes
+
+    python -m bench.bench_log_store --messages 10000000
+'''
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from lib.log_store import SegmentLog
+from lib.message import ChatMessage
+
+
+def _median_us(function, arguments):
+    times = []
+    for argument in arguments:
+        started = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - started)
+    return round(sorted(times)[len(times) // 2] * 1e6, 2)
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix='bench_log_store', dir=args.dir)
+    try:
+        log = SegmentLog(directory, segment_bytes=args.segment_bytes,
+                         fsync_messages=args.fsync_messages, fsync_interval=1)
+        data = str.encode(ChatMessage(sender='bench', message='x' * args.size).toJSON())
+        # Timestamps one microsecond apart, so seeking by time is exact
+        start = time.time()
+        started = time.perf_counter()
+        for i in range(args.messages):
+            log.append(data, epoch=1, timestamp=start + i * 1e-6)
+        log.sync()
+        append_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        count = sum(1 for _ in log.replay(0))
+        replay_s = time.perf_counter() - started
+        assert count == args.messages
+
+        rng = random.Random(1)
+        offsets = [rng.randrange(args.messages) for _ in range(args.seeks)]
+        seek_offset = _median_us(lambda offset: next(log.replay(offset)), offsets)
+        seek_time = _median_us(lambda offset: next(log.replay_since(start + offset * 1e-6)),
+                               offsets)
+        log.close()
+
+        files = os.listdir(directory)
+        return {
+            'messages': args.messages,
+            'record_bytes': len(data) + 20,
+            'fsync_messages': args.fsync_messages,
+            'append_msg_s': round(args.messages / append_s),
+            'replay_msg_s': round(args.messages / replay_s),
+            'seek_offset_us': seek_offset,
+            'seek_time_us': seek_time,
+            'segments': sum(1 for name in files if name.endswith('.log')),
+            'mb': round(sum(os.path.getsize(os.path.join(directory, name))
+                            for name in files if name.endswith('.log')) / 2 ** 20, 1),
+            'index_kb': round(sum(os.path.getsize(os.path.join(directory, name))
+                                  for name in files if name.endswith('.index')) / 1024, 1),
+        }
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000000)
+    parser.add_argument('--size', type=int, default=40,
+                        help='characters per chat message')
+    parser.add_argument('--segment-bytes', type=int, default=64 * 1024 * 1024)
+    parser.add_argument('--fsync-messages', type=int, default=0)
+    parser.add_argument('--seeks', type=int, default=1000)
+    parser.add_argument('--dir', default=None,
+                        help='directory for the log, by default the temporary one')
+    args = parser.parse_args()
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
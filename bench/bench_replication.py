@@ -0,0 +1,124 @@
+'''Throughput and commit latency of chat log replication.
+
+Starts 1, 3 and 5 replica handlers in process, each listening on its own
+UDP port on localhost, and appends chat messages to the log of the leader
+with a fixed number of uncommitted messages outstanding (closed loop).
+Reports per number of replicas and acknowledgement mode
+
+    throughput_msg_s     messages committed per second
+    commit_p50_ms        time from append to commit, median and 99th
+    commit_p99_ms        percentile
+    batches              REPLICATE_REQ batches sent by the leader
+    entries_per_batch    average entries in one batch
+
+    python -m bench.bench_replication --replicas 1,3,5 --messages 20000
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from lib.address import Address
+from lib.internal_handler import InternalMessageHandler
+from lib.membership import MembershipTable
+from lib.message import ChatMessage
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(nr_replicas, acks, args, base_port):
+    os.environ['REPLICATION_ACKS'] = acks
+    os.environ['REPLICA_PORT'] = str(base_port)
+    tables = []
+    handlers = []
+    try:
+        for i in range(nr_replicas):
+            tables.append(MembershipTable('bench_replication{}_{}'.format(base_port, i),
+                                          capacity=8, create=True))
+            handler = InternalMessageHandler(Address('127.0.0.1', base_port + 100 + i),
+                                             membership=tables[i], leader_id=[" " * 256],
+                                             election_state=[1, 1, 1, 0.0])
+            handler.host = '127.0.0.1'
+            handlers.append(handler)
+        for table in tables:
+            for handler in handlers:
+                table.add(handler.election)
+        leader = handlers[0]
+        for handler in handlers:
+            handler.election.leader_id[0] = leader.election.id
+            threading.Thread(target=handler.listen_message, daemon=True).start()
+
+        data = ChatMessage(sender='bench', message='x' * args.size).toJSON()
+        outstanding = threading.Semaphore(args.outstanding)
+        latencies = []
+        done = threading.Event()
+
+        def committed(future, appended_at):
+            latencies.append(time.perf_counter() - appended_at)
+            outstanding.release()
+            if len(latencies) == args.messages:
+                done.set()
+
+        started = time.perf_counter()
+        for _ in range(args.messages):
+            outstanding.acquire()
+            appended_at = time.perf_counter()
+            leader.replicator.append(data).add_done_callback(
+                lambda future, appended_at=appended_at: committed(future, appended_at))
+        if not done.wait(args.timeout):
+            raise RuntimeError('{} of {} messages committed'.format(
+                len(latencies), args.messages))
+        elapsed = time.perf_counter() - started
+        stats = leader.replicator.stats()
+        return {
+            'replicas': nr_replicas,
+            'acks': acks,
+            'throughput_msg_s': round(args.messages / elapsed),
+            'commit_p50_ms': round(_percentile(latencies, 0.5) * 1e3, 3),
+            'commit_p99_ms': round(_percentile(latencies, 0.99) * 1e3, 3),
+            'batches': stats['batches_sent'],
+            'entries_per_batch': round(stats['entries_sent'] / max(1, stats['batches_sent']), 1),
+            'retransmits': stats['retransmits'],
+        }
+    finally:
+        for handler in handlers:
+            handler.terminate()
+        for table in tables:
+            table.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--replicas', default='1,3,5')
+    parser.add_argument('--acks', default='leader,quorum,all')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--outstanding', type=int, default=256,
+                        help='appended messages not committed yet, at most')
+    parser.add_argument('--size', type=int, default=100,
+                        help='characters per chat message')
+    parser.add_argument('--wire', choices=('json', 'binary'), default='binary')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    args = parser.parse_args()
+
+    os.environ['WIRE_FORMAT'] = args.wire
+    base_port = 20000 + os.getpid() % 100 * 200
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    logging.disable(logging.CRITICAL)
+    try:
+        results = [run(int(n), acks, args, base_port)
+                   for n in args.replicas.split(',')
+                   for acks in args.acks.split(',')]
+    finally:
+        sys.stdout = stdout
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
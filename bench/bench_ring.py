@@ -0,0 +1,85 @@
+'''Microbenchmark of RingMember.get_next_node.
+
+Compares the old lookup, which sorted the JSON ids of all members and
+searched its own id on every call ('rebuild'), with the cached ring view
+('cached') for rings of 5, 100 and 1000 members. Also reports the cost of
+rebuilding the view when a member leaves and rejoins.
+
+    python -m bench.bench_ring --number 10000
+'''
+
+import argparse
+import json
+from multiprocessing.shared_memory import ShareableList
+import os
+import timeit
+
+from lib.address import Address
+from lib.election import Node, RingMember
+from lib.membership import MembershipTable
+
+
+def _node(i):
+    host = '10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256)
+    return Node(Address(host, 3000), Address(host, 5970))
+
+
+def _legacy_next_node(member, ids):
+    # get_next_node before the ring view, on the list of JSON ids
+    node_list = sorted(ids)
+    if len(node_list) <= 1:
+        return None
+    json_node = Node(address=member.address,
+                     replica_address=member.replica_address).toJSON()
+    current_index = node_list.index(json_node)
+    return Node.fromJSON(node_list[(current_index + 1) % len(node_list)])
+
+
+def _us_per_op(function, number):
+    return round(min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6, 3)
+
+
+def run(nr_members, number):
+    port = 40000 + os.getpid() % 20000
+    table = MembershipTable('membership{}'.format(port), capacity=nr_members, create=True)
+    leader_id = ShareableList([" " * 256], name='leader_id{}'.format(port))
+    try:
+        for i in range(nr_members - 1):
+            table.add(_node(i))
+        member = RingMember(address=Address('10.0.0.128', port),
+                            replica_address=Address('10.0.0.128', 5970), membership=table)
+        table.add(member)
+        ids = [node.id for node in table.nodes()]
+        extra = _node(0)
+
+        def rebuild_view():
+            # A member leaves and comes back
+            table.remove(extra)
+            member.get_next_node()
+            table.add(extra)
+            member.get_next_node()
+
+        return {
+            'members': nr_members,
+            'rebuild_us': _us_per_op(lambda: _legacy_next_node(member, ids), number),
+            'cached_us': _us_per_op(member.get_next_node, number),
+            'leave_and_rejoin_us': _us_per_op(rebuild_view, max(1, number // 100)),
+        }
+    finally:
+        for shared in (table, leader_id.shm):
+            shared.close()
+            shared.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=10000)
+    parser.add_argument('--members', default='5,100,1000')
+    args = parser.parse_args()
+
+    results = [run(int(n), args.number) for n in args.members.split(',')]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
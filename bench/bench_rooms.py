@@ -0,0 +1,77 @@
+'''Benchmark of the room ring of lib/rooms.py.
+
+Places --rooms rooms on rings of 5, 20 and 100 members with 1, 32 and 256
+points (virtual nodes) per member and reports per ring
+
+    build_ms            time to build the ring
+    lookup_us           time to find the owner of a room
+    skew                rooms of the busiest member over the mean, 1 is even
+    stddev_pct          standard deviation of the rooms per member, in
+                        percent of the mean
+    join_moved_pct      rooms that moved when a member joined, ideally
+                        100 / (members + 1)
+    leave_moved_pct     rooms that moved when a member left, ideally
+                        100 / members
+
+    python -m bench.bench_rooms --rooms 100000
+'''
+
+import argparse
+from collections import Counter
+import json
+import statistics
+import time
+import timeit
+
+from lib.address import Address
+from lib.rooms import HashRing
+
+
+def _node(i):
+    return Address('10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256), 3000)
+
+
+def _moved_pct(before, after):
+    moved = sum(1 for room, owner in before.items() if after[room] != owner)
+    return round(moved / len(before) * 100, 2)
+
+
+def run(nr_members, vnodes, rooms):
+    nodes = [_node(i) for i in range(nr_members + 1)]
+    started = time.perf_counter()
+    ring = HashRing(nodes[:nr_members], vnodes)
+    build_ms = (time.perf_counter() - started) * 1000
+    owners = {room: ring.owner(room) for room in rooms}
+    counts = [Counter(owners.values()).get(node, 0) for node in nodes[:nr_members]]
+    mean = len(rooms) / nr_members
+    number = 100000
+    lookup = min(timeit.repeat(lambda: ring.owner('room42'), number=number, repeat=5))
+    joined = HashRing(nodes, vnodes)
+    left = HashRing(nodes[1:nr_members], vnodes)
+    return {
+        'members': nr_members,
+        'vnodes': vnodes,
+        'build_ms': round(build_ms, 3),
+        'lookup_us': round(lookup / number * 1e6, 3),
+        'skew': round(max(counts) / mean, 3),
+        'stddev_pct': round(statistics.pstdev(counts) / mean * 100, 2),
+        'join_moved_pct': _moved_pct(owners, {room: joined.owner(room) for room in rooms}),
+        'leave_moved_pct': _moved_pct(owners, {room: left.owner(room) for room in rooms}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=100000)
+    parser.add_argument('--members', default='5,20,100')
+    parser.add_argument('--vnodes', default='1,32,256')
+    args = parser.parse_args()
+
+    rooms = ['room{}'.format(i) for i in range(args.rooms)]
+    results = [run(int(members), int(vnodes), rooms)
+               for members in args.members.split(',') for vnodes in args.vnodes.split(',')]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+'''Benchmark of the chat serving modes of server.Server.
+
+Compares the process per client model ('process') with the single event loop
+model ('asyncio') at a number of concurrent clients and reports the memory
+used per connection and the messages/sec fanned out by the server.
+
+    python -m bench.bench_server --clients 1000,10000 --modes process,asyncio
+
+Memory is the proportional set size (PSS) of the server process and all of its
+children, read from /proc, so it only works on Linux. Opening 10k connections
+needs a high enough open file limit (ulimit -n) for both sides.
+'''
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import time
+
+from lib.async_server import ChatMetrics
+from lib.framing import encode_message
+from lib.logger import Logger
+from lib.send_queue import config_from_env
+from lib.message import ChatMessage
+from server import CLIENT_LOCKS, CLIENT_SLOTS, Server
+
+CONNECT_CONCURRENCY = 200
+
+
+class _NoReplication():
+    # The benchmark has no leader, chat messages only fan out
+    def submit_chat_message(self, message, clock=None):
+        return False
+
+
+def _make_server(host, port):
+    # Only the chat serving part of the Server is needed, no discovery or ring
+    server = Server.__new__(Server)
+    server.host = host
+    server.port = port
+    server.server_socket = server._create_server_socket(host, port)
+    server.server_socket.listen(4096)
+    server._logger = Logger()
+    server._chat_metrics = ChatMetrics()
+    server.id = 'bench'
+    server._client_list = []
+    server._internal_msg_handler = _NoReplication()
+    server._rooms = None
+    server._clock_count = multiprocessing.Value('Q', 0)
+    server._send_queue_config = config_from_env()
+    server._client_locks = [multiprocessing.Lock() for _ in range(CLIENT_LOCKS)]
+    server.send_timeout = 5
+    server._client_rooms = multiprocessing.Array('Q', CLIENT_SLOTS, lock=False)
+    server.room_check_interval = 1
+    return server
+
+
+def _serve(server, mode):
+    sys.stdout = open(os.devnull, 'w')
+    if mode == 'asyncio':
+        server.serve_asyncio()
+    else:
+        server.process_listen_client()
+
+
+def _children(pid):
+    children = []
+    try:
+        for tid in os.listdir('/proc/{}/task'.format(pid)):
+            with open('/proc/{}/task/{}/children'.format(pid, tid)) as f:
+                children += [int(c) for c in f.read().split()]
+    except FileNotFoundError:
+        pass
+    return children
+
+
+def _pss_kb(pid):
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return 0
+
+
+def tree_memory_kb(pid):
+    total = _pss_kb(pid)
+    for child in _children(pid):
+        total += tree_memory_kb(child)
+    return total
+
+
+class BenchClient():
+    def __init__(self, name):
+        self.received = 0
+        self.echo = None
+        self.payload = encode_message(
+            ChatMessage(sender=name, message='x' * 32))
+        self._marker = str.encode('"sender": "{}"'.format(name))
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    async def read_loop(self):
+        tail = b''
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                break
+            self.received += data.count(b'"sender"')
+            # Keep a tail so a marker split over two reads is still found
+            window = tail + data
+            tail = window[-len(self._marker):]
+            if self.echo is not None and self._marker in window:
+                self.echo.set()
+
+    async def ping(self, timeout):
+        # One message in flight per sender: wait for our own message to come
+        # back before sending the next one
+        self.echo = asyncio.Event()
+        self.writer.write(self.payload)
+        await asyncio.wait_for(self.echo.wait(), timeout)
+
+
+async def _drive(host, port, nr_clients, nr_senders, nr_messages, timeout):
+    clients = [BenchClient('bench{}'.format(i)) for i in range(nr_clients)]
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(client):
+        async with semaphore:
+            await client.connect(host, port)
+
+    await asyncio.gather(*[connect(c) for c in clients])
+    readers = [asyncio.ensure_future(c.read_loop()) for c in clients]
+    # Give the server time to accept (and fork) for every connection
+    await asyncio.sleep(1 + nr_clients / 2000)
+
+    async def send(client):
+        sent = 0
+        for _ in range(nr_messages):
+            try:
+                await client.ping(timeout)
+                sent += 1
+            except asyncio.TimeoutError:
+                break
+        return sent
+
+    start = time.perf_counter()
+    sent = sum(await asyncio.gather(*[send(c) for c in clients[:nr_senders]]))
+    elapsed = time.perf_counter() - start
+    delivered = sum(c.received for c in clients)
+
+    for reader in readers:
+        reader.cancel()
+    for client in clients:
+        client.writer.close()
+    return sent, delivered, elapsed
+
+
+def run(mode, nr_clients, nr_senders, nr_messages, timeout, host='127.0.0.1'):
+    server = _make_server(host, _free_port(host))
+    process = multiprocessing.Process(target=_serve, args=(server, mode))
+    process.start()
+    server.server_socket.close()
+    time.sleep(0.5)
+    idle_kb = tree_memory_kb(process.pid)
+
+    loop = asyncio.new_event_loop()
+    try:
+        task = loop.create_task(_drive(host, server.port, nr_clients,
+                                       nr_senders, nr_messages, timeout))
+        # Sample memory while every client is still connected
+        sent, delivered, elapsed = loop.run_until_complete(
+            _sample_memory(task, process.pid))
+        loaded_kb = _sample_memory.peak
+    finally:
+        loop.close()
+        _kill_tree(process.pid)
+        process.join()
+
+    return {
+        'mode': mode,
+        'clients': nr_clients,
+        'senders': nr_senders,
+        'memory_idle_kb': idle_kb,
+        'memory_loaded_kb': loaded_kb,
+        'memory_per_connection_kb': round((loaded_kb - idle_kb) / nr_clients, 2),
+        'messages_in': sent,
+        'messages_out': delivered,
+        'messages_in_per_sec': round(sent / elapsed, 1) if elapsed else 0,
+        'messages_out_per_sec': round(delivered / elapsed, 1) if elapsed else 0,
+    }
+
+
+async def _sample_memory(task, pid):
+    _sample_memory.peak = 0
+    while not task.done():
+        _sample_memory.peak = max(_sample_memory.peak, tree_memory_kb(pid))
+        await asyncio.sleep(0.5)
+    return task.result()
+
+
+def _kill_tree(pid):
+    for child in _children(pid):
+        _kill_tree(child)
+    try:
+        os.kill(pid, 9)
+    except ProcessLookupError:
+        pass
+
+
+def _free_port(host):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', default='1000,10000')
+    parser.add_argument('--modes', default='process,asyncio')
+    parser.add_argument('--senders', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--timeout', type=float, default=10)
+    args = parser.parse_args()
+
+    _raise_fd_limit()
+    results = []
+    for nr_clients in [int(c) for c in args.clients.split(',')]:
+        for mode in args.modes.split(','):
+            result = run(mode, nr_clients, min(args.senders, nr_clients),
+                         args.messages, args.timeout)
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
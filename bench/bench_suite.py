@@ -0,0 +1,229 @@
+'''Regression suite of microbenchmarks of the lib/ hot paths.
+
+Times every tracked path and compares it with the baseline stored in
+bench/baseline.json. Timings are scaled by a calibration loop measured in
+the same run, so a slower or faster machine than the one that stored the
+baseline does not count as a change. Exits with 1 when a path got slower
+than --threshold percent, 25 by default. Reports per path
+
+    us                  time per call, best of --repeat rounds
+    baseline_us         the stored time, scaled to this machine
+    change_pct          difference to the baseline, positive is slower
+
+    python -m bench.bench_suite                 # compare with the baseline
+    python -m bench.bench_suite --save          # store a new baseline
+    python -m bench.bench_suite --only clock    # paths whose name contains it
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import timeit
+
+from lib import wire
+from lib.address import Address
+from lib.clock import ClockIndex, VectorClock
+from lib.election import Node, RingMember
+from lib.membership import MembershipTable
+from lib.metrics import Registry
+from lib.rooms import HashRing
+from lib.message import ChatMessage, Message, MessageDecoder, MessageEncoder, MessageType
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def _node(i):
+    host = '10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256)
+    return Node(Address(host, 3000), Address(host, 5970))
+
+
+def _calibration():
+    # Plain interpreter work, the yardstick of the machine
+    def loop():
+        total = 0
+        for i in range(1000):
+            total += i * i % 7
+        return total
+    return loop
+
+
+def _message_json():
+    message = Message(message=_node(1).id, type=MessageType.ELECTION_REQ,
+                      host='192.168.1.20', port=3000, correlation_id=7)
+    return lambda: json.loads(json.loads(MessageEncoder().encode(message)), cls=MessageDecoder)
+
+
+def _message_binary():
+    message = Message(message=_node(1).id, type=MessageType.ELECTION_REQ,
+                      host='192.168.1.20', port=3000, correlation_id=7)
+    return lambda: wire.decode(wire.encode(message))
+
+
+def _chat_message():
+    message = ChatMessage(sender='alice', message='hello ' * 10)
+    return lambda: ChatMessage.fromJSON(message.toJSON())
+
+
+def _node_json():
+    node = _node(1)
+    return lambda: Node.fromJSON(Node(node.address, node.replica_address).toJSON())
+
+
+def _address():
+    return lambda: Address.from_string('192.168.1.20:5970')
+
+
+@contextlib.contextmanager
+def _ring(name, nr_members):
+    table = MembershipTable('bench_suite_{}{}'.format(name, os.getpid()), capacity=nr_members,
+                            create=True)
+    try:
+        for i in range(1, nr_members):
+            table.add(_node(i))
+        member = RingMember(address=Address('10.0.0.0', 3000),
+                            replica_address=Address('10.0.0.0', 5970), membership=table,
+                            leader_id=[' '], election_state=[0, 0, 0, 0.0])
+        table.add(member)
+        yield table, member
+    finally:
+        table.close()
+        table.unlink()
+
+
+def _ring_next_node(stack):
+    table, member = stack.enter_context(_ring('next', 100))
+    return member.get_next_node
+
+
+def _ring_rebuild(stack):
+    # A member leaves and comes back, the ring is formed again each time
+    table, member = stack.enter_context(_ring('rebuild', 100))
+    extra = _node(1)
+
+    def rebuild():
+        table.remove(extra)
+        member.form_ring()
+        member.get_next_node()
+        table.add(extra)
+        member.form_ring()
+        member.get_next_node()
+    return rebuild
+
+
+def _clock_merge():
+    index = ClockIndex()
+    a, b = VectorClock('a', index), VectorClock('b', index)
+    for i in range(64):
+        for _ in range(i % 5 + 1):
+            b.increment('node{}'.format(i))
+    return lambda: a.merge(b)
+
+
+def _counter_inc():
+    return Registry().counter('bench_total').inc
+
+
+def _histogram_observe():
+    histogram = Registry().histogram('bench_seconds')
+    return lambda: histogram.observe(0.003)
+
+
+def _room_owner():
+    ring = HashRing([_node(i).address for i in range(100)], vnodes=256)
+    return lambda: ring.owner('room42')
+
+
+# name -> factory of the function to time, called with the ExitStack of
+# the run when it takes an argument
+CASES = {
+    'calibration': _calibration,
+    'message_json_roundtrip': _message_json,
+    'message_binary_roundtrip': _message_binary,
+    'chat_message_roundtrip': _chat_message,
+    'node_json_roundtrip': _node_json,
+    'address_from_string': _address,
+    'ring_next_node_100': _ring_next_node,
+    'ring_rebuild_100': _ring_rebuild,
+    'clock_merge_64': _clock_merge,
+    'metrics_counter_inc': _counter_inc,
+    'metrics_histogram_observe': _histogram_observe,
+    'rooms_owner_100': _room_owner,
+}
+
+
+def measure(names, repeat):
+    # Best time per call of every path, in rounds that each run all paths
+    # once, so a slow phase of the machine hits them all alike
+    with contextlib.ExitStack() as stack, contextlib.redirect_stdout(io.StringIO()):
+        timers = {}
+        for name in names:
+            factory = CASES[name]
+            function = factory(stack) if factory.__code__.co_argcount else factory()
+            timer = timeit.Timer(function)
+            timers[name] = (timer, timer.autorange()[0])
+        best = dict.fromkeys(names, float('inf'))
+        for _ in range(repeat):
+            for name, (timer, number) in timers.items():
+                best[name] = min(best[name], timer.timeit(number) / number)
+    return {name: seconds * 1e6 for name, seconds in best.items()}
+
+
+def compare(timings, baseline, threshold):
+    # Rows per path and the names of the ones that regressed
+    scale = timings['calibration'] / baseline['calibration']
+    rows, regressed = {}, []
+    for name, us in timings.items():
+        row = {'us': round(us, 3)}
+        if name != 'calibration' and name in baseline:
+            expected = baseline[name] * scale
+            row['baseline_us'] = round(expected, 3)
+            row['change_pct'] = round((us / expected - 1) * 100, 1)
+            if row['change_pct'] > threshold:
+                regressed.append(name)
+        rows[name] = row
+    return {'scale': round(scale, 3), 'threshold_pct': threshold, 'paths': rows,
+            'regressed': regressed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=25,
+                        help='percent slower than the baseline that fails the run')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--only', default='', help='run the paths whose name contains it')
+    parser.add_argument('--save', action='store_true', help='store the timings as the baseline')
+    args = parser.parse_args()
+
+    names = ['calibration'] + [name for name in CASES
+                               if name != 'calibration' and args.only in name]
+    timings = measure(names, args.repeat)
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        scale = baseline['calibration'] / timings['calibration'] if baseline else 1
+        # Paths not run keep their stored time, the ones run are stored on
+        # the scale of the stored calibration
+        baseline.update({name: round(us * scale, 4) for name, us in timings.items()
+                         if name != 'calibration'})
+        baseline.setdefault('calibration', round(timings['calibration'], 4))
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(json.dumps({name: round(us, 3) for name, us in timings.items()}, indent=2))
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    report = compare(timings, baseline, args.threshold)
+    print(json.dumps(report, indent=2))
+    if report['regressed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
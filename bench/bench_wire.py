@@ -0,0 +1,60 @@
+'''Microbenchmark of the Message wire formats in lib.wire.
+
+Reports encode and decode ns/op and bytes per message of the legacy double
+encoded JSON path and of the binary format for typical control messages.
+
+    python -m bench.bench_wire --number 100000
+'''
+
+import argparse
+import json
+import timeit
+
+from lib import wire
+from lib.address import Address
+from lib.election import Node
+from lib.message import Message, MessageEncoder, MessageType
+
+
+def _messages():
+    node = Node(address=Address('192.168.1.20', 3000),
+                replica_address=Address('192.168.1.20', 5970))
+    return {
+        'discovery_req': Message(message='192.168.1.20:5970', type=MessageType.DISCOVERY_REQ,
+                                 host='192.168.1.20', port=3000),
+        'election_req': Message(message=node.id, type=MessageType.ELECTION_REQ,
+                                host='192.168.1.20', port=3000),
+        'ping_req': Message(message=node.id, type=MessageType.PING_REQ,
+                            host='192.168.1.20', port=3000),
+        'ping_res': Message(message='', type=MessageType.PING_RES,
+                            host='192.168.1.20', port=5970),
+    }
+
+
+def _ns_per_op(function, number):
+    return round(min(timeit.repeat(function, number=number, repeat=5)) / number * 1e9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    results = []
+    for name, message in _messages().items():
+        legacy = str.encode(MessageEncoder().encode(message))
+        binary = wire.encode(message)
+        results.append({
+            'message': name,
+            'json_bytes': len(legacy),
+            'binary_bytes': len(binary),
+            'json_encode_ns': _ns_per_op(lambda: str.encode(MessageEncoder().encode(message)), args.number),
+            'binary_encode_ns': _ns_per_op(lambda: wire.encode(message), args.number),
+            'json_decode_ns': _ns_per_op(lambda: wire.loads(legacy), args.number),
+            'binary_decode_ns': _ns_per_op(lambda: wire.loads(binary), args.number),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
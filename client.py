@@ -1,14 +1,73 @@
-import json
-import multiprocessing
+import collections
+import errno
+import heapq
+import itertools
+import os
+import selectors
 import socket
+import sys
 import time
+from dotenv import load_dotenv
 
+from lib.address import Address
+from lib.discovery import Discovery, read_find_response, send_find_request
+from lib.framing import FrameDecoder, encode_message
 from lib.logger import Logger
-from lib.message import ChatMessage
+from lib.message import ChatMessage, ChatMessageType
 
 
+# Callbacks due at a time, run by Client.poll after the selector events.
+# Clients that share a selector share these too, see loadgen.py
+class Timers():
+    def __init__(self):
+        self._heap = []
+        self._count = itertools.count()
+
+    def add(self, delay, callback):
+        timer = [time.monotonic() + delay, next(self._count), callback]
+        heapq.heappush(self._heap, timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        timer[2] = None
+
+    def timeout(self, timeout=None):
+        # Most seconds to wait for the selector to run the next timer in time
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return timeout
+        due = max(0, self._heap[0][0] - time.monotonic())
+        return due if timeout is None else min(timeout, due)
+
+    def run(self):
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            callback = heapq.heappop(self._heap)[2]
+            if callback is not None:
+                callback()
+
+
+# Chat client on one selector loop: reads whole frames from the server,
+# sends the queued messages in batches whenever the socket can take them,
+# and reads the console when it is readable. When the server goes away it
+# finds the others by discovery and reconnects, the leader first, without
+# losing the messages that were not sent yet. Discovery and the connection
+# attempts run on the loop too, poll raises ConnectionError when no server
+# took the client within reconnect_timeout.
+#
+# A client in a room joins it on every connection and holds its messages
+# until the server confirms. A server that does not serve the room sends it
+# to the one that does, see lib/rooms.py.
 class Client():
-    def __init__(self, host, port, nickname):
+    # Seconds to wait for a TCP connection to a server
+    CONNECT_TIMEOUT = 1
+    # Most bytes handed to one send
+    SEND_BATCH = 65536
+
+    def __init__(self, host, port, nickname, broadcast_ip=None, broadcast_port=None,
+                 selector=None, room=None, timers=None):
         self.uuid = None
 
         self._host = host
@@ -17,75 +76,349 @@ class Client():
         self._receive_msg = []
 
         self._sock = None
+        # Clients can share one selector, see loadgen.py
+        self._selector = selector or selectors.DefaultSelector()
+        self._timers = timers or Timers()
+        # The pending timer of the client, one step of a reconnect at a time
+        self._timer = None
+        # Discovery socket, and socket and address of a connection attempt
+        self._finding = None
+        self._connecting = None
+        # Servers still to try, and the one that was lost
+        self._candidates = collections.deque()
+        self._lost = None
+        # Monotonic time to give up reconnecting at, None when connected
+        self._give_up_at = None
+        self._retry_delay = 0
+        self._decoder = FrameDecoder()
+        # Frames not completely sent, the first one _sent bytes in
+        self._outgoing = collections.deque()
+        self._sent = 0
+        # Messages held until the room is joined
+        self._held = collections.deque()
+        self._join_frame = None
+        self._running = False
         self._logger = Logger()
 
-    def _createSocket(self):
-        address = (self._host, self._port)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(address)
-        print('Finding connection, {}:{}...'.format(self._host, self._port))
-        return sock
+        self.broadcast_ip = broadcast_ip
+        self.broadcast_port = broadcast_port
+        # Most seconds between two attempts to find a server
+        self.reconnect_delay = float(os.getenv('CLIENT_RECONNECT_DELAY') or 5)
+        # Most seconds to find a server before giving up
+        self.reconnect_timeout = float(os.getenv('CLIENT_RECONNECT_TIMEOUT') or 30)
+        self.reconnects = 0
+        self.room = room
+        self.joined = False
+        self.redirects = 0
+        # Redirects since the room was last joined
+        self._redirects_in_row = 0
+        # Called with every ChatMessage received and every new connection
+        self.on_message = self._print_message
+        self.on_connect = lambda address: None
+
+    @property
+    def address(self):
+        return Address(self._host, self._port)
+
+    def connect(self):
+        # Connects to the given server, or any other one discovery finds.
+        # Raises ConnectionError when there is none
+        if self._open(self.address):
+            return
+        self.reconnect()
+        while self._sock is None:
+            self.poll()
+
+    def _open(self, address):
+        try:
+            sock = socket.create_connection(tuple(address), timeout=self.CONNECT_TIMEOUT)
+        except OSError as e:
+            self._logger.log_error('Cannot connect to {}: {}'.format(address, e))
+            return False
+        sock.setblocking(False)
+        self._setup(sock, address)
+        return True
+
+    def _setup(self, sock, address):
+        print('Finding connection, {}:{}...'.format(address.host, address.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = sock
+        self._host, self._port = address
+        self._decoder = FrameDecoder()
+        # A frame cut off by the old connection is sent again from its start
+        self._sent = 0
+        if self.room is not None:
+            # Join first, what was not sent waits for the join
+            self._held.extendleft(reversed([frame for frame in self._outgoing
+                                            if frame is not self._join_frame]))
+            self._join_frame = encode_message(ChatMessage(
+                self._nickname, '', type=ChatMessageType.JOIN, room=self.room))
+            self._outgoing = collections.deque([self._join_frame])
+            self.joined = False
+        self._selector.register(sock, self._events(), self._on_socket)
+        self.on_connect(address)
+
+    def _events(self):
+        return selectors.EVENT_READ | (selectors.EVENT_WRITE if self._outgoing else 0)
+
+    def _close(self):
+        # Closes the connection and stops reconnecting
+        if self._sock is not None:
+            self._selector.unregister(self._sock)
+            self._sock.close()
+            self._sock = None
+        self._cancel_timer()
+        self._stop_finding()
+        self._stop_connecting()
+        self._give_up_at = None
+
+    def _set_timer(self, delay, callback):
+        self._cancel_timer()
+        self._timer = self._timers.add(delay, callback)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            Timers.cancel(self._timer)
+            self._timer = None
+
+    def reconnect(self):
+        # Finds another server, the lost one is only tried after the others
+        self._lost = self.address
+        self._close()
+        self._give_up_at = time.monotonic() + self.reconnect_timeout
+        self._retry_delay = 0.1
+        self._find()
+
+    def _find(self):
+        try:
+            self._finding = send_find_request(self.broadcast_ip, self.broadcast_port)
+        except OSError as e:
+            self._logger.log_error('Cannot find servers: {}'.format(e))
+            self._try([self._lost])
+            return
+        self._selector.register(self._finding, selectors.EVENT_READ, self._on_found)
+        self._set_timer(Discovery.DISCOVERY_WAIT, lambda: self._try([self._lost]))
+
+    def _on_found(self, mask):
+        servers = read_find_response(self._finding)
+        if servers is not None:
+            self._try([address for address in servers if address != self._lost] + [self._lost])
+
+    def _stop_finding(self):
+        if self._finding is not None:
+            self._selector.unregister(self._finding)
+            self._finding.close()
+            self._finding = None
+
+    def _try(self, candidates):
+        # Connects to the first of the candidates that takes the connection
+        self._stop_finding()
+        self._candidates = collections.deque(candidates)
+        self._next_candidate()
 
-    def _handleMessage(self):
+    def _next_candidate(self):
+        self._cancel_timer()
+        self._stop_connecting()
+        while self._candidates:
+            address = self._candidates.popleft()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            error = sock.connect_ex(tuple(address))
+            if error not in (0, errno.EINPROGRESS):
+                self._logger.log_error('Cannot connect to {}: {}'.format(
+                    address, os.strerror(error)))
+                sock.close()
+                continue
+            self._connecting = (sock, address)
+            self._selector.register(sock, selectors.EVENT_WRITE, self._on_connected)
+            self._set_timer(self.CONNECT_TIMEOUT, self._next_candidate)
+            return
+        self._retry()
+
+    def _stop_connecting(self):
+        if self._connecting is not None:
+            sock = self._connecting[0]
+            self._selector.unregister(sock)
+            sock.close()
+            self._connecting = None
+
+    def _on_connected(self, mask):
+        sock, address = self._connecting
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._logger.log_error('Cannot connect to {}: {}'.format(
+                address, os.strerror(error)))
+            self._next_candidate()
+            return
+        self._selector.unregister(sock)
+        self._connecting = None
+        self._cancel_timer()
+        if self._give_up_at is not None:
+            self._give_up_at = None
+            self.reconnects += 1
+            self._logger.log_sys('Connected to {}'.format(address))
+        self._setup(sock, address)
+
+    def _retry(self):
+        # No candidate took the connection: find the servers again after a
+        # delay, or give up
+        if self._give_up_at is None:
+            self.reconnect()  # The server a redirect named is gone
+            return
+        delay = self._retry_delay
+        if time.monotonic() + delay >= self._give_up_at:
+            self._give_up_at = None
+            raise ConnectionError('No server found in {:.0f}s'.format(self.reconnect_timeout))
+        self._logger.log_error('No server found, retrying in {:.1f}s'.format(delay))
+        self._set_timer(delay, self._find)
+        self._retry_delay = min(delay * 2, self.reconnect_delay)
+
+    # ________sending_________________
+
+    def send_message(self, message):
+        req = ChatMessage(sender=self._nickname, message=message, room=self.room)
+        self.send(encode_message(req))
+
+    def send(self, frame):
+        # Queues an encoded frame, sent with the others on the next poll
+        if self.room is not None and not self.joined:
+            self._held.append(frame)
+            return
+        if not self._outgoing and self._sock is not None:
+            self._selector.modify(self._sock, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                  self._on_socket)
+        self._outgoing.append(frame)
+
+    def _flush(self):
+        while self._outgoing:
+            batch = bytearray(memoryview(self._outgoing[0])[self._sent:])
+            for frame in itertools.islice(self._outgoing, 1, None):
+                if len(batch) + len(frame) > self.SEND_BATCH:
+                    break
+                batch += frame
+            sent = self._sock.send(batch)
+            # Drop the frames sent completely, remember how far the next is
+            done = self._sent + sent
+            while self._outgoing and done >= len(self._outgoing[0]):
+                done -= len(self._outgoing.popleft())
+            self._sent = done
+            if sent < len(batch):
+                return  # The socket is full, wait until it is writable
+        self._selector.modify(self._sock, selectors.EVENT_READ, self._on_socket)
+
+    # ________receiving_________________
+
+    def _on_socket(self, mask):
+        try:
+            if mask & selectors.EVENT_READ:
+                if self._decoder.recv_into(self._sock) == 0:
+                    raise ConnectionResetError('Server closed the connection')
+                for message in self._decoder.messages():
+                    if not self._receive(message):
+                        break  # Redirected to another server
+            if mask & selectors.EVENT_WRITE and self._sock is not None:
+                self._flush()
+        except BlockingIOError:
+            pass
+        except (ConnectionError, OSError) as e:
+            self._logger.log_error('Lost the server {}: {}'.format(self.address, e))
+            self.reconnect()
+        except (ValueError, KeyError) as e:
+            # Oversized frame or malformed message, the stream is lost
+            self._logger.log_error('Dropped the server {}: {}'.format(self.address, e))
+            self.reconnect()
+
+    def _receive(self, message):
+        # False when the client moved to another server
+        if message.type == ChatMessageType.REDIRECT:
+            self._redirect(Address.from_string(message.message))
+            return False
+        if message.type == ChatMessageType.JOIN:
+            self._on_join()
+        elif self.room is None or message.room in (None, self.room):
+            # A message of the old room can cross the join of a new one
+            self.on_message(message)
+        return True
+
+    def _on_join(self):
+        self.joined = True
+        self._redirects_in_row = 0
+        while self._held:
+            self.send(self._held.popleft())
+
+    def _redirect(self, address):
+        self._logger.log_sys('Room {} is served by {}'.format(self.room, address))
+        self._close()
+        self.redirects += 1
+        self._redirects_in_row += 1
+        delay = 0
+        if self._redirects_in_row > 1:
+            # The servers disagree about the room until they all saw the
+            # last membership change
+            delay = min(0.1 * 2 ** self._redirects_in_row, self.reconnect_delay)
+        self._set_timer(delay, lambda: self._try([address]))
+
+    def _print_message(self, message):
         ''' Receiving message from the node server'''
-        while True:
-            data = ''
-            data = self._sock.recv(1024).decode()
-            '''Printing sms received from the server '''
-            time.sleep(0.001)
-            if data:
-                message = json.loads(data)
-                print("\033[A                             \033[A")
-                self._logger.log_client_message(
-                    "{}: {}".format(message['sender'],
-                                    message['message']))
-                print("Enter message: \n")
+        print("\033[A                             \033[A")
+        self._logger.log_client_message(
+            "{}: {}".format(message.sender, message.message))
+        print("Enter message: \n")
+
+    def _on_input(self, mask):
+        message = sys.stdin.readline()
+        if not message:
+            self.shutdown()
+            return
+        message = message.rstrip('\n')
+        self._logger.log_sys('Sending message: {}'.format(message))
+        self.send_message(message)
+
+    # ________loop_________________
+
+    def poll(self, timeout=None):
+        # Raises ConnectionError when the client gave up finding a server
+        for key, mask in self._selector.select(self._timers.timeout(timeout)):
+            key.data(mask)
+        self._timers.run()
 
     def run(self):
-        # Run chat room
-        self._sock = self._createSocket()
-
-        # First message
-        # message = '{} has entered the chat'.format(self._nickname)
-        # self.send_message(message)
-
-        if self._sock:
-            recv_io = multiprocessing.Process(target=self._handleMessage)
-            recv_io.daemon = True
-            recv_io.start()
-            while True:
-                try:
-                    message = input("Enter message: \n")
-                    req = ChatMessage(sender=self._nickname,
-                                      message=message).toJSON()
-                    self._logger.log_sys('Sending message: {}'.format(message))
-                    self._sock.send(str.encode(req))
-                except KeyboardInterrupt:
-                    self.shutdown()
-                    break
-                except Exception as e:
-                    self._logger.log_error(
-                        'Error sending message: {}'.format(e))
-                    self.shutdown()
-                    break
+        # Run chat room. False when the client gave up finding a server.
+        self._running = True
+        try:
+            self.connect()
+            self._selector.register(sys.stdin, selectors.EVENT_READ, self._on_input)
+            print("Enter message: \n")
+            while self._running:
+                self.poll()
+        except KeyboardInterrupt:
+            self.shutdown()
+        except ConnectionError as e:
+            self._logger.log_error('Disconnected: {}'.format(e))
+            self.shutdown()
+            return False
+        return True
 
     def shutdown(self):
-        self._sock = None
+        self._running = False
+        self._close()
 
 
 def main():
+    load_dotenv()
     while True:
         server_ip = input('Enter server_ip: ')
         server_port = input('Enter server_port: ')
         nickname = 'client'
         nickname = input('Enter nickname: ')
+        room = input('Enter room (empty for none): ') or None
         server_port = int(server_port)
         if len(server_ip.split('.')) < 4:
             continue
         break
-    time.sleep(1)
-    client = Client(server_ip, server_port, nickname)
-    client.run()
+    client = Client(server_ip, server_port, nickname, room=room)
+    if not client.run():
+        sys.exit(1)
 
 
 if __name__ == '__main__':
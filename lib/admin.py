@@ -0,0 +1,72 @@
+import json
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from lib import metrics
+from lib.logger import Logger
+from lib.middleware import TimingMiddleware
+
+# Local HTTP admin endpoint of a server
+#
+#   /metrics        the metrics in the Prometheus text format
+#   /metrics.json   the metrics as JSON
+#   /traces         the spans of the sampled traces, by trace id
+#   /health         'ok' while the server runs
+
+
+class AdminApp():
+    def __init__(self, registry, spans=None):
+        self.registry = registry
+        self.spans = spans
+        self.routes = {
+            '/metrics': self.prometheus,
+            '/metrics.json': self.json,
+            '/health': self.health,
+        }
+        if spans is not None:
+            self.routes['/traces'] = self.traces
+
+    def __call__(self, environ, start_response):
+        route = self.routes.get(environ.get('PATH_INFO') or '/')
+        if route is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not found\n']
+        if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Content-Type', 'text/plain'),
+                                                      ('Allow', 'GET, HEAD')])
+            return [b'Method not allowed\n']
+        content_type, body = route()
+        start_response('200 OK', [('Content-Type', content_type),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    def prometheus(self):
+        return 'text/plain; version=0.0.4', metrics.prometheus(self.registry).encode()
+
+    def json(self):
+        return 'application/json', json.dumps(self.registry.collect()).encode()
+
+    def traces(self):
+        return 'application/json', json.dumps(self.spans.traces()).encode()
+
+    def health(self):
+        return 'text/plain', b'ok\n'
+
+
+def make_app(registry, spans=None):
+    return TimingMiddleware(AdminApp(registry, spans), registry)
+
+
+class _RequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        # Instead of a line on stderr per request
+        Logger().debug('sys', 'Admin {} {}', self.address_string(), format % args)
+
+
+def create_admin_server(host, port, registry, spans=None):
+    # Takes the next port while the port is in use, like the chat server
+    while True:
+        try:
+            return make_server(host, port, make_app(registry, spans), server_class=WSGIServer,
+                               handler_class=_RequestHandler)
+        except OSError:
+            port += 1
@@ -0,0 +1,298 @@
+import asyncio
+import os
+import time
+
+from lib import metrics, trace
+from lib.framing import FrameDecoder, encode_client_message, encode_message
+from lib.logger import Logger
+from lib.message import ChatMessage, ChatMessageType
+from lib.send_queue import SendQueue, config_from_env
+
+
+# Metrics of chat serving, the same in both serving modes. Registered by the
+# server before it forks, registering them again returns the same ones.
+class ChatMetrics():
+    def __init__(self, registry=None):
+        registry = registry or metrics.registry()
+        self.messages_in = registry.counter(
+            'chat_messages_in_total', 'Chat messages received from clients')
+        self.messages_out = registry.counter(
+            'chat_messages_out_total', 'Chat messages queued to clients')
+        self.fanout_seconds = registry.histogram(
+            'chat_fanout_seconds', 'Time to queue a chat message to every client')
+        self.clients = registry.gauge('chat_clients', 'Connected chat clients')
+        self.redirects = registry.counter(
+            'chat_redirects_total', 'Clients sent to the server of their room')
+        # Outbound queues of the clients, see lib/send_queue.py. In process
+        # mode the socket buffer of a client is its queue.
+        self.queued_bytes = registry.gauge(
+            'chat_send_queue_bytes', 'Bytes queued to clients and not sent yet')
+        self.slow_clients = registry.gauge(
+            'chat_slow_clients', 'Clients with more than the low watermark queued')
+        self.bytes_sent = registry.counter('chat_bytes_sent_total', 'Bytes written to clients')
+        self.dropped = registry.counter(
+            'chat_send_dropped_total', 'Chat messages dropped for slow clients')
+        self.evictions = registry.counter(
+            'chat_evictions_total', 'Slow clients disconnected')
+
+
+# One connected chat client. Bytes are received straight into the frame
+# decoder's buffer and every whole frame is handed to the server. Outgoing
+# frames go through a bounded SendQueue that is drained in coalesced writes
+# whenever the transport can take more.
+class ChatConnection(asyncio.BufferedProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.address = None
+        self.decoder = FrameDecoder()
+        self.queue = SendQueue(**server.send_queue_config)
+        self._flush_scheduled = False
+        self._writing_paused = False
+        # Senders paused because this connection's queue is over the limit
+        self._paused_senders = set()
+        self._pause_count = 0
+        # Room of the client, None until it joins one
+        self.room = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        # Keep the transport buffer small so the bound of the queue holds
+        transport.set_write_buffer_limits(high=self.queue.max_write)
+        self.server._logger.debug('client', 'Connected by {}:{}', self.address[0], self.address[1])
+        self.server._clients.add(self)
+        self.server._rooms.setdefault(None, set()).add(self)
+        self.server.metrics.clients.inc()
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.decoder.advance(nbytes)
+        try:
+            for message in self.decoder.messages():
+                self.server.handle_client_message(message, self)
+        except (ValueError, KeyError) as e:
+            self.server._logger.log_error('Client {}:{} dropped: {}'.format(
+                self.address[0], self.address[1], e))
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.server._clients.discard(self)
+        self.server._leave(self)
+        self.server.metrics.clients.dec()
+        self._resume_senders()
+        self.server._logger.debug('client', 'Client disconnected')
+
+    def send(self, data, sender=None):
+        dropped = self.queue.dropped
+        queued = self.queue.push(data)
+        if self.queue.dropped != dropped:
+            self.server.metrics.dropped.inc(self.queue.dropped - dropped)
+        if not queued:
+            if self.queue.evicted and not self.transport.is_closing():
+                self.server.metrics.evictions.inc()
+                self.server._logger.log_error('Evicting slow client {}:{}'.format(
+                    self.address[0], self.address[1]))
+                self.transport.abort()
+            return
+        if self.queue.paused and sender is not None and sender not in self._paused_senders:
+            self._paused_senders.add(sender)
+            sender.pause_reading()
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled and not self._writing_paused:
+            # Flush once per loop iteration so a burst becomes one write
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        while len(self.queue) and not self._writing_paused and not self.transport.is_closing():
+            batch = self.queue.pop_batch()
+            self.transport.write(batch)
+            self.queue.sent(len(batch))
+            self.server.metrics.bytes_sent.inc(len(batch))
+        if not self.queue.paused:
+            self._resume_senders()
+
+    # Transport flow control
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._schedule_flush()
+
+    # Sender flow control, used by the PAUSE overflow policy
+    def pause_reading(self):
+        self._pause_count += 1
+        if self._pause_count == 1 and not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        self._pause_count -= 1
+        if self._pause_count == 0 and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def _resume_senders(self):
+        senders, self._paused_senders = self._paused_senders, set()
+        for sender in senders:
+            sender.resume_reading()
+
+
+# Single process chat serving engine. Accepts, reads, decodes and fans out the
+# messages of every connected client on one asyncio event loop instead of
+# forking a process per client.
+#
+# Messages fan out to the clients in the room of the sender. With a
+# RoomDirectory a client joining a room of another server is redirected to
+# it, and after a membership change the clients of the rooms that moved are
+# redirected to their new server, see lib/rooms.py.
+class AsyncChatServer():
+    def __init__(self, server_socket, on_message=None, send_queue_config=None, rooms=None):
+        self._logger = Logger()
+        self.server_socket = server_socket
+        # Called with (message, address) for every decoded client message
+        self.on_message = on_message
+        self.send_queue_config = send_queue_config or config_from_env()
+        # Every connected client, shared by all connections
+        self._clients = set()
+        # Room -> its clients, the ones that joined none under None
+        self._rooms = {}
+        self.rooms = rooms
+        # Seconds between checks for rooms that moved to another server
+        self.room_check_interval = float(os.getenv('ROOM_CHECK_INTERVAL') or 1)
+        self._checked_ring = None
+        # Seconds between samples of the queue depth gauges
+        self.sample_interval = 1
+        self.metrics = ChatMetrics()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.server_socket.setblocking(False)
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: ChatConnection(self), sock=self.server_socket)
+        tasks = [loop.create_task(self._sample_queues())]
+        if self.rooms is not None:
+            tasks.append(loop.create_task(self._watch_rooms()))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def handle_client_message(self, message, connection):
+        if message.type != ChatMessageType.MESSAGE:
+            self.handle_room_message(message, connection)
+            return
+        # Fans out in the room the client joined, whatever it claims
+        message.room = connection.room
+        self.metrics.messages_in.inc()
+        # Traces are sampled here, a trace the client sent is dropped
+        message.trace = trace.start()
+        if message.trace is not None:
+            message.trace.hop('recv')
+        if self.on_message is not None:
+            self.on_message(message, connection.address)
+        self.broadcast_client_message(message, connection)
+
+    def broadcast_client_message(self, message, sender=None):
+        # Encode once, then queue the same frame for every client
+        started = time.perf_counter()
+        data = encode_client_message(message)
+        sent = 0
+        room = self._rooms.get(message.room, ())
+        for connection in list(room):
+            if connection.transport.is_closing():
+                self._clients.discard(connection)
+                room.discard(connection)
+                continue
+            connection.send(data, sender)
+            sent += 1
+        self.metrics.messages_out.inc(sent)
+        self.metrics.fanout_seconds.observe(time.perf_counter() - started)
+        if message.trace is not None:
+            message.trace.hop('fanout to {}'.format(sent))
+
+    # ________rooms_________________
+
+    def handle_room_message(self, message, connection):
+        if message.type == ChatMessageType.JOIN:
+            self.join(connection, message.room)
+        elif message.type == ChatMessageType.LEAVE:
+            self._move(connection, None)
+        else:
+            raise ValueError('Unexpected {} from a client'.format(message.type))
+
+    def join(self, connection, room):
+        # Joins the client to the room when it is served here, else sends
+        # the client to the server of the room
+        if room is not None and self.rooms is not None:
+            owner = self.rooms.owner(room)
+            if owner != self.rooms.address:
+                self.redirect(connection, room, owner)
+                return
+        self._move(connection, room)
+        connection.send(encode_message(ChatMessage('', '', type=ChatMessageType.JOIN, room=room)))
+
+    def redirect(self, connection, room, owner):
+        self._logger.debug('client', 'Room {} of {}:{} is on {}', room,
+                           connection.address[0], connection.address[1], owner)
+        self.metrics.redirects.inc()
+        # The client closes the connection, it stays in its room until then
+        connection.send(encode_message(ChatMessage(
+            '', str(owner), type=ChatMessageType.REDIRECT, room=room)))
+
+    def _move(self, connection, room):
+        self._leave(connection)
+        connection.room = room
+        self._rooms.setdefault(room, set()).add(connection)
+
+    def _leave(self, connection):
+        room = self._rooms.get(connection.room)
+        if room is not None:
+            room.discard(connection)
+            if not room and connection.room is not None:
+                del self._rooms[connection.room]
+
+    def check_rooms(self):
+        # After a membership change, redirects the clients of the rooms that
+        # moved to another server. Only about 1/N of the rooms move.
+        ring = self.rooms.ring()
+        if ring is self._checked_ring:
+            return
+        self._checked_ring = ring
+        for room, connections in list(self._rooms.items()):
+            if room is None:
+                continue
+            owner = self.rooms.owner(room)
+            if owner != self.rooms.address:
+                for connection in list(connections):
+                    self.redirect(connection, room, owner)
+
+    async def _watch_rooms(self):
+        while True:
+            await asyncio.sleep(self.room_check_interval)
+            self.check_rooms()
+
+    def client_count(self):
+        return len(self._clients)
+
+    def sample_queues(self):
+        # Sets the queue depth gauges, the only process that sets them
+        queues = [connection.queue for connection in self._clients]
+        self.metrics.queued_bytes.set(sum(queue.nbytes for queue in queues))
+        self.metrics.slow_clients.set(
+            sum(1 for queue in queues if queue.nbytes > queue.low_watermark))
+
+    async def _sample_queues(self):
+        while True:
+            await asyncio.sleep(self.sample_interval)
+            self.sample_queues()
@@ -0,0 +1,152 @@
+import collections
+import os
+import time
+
+from lib.clock import VectorClock
+
+# Messages wait for the ones they depend on for at most CAUSAL_TIMEOUT
+# seconds, and while fewer than CAUSAL_MAX_HELD wait. Past either the first
+# missing message is given up as lost, and those that waited for it are
+# delivered without it ('deliver') or discarded ('drop').
+POLICIES = ('deliver', 'drop')
+
+
+class _Held():
+    __slots__ = ('entries', 'message', 'arrived', 'missing')
+
+    def __init__(self, entries, message, arrived):
+        self.entries = entries
+        self.message = message
+        self.arrived = arrived
+        self.missing = None  # the (slot, counter) it waits for
+
+
+# Causal delivery of the chat messages the leader receives. A message of
+# sender j with clock V is delivered once the message before it from j was,
+# V[j] == delivered[j] + 1, and every message it depends on as well,
+# V[k] <= delivered[k]. Until then it is held back, indexed by the one
+# (slot, counter) it waits for, so a delivery only looks at the messages it
+# unblocks.
+#
+# Clocks come as the entries of VectorClock.encode_delta, the sender's own
+# entry first. Entries missing from a delta did not change since the
+# sender's previous message, which is delivered first, so they are met.
+# After a leader change the new leader has not seen the earlier messages of
+# the senders, their first messages wait for the timeout.
+class CausalQueue():
+    def __init__(self, clock: VectorClock, deliver, max_held=None, timeout=None, policy=None):
+        # Counters of the delivered messages by sender slot
+        self.delivered = clock
+        self.deliver = deliver
+        self.max_held = int(max_held or os.getenv('CAUSAL_MAX_HELD') or 10000)
+        self.timeout = float(timeout or os.getenv('CAUSAL_TIMEOUT') or 1)
+        self.policy = (policy or os.getenv('CAUSAL_POLICY') or 'deliver').lower()
+        if self.policy not in POLICIES:
+            raise ValueError('Unknown causal policy {}'.format(self.policy))
+        # (slot, counter) -> messages waiting for it
+        self._waiting = collections.defaultdict(list)
+        # (sender slot, counter) -> _Held, in order of arrival
+        self._held = collections.OrderedDict()
+        self.counts = collections.Counter()
+
+    def __len__(self):
+        return len(self._held)
+
+    def _now(self):
+        return time.monotonic()
+
+    def push(self, entries, message, now=None):
+        # entries: [(slot, counter)] of the message's clock, the sender's first
+        now = self._now() if now is None else now
+        sender, counter = entries[0]
+        delivered = self._counter(sender)
+        if counter == 1 and delivered >= 1:
+            # The sender restarted
+            self._set(sender, 0)
+        elif counter <= delivered or entries[0] in self._held:
+            self.counts['duplicate'] += 1
+            return
+        held = self._held[entries[0]] = _Held(entries, message, now)
+        self._try([held])
+        self.expire(now)
+
+    def expire(self, now=None):
+        # Gives up on missing messages once the oldest held one waited too
+        # long, or too many are held. Runs on every arrival.
+        now = self._now() if now is None else now
+        while self._held:
+            held = next(iter(self._held.values()))
+            if len(self._held) <= self.max_held and now - held.arrived < self.timeout:
+                return
+            self.counts['lost'] += 1
+            waiting = self._advance(*self._lost(held))
+            if self.policy == 'drop':
+                released = []
+                for held in waiting:
+                    del self._held[held.entries[0]]
+                    self.counts['dropped'] += 1
+                    released.extend(self._advance(*held.entries[0]))
+                waiting = released
+            self._try(waiting)
+
+    def stats(self):
+        return dict(self.counts, held=len(self._held), waiting=len(self._waiting))
+
+    def _counter(self, slot):
+        counters = self.delivered.counters
+        return counters[slot] if slot < len(counters) else 0
+
+    def _set(self, slot, counter):
+        self.delivered._grow(slot + 1)
+        self.delivered.counters[slot] = counter
+
+    def _missing(self, held):
+        # The (slot, counter) the message waits for, None when deliverable
+        sender, counter = held.entries[0]
+        if self._counter(sender) != counter - 1:
+            return sender, counter - 1
+        for slot, counter in held.entries[1:]:
+            if self._counter(slot) < counter:
+                return slot, counter
+        return None
+
+    def _lost(self, held):
+        # (slot, counter) of the messages held waits for that never arrived,
+        # from the first one on up to the next that did or the one it needs.
+        # Follows the messages in between that arrived and wait themselves.
+        for _ in range(len(self._held)):
+            slot, needed = held.missing
+            first = self._counter(slot) + 1
+            if (slot, first) in self._held:
+                held = self._held[slot, first]
+                continue
+            last = first
+            while last < needed and (slot, last + 1) not in self._held:
+                last += 1
+            return slot, last
+        raise RuntimeError('Cyclic dependencies of held messages')
+
+    def _try(self, pending):
+        # Delivers the messages that can be, and every message they unblock
+        while pending:
+            held = pending.pop()
+            held.missing = self._missing(held)
+            if held.missing is not None:
+                self._waiting[held.missing].append(held)
+                continue
+            del self._held[held.entries[0]]
+            pending.extend(self._advance(*held.entries[0]))
+            self.deliver(held.message)
+            self.counts['delivered'] += 1
+
+    def _advance(self, slot, counter):
+        # Counts the messages of slot up to counter as delivered, returns
+        # those waiting for them
+        current = self._counter(slot)
+        if counter <= current:
+            return []
+        self._set(slot, counter)
+        released = []
+        for step in range(current + 1, counter + 1):
+            released.extend(self._waiting.pop((slot, step), ()))
+        return released
@@ -0,0 +1,199 @@
+from concurrent.futures import Future
+import itertools
+import os
+import socket
+import threading
+import time
+
+from lib import metrics, trace, wire
+from lib.address import Address
+from lib.logger import Logger
+from lib.message import Message, MessageType
+
+
+# Round trip time estimate of one peer, used for its request timeout
+# (RFC 6298: srtt + 4 * rttvar, doubled after every timeout).
+class RttEstimator():
+    def __init__(self, initial_timeout, min_timeout, max_timeout):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = initial_timeout
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(self.max_timeout,
+                           max(self.min_timeout, self.srtt + 4 * self.rttvar))
+
+    def backoff(self):
+        self.timeout = min(self.max_timeout, self.timeout * 2)
+
+
+class _Request():
+    def __init__(self, future, address, sent_at, deadline):
+        self.future = future
+        self.address = address
+        self.sent_at = sent_at
+        self.deadline = deadline
+
+
+# Long lived request/response channel to the other replicas. Every request is
+# tagged with a correlation id and returns a Future that a background
+# receiver thread resolves with the matching response, or fails with
+# TimeoutError after the adaptive timeout of the peer. Any number of requests
+# can be in flight at once.
+#
+# The socket and the receiver thread are opened lazily in each process, so a
+# channel created before the server forks can be used by all its processes.
+class ReplicaChannel():
+    def __init__(self, host='', min_timeout=None, max_timeout=None):
+        self._logger = Logger()
+        self.host = host
+        self.min_timeout = float(
+            min_timeout or os.getenv('REPLICA_MIN_TIMEOUT') or 0.2)
+        self.max_timeout = float(
+            max_timeout or os.getenv('REPLICA_TIMEOUT') or 5)
+        self._pid = None
+        registry = metrics.registry()
+        self._requests = registry.counter('replica_requests_total', 'Replica requests sent')
+        self._timeouts = registry.counter(
+            'replica_timeouts_total', 'Replica requests without a response in time')
+        self._rtt_seconds = registry.histogram(
+            'replica_rtt_seconds', 'Round trip time of answered replica requests')
+
+    def _ensure_open(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._rtt = {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((self.host, 0))
+        self.sock.settimeout(self.min_timeout / 2)
+        self._receiver = threading.Thread(
+            target=self._receive_loop, daemon=True)
+        self._receiver.start()
+
+    def _estimator(self, address):
+        estimator = self._rtt.get(address)
+        if estimator is None:
+            estimator = RttEstimator(
+                self.max_timeout, self.min_timeout, self.max_timeout)
+            self._rtt[address] = estimator
+        return estimator
+
+    def timeout_for(self, address):
+        self._ensure_open()
+        return self._estimator(Address(*address)).timeout
+
+    def request(self, message: Message, address) -> Future:
+        self._ensure_open()
+        _attach_trace(message)
+        address = Address(*address)
+        future = Future()
+        with self._lock:
+            message.correlation_id = next(self._ids) & 0xFFFFFFFF
+            now = time.monotonic()
+            deadline = now + self._estimator(address).timeout
+            self._pending[message.correlation_id] = _Request(
+                future, address, now, deadline)
+        self.sock.sendto(wire.dumps(message), (address.host, address.port))
+        self._requests.inc()
+        return future
+
+    def send(self, message: Message, address):
+        # One way message, no response expected
+        self._ensure_open()
+        _attach_trace(message)
+        self.sock.sendto(wire.dumps(message), (address[0], address[1]))
+
+    def _receive_loop(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except socket.timeout:
+                data = None
+            except OSError:
+                break
+            if data is not None:
+                # A bad reply must not stop the receiver, the requests
+                # would never resolve or time out
+                try:
+                    self._on_response(data, Address(*address))
+                except Exception as e:
+                    self._logger.log_error(
+                        'Dropped bad replica reply from {}: {}'.format(address, e))
+            self._expire()
+
+    def _on_response(self, data, address):
+        response = _decode_response(data)
+        correlation_id = getattr(response, 'correlation_id', None)
+        with self._lock:
+            if correlation_id is not None:
+                request = self._pending.pop(correlation_id, None)
+            else:
+                # Legacy peers do not echo the id, take the oldest request
+                # sent to that address
+                request = None
+                for cid, pending in self._pending.items():
+                    if pending.address == address:
+                        request = self._pending.pop(cid)
+                        break
+            if request is None or request.future.cancelled():
+                return
+            rtt = time.monotonic() - request.sent_at
+            self._estimator(request.address).sample(rtt)
+        self._rtt_seconds.observe(rtt)
+        request.future.set_result(response)
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for cid, request in list(self._pending.items()):
+                if request.deadline <= now:
+                    expired.append(self._pending.pop(cid))
+                    self._estimator(request.address).backoff()
+        for request in expired:
+            if request.future.cancelled():
+                continue
+            self._timeouts.inc()
+            self._logger.log_replica(
+                'Replica message timed out. {}'.format(request.address))
+            request.future.set_exception(TimeoutError(
+                'No response from {}'.format(request.address)))
+
+    def in_flight(self):
+        self._ensure_open()
+        return len(self._pending)
+
+    def close(self):
+        if self._pid == os.getpid():
+            self.sock.close()
+            self._pid = None
+
+
+def _decode_response(data):
+    # Replies are a Message in either wire format, or raw text from legacy
+    # peers such as the leader id or an empty acknowledgement
+    try:
+        return wire.loads(data)
+    except ValueError:
+        # Raises UnicodeDecodeError, a ValueError, on anything else
+        return bytes(data).decode("utf-8")
+
+
+def _attach_trace(message):
+    # Sent while handling a traced message, the trace goes along
+    current = trace.current()
+    if current is not None and message.trace is None:
+        message.trace = current.copy()
+        message.trace.hop('send {}'.format(MessageType(message.type).name))
@@ -1,18 +1,125 @@
+from array import array
+import hashlib
+import operator
+
+try:
+    import numpy
+except ImportError:  # Optional, speeds up comparing many clocks at once
+    numpy = None
+
+
+# Results of VectorClock.compare
+BEFORE = -1  # happened before the other clock
+EQUAL = 0
+AFTER = 1  # happened after the other clock
+CONCURRENT = None
+
+# Bytes of the digest that stands for a node id in delta encodings
+DIGEST_SIZE = 8
+
+
+def digest(id: str) -> bytes:
+    return hashlib.blake2b(str.encode(id), digest_size=DIGEST_SIZE).digest()
+
+
+# Dense slots for the node ids of one process. Node ids are long JSON
+# strings, so clocks store their counters in an array indexed by slot and
+# every clock of the process shares the slots. Ids learned from the wire
+# are only known by their digest.
+class ClockIndex():
+    def __init__(self):
+        self._slots = {}  # digest -> slot
+        self._by_id = {}  # id -> slot
+        self.ids = []  # slot -> id, or the digest in hex while unknown
+        self.digests = []  # slot -> digest
+
+    def __len__(self):
+        return len(self.ids)
+
+    def slot(self, id: str) -> int:
+        slot = self._by_id.get(id)
+        if slot is None:
+            slot = self.slot_of_digest(digest(id))
+            self.ids[slot] = id
+            self._by_id[id] = slot
+        return slot
+
+    def slot_of_digest(self, key: bytes) -> int:
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = len(self.ids)
+            self._slots[key] = slot
+            self.ids.append(key.hex())
+            self.digests.append(key)
+        return slot
+
+
+INDEX = ClockIndex()
+
+
 class VectorClock:
-    def __init__(self, id: str):
-        self.vcDictionary = {}
-        self.vcDictionary[id] = 0
+    def __init__(self, id: str, index: ClockIndex = None):
+        self.id = id
+        self.index = index if index is not None else INDEX
+        # Counters by slot, slots past the end are 0
+        self.counters = array('Q')
+        self._slot = self.index.slot(id)
+        self._grow(self._slot + 1)
 
-    def increment(self, id: str):
-        self.vcDictionary[id] += 1
+    def _grow(self, size):
+        if len(self.counters) < size:
+            self.counters.extend([0] * (size - len(self.counters)))
+
+    def __getitem__(self, id: str) -> int:
+        slot = self.index.slot(id)
+        return self.counters[slot] if slot < len(self.counters) else 0
+
+    @property
+    def vcDictionary(self):
+        return {self.index.ids[slot]: counter for slot, counter in enumerate(self.counters)
+                if counter or slot == self._slot}
+
+    def increment(self, id: str = None):
+        slot = self._slot if id is None else self.index.slot(id)
+        self._grow(slot + 1)
+        self.counters[slot] += 1
+
+    def set(self, id: str, counter: int):
+        slot = self.index.slot(id)
+        self._grow(slot + 1)
+        self.counters[slot] = counter
 
     def merge(self, vc: 'VectorClock'):
-        for key in vc.vcDictionary:
-            if key not in self.vcDictionary:
-                self.vcDictionary[key] = vc.vcDictionary[key]
-            else:
-                self.vcDictionary[key] = max(
-                    self.vcDictionary[key], vc.vcDictionary[key])
+        other = vc.counters
+        self._grow(len(other))
+        counters = self.counters
+        if numpy is not None and len(other) >= 64:
+            mine = numpy.frombuffer(counters, dtype=numpy.uint64)[:len(other)]
+            numpy.maximum(mine, numpy.frombuffer(other, dtype=numpy.uint64), out=mine)
+            return
+        counters[:len(other)] = array('Q', [x if x > y else y for x, y in zip(counters, other)])
+
+    def compare(self, vc: 'VectorClock'):
+        # BEFORE, EQUAL, AFTER or CONCURRENT
+        a, b = self.counters, vc.counters
+        if len(a) != len(b):
+            # Slots past the end are 0
+            a, b = array('Q', a), array('Q', b)
+            a.extend([0] * (len(b) - len(a)))
+            b.extend([0] * (len(a) - len(b)))
+        less = any(map(operator.lt, a, b))
+        greater = any(map(operator.gt, a, b))
+        if less and greater:
+            return CONCURRENT
+        return BEFORE if less else AFTER if greater else EQUAL
+
+    def happens_before(self, vc: 'VectorClock') -> bool:
+        return self.compare(vc) == BEFORE
+
+    def copy(self):
+        clock = VectorClock(self.id, self.index)
+        clock.counters = array('Q', self.counters)
+        return clock
 
     def local_event(self, id: str, clock):
         self.increment(id)
@@ -21,19 +128,120 @@ class VectorClock:
         return clock
 
     def send_event(self, pipe, clock, pid):
-        self.increment(id)
+        self.increment()
         pipe.send((pid, clock))
         print("Process {} sent a message. Lamport timestamp is {}".format(
-            id, clock))
+            self.id, clock))
         return clock
 
     def receive_event(self, pipe, clock, pid):
         message, timestamp = pipe.recv()
         self.merge(timestamp)
-        self.increment(id)
+        self.increment()
         print("Process {} received a message from process {}. Lamport timestamp is {}".format(
-            id, message, clock))
+            self.id, message, clock))
         return clock
 
+    # ________delta encoding_________________
+
+    def encode_delta(self, sent=None) -> bytes:
+        # The entries that changed since the counters in sent, all of them
+        # without it, as digest (8) | counter (varint) each. The own entry
+        # is always sent, and first. Updates sent.
+        out = bytearray()
+        digests = self.index.digests
+        counters = self.counters
+        if sent is not None and len(sent) < len(counters):
+            sent.extend([0] * (len(counters) - len(sent)))
+        out += digests[self._slot]
+        _put_varint(out, counters[self._slot])
+        for slot, counter in enumerate(counters):
+            if slot == self._slot or not counter:
+                continue
+            if sent is not None:
+                if sent[slot] >= counter:
+                    continue
+                sent[slot] = counter
+            out += digests[slot]
+            _put_varint(out, counter)
+        if sent is not None:
+            sent[self._slot] = counters[self._slot]
+        return bytes(out)
+
+    def read_delta(self, data: bytes):
+        # (slot, counter) of the entries of an encode_delta, the sender's
+        # own entry first
+        entries = []
+        offset = 0
+        while offset < len(data):
+            slot = self.index.slot_of_digest(bytes(data[offset:offset + DIGEST_SIZE]))
+            counter, offset = _get_varint(data, offset + DIGEST_SIZE)
+            entries.append((slot, counter))
+        return entries
+
+    def merge_delta(self, data: bytes):
+        # Merges the entries of an encode_delta
+        self.merge_entries(self.read_delta(data))
+
+    def merge_entries(self, entries):
+        for slot, counter in entries:
+            self._grow(slot + 1)
+            if counter > self.counters[slot]:
+                self.counters[slot] = counter
+
     def __str__(self):
         return str(self.vcDictionary)
+
+
+# Deltas of one clock to each peer. Every entry is sent when it changed
+# since the last message to that peer. Datagrams can be lost, so the first
+# message to a peer and every full_every-th one after it carry the whole
+# clock instead.
+class DeltaEncoder():
+    def __init__(self, clock: VectorClock, full_every=16):
+        self.clock = clock
+        self.full_every = full_every
+        self._sent = {}  # peer -> (counters sent, messages since the full clock)
+
+    def encode(self, peer) -> bytes:
+        sent, count = self._sent.get(peer, (None, 0))
+        if sent is None or count + 1 >= self.full_every:
+            sent, count = array('Q'), -1
+        data = self.clock.encode_delta(sent)
+        self._sent[peer] = (sent, count + 1)
+        return data
+
+
+def compare_many(clock: VectorClock, clocks):
+    # clock.compare(other) for every clock of the list, with NumPy as one
+    # matrix operation when it is installed
+    if numpy is None or not clocks:
+        return [clock.compare(other) for other in clocks]
+    width = max([len(clock.counters)] + [len(other.counters) for other in clocks])
+    matrix = numpy.zeros((len(clocks), width), dtype=numpy.uint64)
+    for row, other in enumerate(clocks):
+        matrix[row, :len(other.counters)] = numpy.frombuffer(other.counters, dtype=numpy.uint64)
+    mine = numpy.zeros(width, dtype=numpy.uint64)
+    mine[:len(clock.counters)] = numpy.frombuffer(clock.counters, dtype=numpy.uint64)
+    less = (mine < matrix).any(axis=1)
+    greater = (mine > matrix).any(axis=1)
+    return [CONCURRENT if l and g else BEFORE if l else AFTER if g else EQUAL
+            for l, g in zip(less.tolist(), greater.tolist())]
+
+
+def _put_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
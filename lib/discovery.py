@@ -1,21 +1,50 @@
 import json
 from multiprocessing import Process
-import multiprocessing
 import os
+import random
+import select
 import time
 from dotenv import load_dotenv
 from lib.address import Address
-from lib.message import Message, MessageDecoder, MessageEncoder, MessageType
+from lib.message import Message, MessageType
+from lib import wire
 import socket
 
 from lib.logger import Logger
 
 
+# Discovery of the other servers.
+#
+# A new node broadcasts a DISCOVERY_REQ and collects the answers on its send
+# socket. Every listener adds the requester to its membership and schedules a
+# unicast DISCOVERY_RES after a random delay (jitter). The response carries the
+# full membership of the responder, so one answer is usually enough: as soon
+# as the first answers arrived the requester broadcasts a second request that
+# lists every node it already knows, and those nodes cancel their pending
+# reply. Repeated requests within DEDUP_WINDOW are ignored.
+#
+# Nodes that send requests without the known list (older versions) still get
+# the old broadcast response.
+#
+# Chat clients look for servers with the same request, marked as 'client'.
+# Every server answers it right away and does not add the client to its
+# membership, see find_servers.
 class Discovery():
     BROADCAST_IP = '255.255.255.255'
     BROADCAST_PORT = 5972
+    # Seconds to collect responses
+    DISCOVERY_WAIT = 1
+    # Maximum random delay of a response
+    REPLY_JITTER = 0.2
+    # Seconds a repeated request is ignored
+    DEDUP_WINDOW = 2
     def on_discovery(x): return print(x)
     def on_finish_discovery(): return print('No nodes found in the network.')
+    # Returns the Nodes this node knows about, sent with every response
+    def get_members(): return []
+    # Returns the chat Address of the leader, None while unknown
+    @staticmethod
+    def get_leader(): return None
     replica_address = None
 
     def __init__(self, host, port, broadcast_port):
@@ -24,6 +53,18 @@ class Discovery():
         self.host = host
         self.port = port
         self.BROADCAST_PORT = int(broadcast_port)
+        self.REPLY_JITTER = float(
+            os.getenv('DISCOVERY_JITTER') or self.REPLY_JITTER)
+        # requester address -> (due time, reply address)
+        self._pending_replies = {}
+        # (host, port, round) of a request -> time it was seen
+        self._seen_requests = {}
+        # Addresses learned by our own discovery
+        self._found = set()
+        self._round = 0
+        self.random = random.Random()
+        self.datagrams_sent = 0
+        self.replies_suppressed = 0
         self.setup_broadcast_socket()
 
     def set_on_message(self, on_message):
@@ -32,6 +73,12 @@ class Discovery():
     def set_replica_address(self, replica_address):
         self.replica_address = replica_address
 
+    def set_get_members(self, get_members):
+        self.get_members = get_members
+
+    def set_get_leader(self, get_leader):
+        self.get_leader = get_leader
+
     def run(self) -> None:
         self.listen()
 
@@ -52,71 +99,200 @@ class Discovery():
                 socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.recv_socket.bind(("", self.BROADCAST_PORT))
 
+    def _now(self):
+        return time.monotonic()
+
+    def _broadcast(self, data):
+        self.datagrams_sent += 1
+        self.send_socket.sendto(data, (self.BROADCAST_IP, self.BROADCAST_PORT))
+
+    def _reply(self, data, address):
+        self.datagrams_sent += 1
+        self.recv_socket.sendto(data, address)
+
+    # ________requester_________________
+
     # Will be called first time when node enter the network to collect information about other nodes and leader
     def send_discovery_message(self):
-        message = Message(message=f"{self.replica_address if self.replica_address else ''}", host=self.host, port=self.port,
+        self.start_discovery()
+        start = self._now()
+        suppress_at = None
+        while True:
+            now = self._now()
+            if suppress_at is not None and now >= suppress_at:
+                self.suppress_replies()
+                suppress_at = float('inf')
+            wait_until = min(start + self.DISCOVERY_WAIT,
+                             suppress_at or float('inf'))
+            if now >= start + self.DISCOVERY_WAIT:
+                break
+            self.send_socket.settimeout(wait_until - now)
+            try:
+                data, address = self.send_socket.recvfrom(65535)
+            except socket.timeout:
+                continue
+            try:
+                message = wire.loads(data)
+                if message.type != MessageType.DISCOVERY_RES:
+                    continue
+                self.handle_response(message)
+            except Exception as e:
+                # A bad answer must not end the discovery
+                self._logger.log_error(
+                    'Dropped malformed discovery response from {}: {}'.format(address, e))
+                continue
+            if suppress_at is None:
+                # Let the other early answers arrive, then suppress the rest
+                suppress_at = self._now() + self.REPLY_JITTER / 10
+        self.on_finish_discovery()
+
+    def start_discovery(self):
+        self._found = {(self.host, self.port)}
+        self._round = 0
+        self._broadcast_request(known=[])
+
+    def suppress_replies(self):
+        # Second request, listing every node already known. Nodes in the list
+        # cancel their pending reply, the others still answer.
+        self._round += 1
+        self._broadcast_request(
+            known=['{}:{}'.format(host, port) for host, port in self._found])
+
+    def _broadcast_request(self, known):
+        payload = json.dumps({
+            'replica': str(self.replica_address) if self.replica_address else '',
+            'round': self._round,
+            'known': known,
+        })
+        message = Message(message=payload, host=self.host, port=self.port,
                           type=MessageType.DISCOVERY_REQ)
-        message = MessageEncoder().encode(message)
         self._logger.log_broadcast(
             'Sending discovery message: {}'.format(message))
-
         # Broadcast message
-        self.send_socket.sendto(
-            str.encode(message), (self.BROADCAST_IP, self.BROADCAST_PORT))
-        time.sleep(1)
-        self.on_finish_discovery()
+        self._broadcast(wire.dumps(message))
+
+    def handle_response(self, message):
+        payload = _decode_payload(message)
+        members = [(message.host, message.port, payload['replica'])]
+        members += [(host, port, '{}:{}'.format(replica_host, replica_port))
+                    for host, port, replica_host, replica_port in payload.get('members', [])]
+        for host, port, replica in members:
+            if (host, port) in self._found:
+                continue
+            self._found.add((host, port))
+            self.on_discovery(Message(message=replica, host=host, port=port,
+                                      type=MessageType.DISCOVERY_RES))
+
+    # ________listener_________________
 
     def broadcast(self, message):
         # Broadcast the message to the network
-        self.send_socket.settimeout(1)
         try:
-            # Broadcast message
-            self.send_socket.sendto(str.encode(
-                message), (self.BROADCAST_IP, self.BROADCAST_PORT))
-            while True:
-                data, address = self.send_socket.recvfrom(1024)
-                print('Broadcasted message: {}'.format(message))
-                print(data)
-        except socket.timeout:
-            self._logger.log_broadcast(
-                'Broadcast timed out')
+            self._broadcast(message)
         except Exception as e:
             self._logger.log_broadcast(
                 'Error while broadcasting message: {}'.format(e))
 
     def listen(self):
-        # Listen for incoming messages
-        print('Listening for incoming messages from broadcast...')
-        while True:
-            data, address = self.recv_socket.recvfrom(1024)
-            print('Received data from {}'.format(address))
-            p = multiprocessing.Process(target=self.process_message,
-                                        args=(data, address))
-            p.start()
-            p.join()
+        # Listen for incoming messages, and send the scheduled replies when due
+        self._logger.log_broadcast('Listening for incoming messages from broadcast...')
+        while not self._stop_req:
+            next_due = self.send_due_replies(self._now())
+            self.recv_socket.settimeout(
+                None if next_due is None else max(0, next_due - self._now()))
+            try:
+                data, address = self.recv_socket.recvfrom(65535)
+            except socket.timeout:
+                continue
+            self.process_message(data, address)
 
     def process_message(self, data, address):
-        jsonStr = data.decode("utf-8")
-        message = json.loads(json.loads(jsonStr), cls=MessageDecoder)
+        # Handles one datagram, a bad one is dropped without stopping the
+        # listener
+        try:
+            self._process_message(wire.loads(data), address)
+        except Exception as e:
+            self._logger.log_error(
+                'Dropped malformed discovery message from {}: {}'.format(address, e))
+
+    def _process_message(self, message, address):
         if message.type == MessageType.DISCOVERY_REQ:
             if message.host != self.host or message.port != self.port:  # Ignore its own discovery request
-                self._logger.log_broadcast('Discovery request from: {} {}'.format(
-                    message.host, message.port))
-                # Reply with its own address
-                res = str(Address(host=self.replica_address.host,
-                                  port=self.replica_address.port))
-                reply = Message(host=self.host, port=self.port, message=res,
-                                type=MessageType.DISCOVERY_RES)
-                self._logger.log_broadcast(
-                    'Sending discovery response to {}'.format(address))
-                self.broadcast(MessageEncoder().encode(reply))
-                # Add new node to the network
-                self.on_discovery(message)
+                self.handle_request(message, address, self._now())
         elif message.type == MessageType.DISCOVERY_RES:
+            # Broadcast response of an older node
             self.on_discovery(message)
         elif message.type == MessageType.MESSAGE:
             self.on_message(message, address)
 
+    def handle_request(self, message, address, now):
+        payload = _decode_payload(message)
+        key = (message.host, message.port, payload.get('round', 0))
+        seen = self._seen_requests.get(key)
+        if seen is not None and now - seen < self.DEDUP_WINDOW:
+            return
+        self._seen_requests[key] = now
+        self._forget_requests(now)
+
+        if payload.get('client'):
+            self._reply(wire.dumps(self._response()), address)
+            return
+
+        self._logger.log_broadcast('Discovery request from: {} {}'.format(
+            message.host, message.port))
+        # Add new node to the network
+        self.on_discovery(Message(message=payload['replica'], host=message.host,
+                                  port=message.port, type=MessageType.DISCOVERY_REQ))
+
+        if 'known' not in payload:
+            # Older requester, it listens for broadcast responses only
+            self.broadcast(wire.dumps(self._response(legacy=True)))
+            return
+        requester = (message.host, message.port)
+        if '{}:{}'.format(self.host, self.port) in payload['known']:
+            # Another node already answered for us
+            if self._pending_replies.pop(requester, None) is not None:
+                self.replies_suppressed += 1
+            return
+        if requester not in self._pending_replies:
+            self._pending_replies[requester] = (
+                now + self.random.uniform(0, self.REPLY_JITTER), address)
+
+    def send_due_replies(self, now):
+        # Sends the replies that are due, returns when the next one is
+        next_due = None
+        for requester, (due, address) in list(self._pending_replies.items()):
+            if due <= now:
+                del self._pending_replies[requester]
+                self._logger.log_broadcast(
+                    'Sending discovery response to {}'.format(address))
+                self._reply(wire.dumps(self._response()), address)
+            elif next_due is None or due < next_due:
+                next_due = due
+        return next_due
+
+    def _response(self, legacy=False):
+        replica = str(Address(host=self.replica_address.host,
+                              port=self.replica_address.port))
+        if legacy:
+            res = replica
+        else:
+            leader = self.get_leader()
+            res = json.dumps({
+                'replica': replica,
+                'members': [[node.address.host, node.address.port,
+                             node.replica_address.host, node.replica_address.port]
+                            for node in self.get_members()],
+                'leader': [leader.host, leader.port] if leader is not None else None,
+            })
+        return Message(host=self.host, port=self.port, message=res,
+                       type=MessageType.DISCOVERY_RES)
+
+    def _forget_requests(self, now):
+        if len(self._seen_requests) > 1024:
+            self._seen_requests = {key: seen for key, seen in self._seen_requests.items()
+                                   if now - seen < self.DEDUP_WINDOW}
+
     def terminate(self):
         self._stop_req = True
         self.send_socket.close()
@@ -133,6 +309,83 @@ class Discovery():
         discovery_thread.start()
 
 
+def find_servers(broadcast_ip=None, broadcast_port=None, wait=None):
+    # Chat addresses of the servers, as told by the first server that answers
+    # a client's discovery request within wait seconds: the leader first,
+    # then the server that answered, then the other members
+    wait = Discovery.DISCOVERY_WAIT if wait is None else wait
+    sock = send_find_request(broadcast_ip, broadcast_port)
+    try:
+        deadline = time.monotonic() + wait
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                return []
+            servers = read_find_response(sock)
+            if servers is not None:
+                return servers
+    finally:
+        sock.close()
+
+
+def send_find_request(broadcast_ip=None, broadcast_port=None):
+    # Non blocking socket that sent a client's discovery request, read the
+    # answers with read_find_response when it is readable
+    broadcast_ip = broadcast_ip or os.getenv('BROADCAST_IP') or Discovery.BROADCAST_IP
+    broadcast_port = int(broadcast_port or os.getenv('BROADCAST_PORT')
+                         or Discovery.BROADCAST_PORT)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind(('', 0))
+        host, port = sock.getsockname()
+        request = Message(message=json.dumps({'client': True}), host=host, port=port,
+                          type=MessageType.DISCOVERY_REQ)
+        sock.sendto(wire.dumps(request), (broadcast_ip, broadcast_port))
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def read_find_response(sock):
+    # Servers of the answer waiting on the socket, None when there is none
+    # or it is no valid answer
+    try:
+        message = wire.loads(sock.recvfrom(65535)[0])
+    except (OSError, ValueError):
+        return None  # Nothing to read, no listener at the port or garbage
+    if message.type != MessageType.DISCOVERY_RES:
+        return None
+    try:
+        servers = _servers(message)
+    except (ValueError, KeyError, TypeError):
+        return None  # Malformed, wait for another answer
+    unique = []
+    for address in servers:
+        if address not in unique:
+            unique.append(address)
+    return unique
+
+
+def _servers(message):
+    # Chat addresses in a discovery response, the leader first
+    payload = _decode_payload(message)
+    servers = [Address(message.host, message.port)]
+    servers += [Address(host, port) for host, port, _, _ in payload.get('members', [])]
+    if payload.get('leader'):
+        servers.insert(0, Address(*payload['leader']))
+    return servers
+
+
+def _decode_payload(message):
+    # Discovery payloads are JSON, older nodes send just the replica address
+    if isinstance(message.message, str) and message.message.startswith('{'):
+        return json.loads(message.message)
+    return {'replica': message.message}
+
+
 if __name__ == '__main__':
     load_dotenv()
     discovery = Discovery("127.0.0.1", port=3004,
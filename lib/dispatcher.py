@@ -0,0 +1,114 @@
+import os
+import queue
+import threading
+
+from lib import trace
+from lib.logger import Logger
+
+# Lanes a handler can run on
+INLINE = 'inline'  # in the listener thread, for fast handlers
+POOL = 'pool'  # on the shared worker pool, unordered, for slow handlers
+# Any other lane name is an ordered lane: one worker thread that runs its
+# messages one at a time in arrival order.
+
+
+class _Worker():
+    def __init__(self, name, nr_threads, max_queue):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.threads = [threading.Thread(target=self._loop, name=name, daemon=True)
+                        for _ in range(nr_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            item[0](*item[1:])
+
+    def submit(self, function, *args):
+        # Blocks the listener when the lane is full
+        self.queue.put((function,) + args)
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+
+
+# Runs the handlers of received replica messages inside the listener process.
+# Fast handlers run inline, slow ones on an optional bounded worker pool, and
+# handlers whose messages must stay in order share an ordered lane.
+class Dispatcher():
+    def __init__(self, workers=None, max_queue=None, default=None, default_lane=INLINE):
+        # default handles the messages of types without a handler, on
+        # default_lane
+        self._logger = Logger()
+        self.workers = int(workers if workers is not None
+                           else os.getenv('REPLICA_WORKERS') or 0)
+        self.max_queue = int(max_queue or os.getenv('REPLICA_QUEUE') or 1024)
+        self.default = default
+        self.default_lane = default_lane
+        self._handlers = {}
+        self._lanes = {}
+        self._lanes_lock = threading.Lock()
+        self._pid = None
+        self._stopped = threading.Event()
+
+    def register(self, type, handler, lane=INLINE):
+        self._handlers[type] = (handler, lane)
+
+    def _lane(self, lane):
+        with self._lanes_lock:
+            if self._pid != os.getpid():
+                # Worker threads do not survive a fork
+                self._pid = os.getpid()
+                self._lanes = {}
+            worker = self._lanes.get(lane)
+            if worker is None:
+                nr_threads = self.workers if lane == POOL else 1
+                worker = _Worker('dispatch-' + lane, nr_threads, self.max_queue)
+                self._lanes[lane] = worker
+            return worker
+
+    def every(self, lane, interval, function):
+        # Runs function every interval seconds on the lane, between its
+        # messages, until stop
+        def tick():
+            while not self._stopped.wait(interval):
+                self._lane(lane).submit(self._call, function)
+        threading.Thread(target=tick, name='timer-' + lane, daemon=True).start()
+
+    def dispatch(self, message, address, inline=False):
+        # inline=True runs the handler in the calling thread whatever its lane
+        handler, lane = self._handlers.get(message.type, (self.default, self.default_lane))
+        if handler is None:
+            return
+        if inline or lane == INLINE or (lane == POOL and self.workers <= 0):
+            self._run(handler, message, address)
+        else:
+            self._lane(lane).submit(self._run, handler, message, address)
+
+    def _run(self, handler, message, address):
+        try:
+            if message.trace is None:
+                handler(message, address)
+            else:
+                # What the handler sends carries the trace on
+                with trace.use(message.trace):
+                    handler(message, address)
+        except Exception as e:
+            self._logger.log_error(
+                'Error handling {} from {}: {}'.format(message.type, address, e))
+
+    def _call(self, function):
+        try:
+            function()
+        except Exception as e:
+            self._logger.log_error('Error in timer {}: {}'.format(function, e))
+
+    def stop(self):
+        self._stopped.set()
+        for worker in self._lanes.values():
+            worker.stop()
+        self._lanes = {}
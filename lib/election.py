@@ -1,13 +1,18 @@
 # Defined a class to calculate the election results based on the input data.
 
+import ipaddress
 import json
 from multiprocessing import Manager, Process
 from multiprocessing.shared_memory import ShareableList
+import os
 import time
 
+from lib import metrics, trace
 from lib.address import Address
+from lib.failure_detector import PhiAccrualDetector
 from lib.logger import Logger
-from lib.message import Message, MessageEncoder, MessageType
+from lib.membership import ALIVE, DEAD, SUSPECT, MembershipTable
+from lib.message import Message, MessageType
 
 
 class Node:
@@ -19,7 +24,23 @@ class Node:
     def __init__(self, address=Address(), replica_address=Address()) -> None:
         self.address = address
         self.replica_address = replica_address
-        self.id = self.toJSON()
+        self._id = None
+        self._key = None
+
+    @property
+    def id(self):
+        # JSON id, built on first use
+        if self._id is None:
+            self._id = self.toJSON()
+        return self._id
+
+    @property
+    def key(self):
+        # Order of the nodes in the ring and in elections: the numeric IP
+        # address and port. The JSON id sorts '10.0.0.10' before '10.0.0.9'.
+        if self._key is None:
+            self._key = _node_key(self.address)
+        return self._key
 
     def __str__(self):
         return "[Address: {}, Replica Address: {}]".format(self.address, self.replica_address)
@@ -48,23 +69,175 @@ class Node:
         return Node(Address.fromJSON(data['address']), Address.fromJSON(data['replica_address']))
 
 
+def _node_key(address):
+    try:
+        return (int(ipaddress.ip_address(address.host)), '', address.port or 0)
+    except ValueError:
+        # Host names sort before all IP addresses
+        return (-1, address.host or '', address.port or 0)
+
+
+def _election_body(epoch, id):
+    return {'epoch': epoch, 'id': id}
+
+
+def _parse_election_body(body):
+    # (epoch, id) of an ELECTION or LEADER message. Legacy peers send the
+    # bare id, without epoch.
+    if isinstance(body, dict):
+        return body.get('epoch'), body.get('id', '')
+    return None, body
+
+
+class ChangRobertsElection():
+    # ELECTION(epoch, id) travels along the ring. Every node forwards the
+    # higher of the received id and its own, once: a node that already sent
+    # its own id swallows lower ones. The id that comes back to its sender
+    # wins and LEADER goes around the ring once. N to N log N messages on
+    # average, and N hops of latency.
+    def __init__(self, member):
+        self.member = member
+
+    def start(self, epoch):
+        member = self.member
+        member.send_next_node(MessageType.ELECTION_REQ,
+                              _election_body(epoch, member.id), wait=False)
+
+    def receive_election(self, epoch, id):
+        member = self.member
+        if id == member.id:
+            # Our id came back around, we are the leader
+            member.raise_leader()
+            member.send_next_node(MessageType.LEADER_REQ,
+                                  _election_body(epoch, id), wait=False)
+        elif Node.fromJSON(id).key > member.key:
+            member.participant = True
+            member.send_next_node(MessageType.ELECTION_REQ,
+                                  _election_body(epoch, id), wait=False)
+        elif not member.participant:
+            member.participant = True
+            self.start(epoch)
+
+    def receive_leader(self, epoch, id):
+        member = self.member
+        if id != member.id:
+            member.send_next_node(MessageType.LEADER_REQ,
+                                  _election_body(epoch, id), wait=False)
+
+
+class BullyElection():
+    # Bully election over the current membership. The initiator asks the
+    # live member with the highest key to take over, falling back to the
+    # next one while they do not answer. A member that takes over and has
+    # no live member above itself announces itself to all members. With no
+    # failures that is one request and N - 1 announcements, and two round
+    # trips of latency.
+    def __init__(self, member):
+        self.member = member
+
+    def start(self, epoch):
+        member = self.member
+        higher = sorted((node for node in member.sorted_ring() if node.key > member.key),
+                        key=lambda node: node.key, reverse=True)
+        for node in higher:
+            message = Message(host=member.address.host, port=member.address.port,
+                              message=_election_body(epoch, member.id),
+                              type=MessageType.ELECTION_REQ)
+            response = member.sock_send(message, node.replica_address)
+            if response is None:
+                continue
+            # A member that is ahead of us answers with its leader
+            reply_epoch, leader = _parse_election_body(response.message)
+            if reply_epoch is not None and reply_epoch > epoch and leader.strip():
+                member.receive_leader(response.message)
+            return
+        self.announce(epoch)
+
+    def announce(self, epoch):
+        member = self.member
+        member.raise_leader()
+        for node in member.sorted_ring():
+            if node.address == member.address:
+                continue
+            message = Message(host=member.address.host, port=member.address.port,
+                              message=_election_body(epoch, member.id),
+                              type=MessageType.LEADER_REQ)
+            if member.sock_request is None:
+                member.sock_send(message, node.replica_address)
+            else:
+                member.sock_request(message, node.replica_address)
+
+    def receive_election(self, epoch, id):
+        member = self.member
+        # Several lower members ask us in the same epoch, take over once
+        if not member.participant:
+            member.participant = True
+            self.start(epoch)
+
+    def receive_leader(self, epoch, id):
+        pass
+
+
+# ELECTION_STRATEGY values
+ELECTION_STRATEGIES = {
+    'ring': ChangRobertsElection,
+    'bully': BullyElection,
+}
+
+
 class RingMember(Node):
-    participant = False
     nodes = []  # List of nodes address in the ring
 
-    def __init__(self, address=Address(), send=lambda msg, adr: None, replica_address=Address()) -> None:
+    def __init__(self, address=Address(), send=lambda msg, adr: None, replica_address=Address(),
+                 request=None, membership=None, leader_id=None, election_state=None) -> None:
         super().__init__(address, replica_address)
         self.next_node_alive = True
+        # send blocks for the response, request returns a Future of it
         self.sock_send = send
+        self.sock_request = request
         self.address = address
         self.replica_address = replica_address
-        self.nodes = ShareableList(name="replica_list"+str(address.port))
-        self.leader_id = ShareableList(name="leader_id"+str(address.port))
+        # Shared membership table, see lib/membership.py
+        if membership is None:
+            membership = MembershipTable(name="membership"+str(address.port))
+        self.nodes = membership
+        # Ring view, rebuilt when members are added or removed
+        self._ring = []
+        self._successor = {}
+        self._predecessor = {}
+        self._ring_generation = None
+        # Shared [leader id], attached by name unless given
+        if leader_id is None:
+            leader_id = ShareableList(name="leader_id"+str(address.port))
+        self.leader_id = leader_id
         self._logger = Logger()
         self.is_sending_heartbeat = False
-
-    def send_next_node(self, type, id):
-        # send to next node
+        self.heartbeat_interval = float(os.getenv('HEARTBEAT_INTERVAL') or 5)
+        # Pings retried, with doubling delay, before a successor can be dead
+        self.heartbeat_retries = int(os.getenv('HEARTBEAT_RETRIES') or 3)
+        self.failure_detector = PhiAccrualDetector(
+            interval=self.heartbeat_interval)
+        registry = metrics.registry()
+        self._heartbeat_rtt = registry.histogram(
+            'heartbeat_rtt_seconds', 'Round trip time of answered pings of the successor')
+        self._heartbeat_missed = registry.counter(
+            'heartbeat_missed_total', 'Pings of the successor without an answer')
+        self._election_seconds = registry.histogram(
+            'election_duration_seconds',
+            'Time from the start of an election until the leader is known', buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+        # Shared [epoch, epoch we take part in, epoch whose leader we know,
+        # start time] of elections, attached on first use unless given
+        self._election_state = election_state
+        # Seconds after which a running election no longer holds back a new one
+        self.election_timeout = float(os.getenv('ELECTION_TIMEOUT') or 10)
+        # Share of the elections traced from their start, see lib/trace.py
+        self.trace_sample = float(os.getenv('TRACE_ELECTION_SAMPLE') or 1)
+        strategy = os.getenv('ELECTION_STRATEGY', 'ring').lower()
+        self.election = ELECTION_STRATEGIES[strategy](self)
+
+    def send_next_node(self, type, id, wait=True):
+        # send to next node. With wait=False the message is sent without
+        # waiting for the response and a Future of it is returned
         next_node = self.get_next_node()
         if next_node is not None:
             elect_msg = Message(host=self.address.host, port=self.address.port, message=id,
@@ -72,156 +245,274 @@ class RingMember(Node):
             self._logger.log_replica(
                 'Sending {} to {}'.format(type, next_node.replica_address))
 
-            return self.sock_send(MessageEncoder().encode(
-                elect_msg), next_node.replica_address)
+            if wait or self.sock_request is None:
+                return self.sock_send(elect_msg, next_node.replica_address)
+            return self.sock_request(elect_msg, next_node.replica_address)
         return None
 
     def send_leader(self, type, id):
         # send to leader node
-        print('Sending LEADER to {}'.format(self.leader_id[0]))
+        self._logger.debug('election', 'Sending LEADER to {}', self.leader_id[0])
         # if next_node is not None:
         #     elect_msg = Message(host=self.address.host, port=self.address.port, message=id,
         #                         type=type)
-        #     self.sock_send(MessageEncoder().encode(
-        #         elect_msg), self.replica_address)
+        #     self.sock_send(elect_msg, self.replica_address)
 
     # Ring formation
     def form_ring(self):
-        sorted_list = sorted(
-            [node for node in self.nodes if not node.startswith(' ')])
-        for i in range(len(self.nodes)):
-            if i < len(sorted_list):
-                self.nodes[i] = sorted_list[i]
-            else:
-                self.nodes[i] = " "
-        ns = [Node.fromJSON(node).address for node in sorted_list]
-        print('Ring formed: {}'.format(ns))
+        # Only reports the size: called on every membership change, the
+        # view itself is rebuilt on its next use
+        self._logger.debug('replica', 'Ring formed: {} members', len(self.nodes))
+
+    def sorted_ring(self):
+        # Members sorted by key. The view and the successor and predecessor
+        # maps are only rebuilt after a membership change.
+        generation = self.nodes.changes
+        if generation != self._ring_generation:
+            # Keep the Nodes of the old view, their ids are already built
+            known = {node.address: node for node in self._ring}
+            ring = []
+            for member in self.nodes.members():
+                if member.status == DEAD:
+                    continue
+                node = known.get(member.address)
+                if node is None or node.replica_address != member.replica_address:
+                    node = Node(member.address, member.replica_address)
+                ring.append(node)
+            ring.sort(key=lambda node: node.key)
+            self._successor = {}
+            self._predecessor = {}
+            for i, node in enumerate(ring):
+                self._successor[node.id] = ring[(i + 1) % len(ring)]
+                self._predecessor[node.id] = ring[i - 1]
+            self._ring = ring
+            self._ring_generation = generation
+        return self._ring
 
     def get_next_node(self):
-        node_list = sorted(
-            [node for node in self.nodes if not node.startswith(' ')])\
-
-        if len(node_list) == 0 or len(node_list) == 1:
+        if len(self.sorted_ring()) <= 1:
             return None
+        return self._successor.get(self.id)
 
-        json_node = Node(address=self.address,
-                         replica_address=self.replica_address).toJSON()
-        current_index = node_list.index(json_node)
-        if current_index + 1 < len(node_list):
-            n = Node.fromJSON(node_list[current_index + 1])
-            return n
-        n = Node.fromJSON(node_list[0])
-        return n
+    def get_previous_node(self):
+        if len(self.sorted_ring()) <= 1:
+            return None
+        return self._predecessor.get(self.id)
 
     def join_ring(self):
         # Query neighbor for the current leader
-        leader_id = self.send_next_node(MessageType.GET_LEADER, "")
-        self.leader_id[0] = json.dumps(leader_id)
+        response = self.send_next_node(MessageType.GET_LEADER, "")
+        leader_id = response.message if isinstance(
+            response, Message) else response
+        if leader_id:
+            self.leader_id[0] = leader_id
+        elif not self.leader_id[0].strip():
+            # Nobody has a leader yet, e.g. servers started together
+            self.inititate_election()
         self._logger.log_replica('Leader is {}'.format(self.leader_id[0]))
 
     def get_ring(self):
-        node_list = [Node.fromJSON(node)
-                     for node in self.nodes if not node.startswith(' ')]
-        return node_list
+        return self.nodes.nodes()
 
     def is_leader(self):
         return self.leader_id[0] == self.id
 
+    @property
+    def election_state(self):
+        if self._election_state is None:
+            self._election_state = ShareableList(
+                name="election"+str(self.address.port))
+        return self._election_state
+
+    @property
+    def election_epoch(self):
+        return self.election_state[0]
+
+    @property
+    def participant(self):
+        # Taking part in the election of the current epoch, which has no
+        # leader yet
+        state = self.election_state
+        return state[0] > 0 and state[1] == state[0] and state[2] != state[0]
+
+    @participant.setter
+    def participant(self, value):
+        self.election_state[1] = self.election_state[0] if value else 0
+
+    @property
+    def elected(self):
+        # The leader of the current epoch is known
+        state = self.election_state
+        return state[0] > 0 and state[2] == state[0]
+
     def inititate_election(self):
         # Initiate the election process
         # If ring has only 1 member, then it is the leader
-        if len(self.nodes) == 1:
+        if len(self.sorted_ring()) <= 1:
             self.raise_leader()
-        else:
-            # send(self.id, 'ELECTION')
-            self.send_next_node(MessageType.ELECTION_REQ, self.id)
-            self.participant = True
-
-    # Upon receiving a message ELECTION(j)
-    def receive_election(self, id):
-        self._logger.log_election(
-            'Upon receiving a message ELECTION(j) {}'.format(id))
-        # if (j > my_id) then send(ELECTION, j);
-        if id > self.id:
-            # send(id, 'ELECTION')
-            self.send_next_node(MessageType.ELECTION_REQ, id)
+            return
+        state = self.election_state
+        if self.participant and self._now() - state[3] < self.election_timeout:
+            # Coalesced with the election that is already running, e.g. when
+            # several members detect the dead leader
             self._logger.log_election(
-                'if (j > my_id) then send(ELECTION, j); {}'.format(id))
-        # else if (my_id = j) then send(LEADER(my_id));
-        elif id == self.id:
-            # send(id, 'LEADER')
-            self.send_next_node(MessageType.LEADER_REQ, id)
-            self.leader_id[0] = self.id
-            self._logger.log_election(
-                'else if (my_id = j) then send(LEADER(my_id)); {}'.format(id))
-
-        # if ((my_id > j) ^ (¬participant)) then send ELECTION(my_id));
-        if self.id > id and not self.participant:
-            # send(self.id, 'ELECTION')
-            self.inititate_election()
-            self._logger.log_election(
-                'if ((my_id > j) ^ (¬participant)) then send ELECTION(my_id)); {}'.format(id))
-        self.participant = True
-
-    # Upon receiving a message LEADER(j):
-    def receive_leader(self, leader_id):
+                'Election {} already running'.format(state[0]))
+            return
+        epoch = state[0] + 1
+        state[0] = epoch
+        state[1] = epoch
+        state[3] = self._now()
+        self._logger.log_election('Starting election {}'.format(epoch))
+        election_trace = trace.start(self.trace_sample)
+        if election_trace is None:
+            self.election.start(epoch)
+            return
+        election_trace.hop('start election {}'.format(epoch))
+        with trace.use(election_trace):
+            self.election.start(epoch)
+
+    def check_leader(self):
+        # Restarts an election that ended without a leader, e.g. because
+        # the members changed while it ran and LEADER missed some of them
+        if self.leader_id[0].strip() and not self.participant:
+            return
+        if self.participant and self._now() - self.election_state[3] < self.election_timeout:
+            return
+        self.inititate_election()
+
+    def election_reply(self):
+        # Response to ELECTION: our epoch and leader, so that an initiator
+        # that is behind learns the leader
+        return _election_body(self.election_epoch, self.leader_id[0].strip())
+
+    def _enter_epoch(self, epoch):
+        # False for messages of an older election. A newer one replaces the
+        # current election.
+        if epoch is None:
+            # Legacy peer, treat as the current election
+            return True
+        state = self.election_state
+        if epoch < state[0]:
+            return False
+        if epoch > state[0]:
+            state[0] = epoch
+            state[1] = 0
+            state[3] = self._now()
+        return True
+
+    # Upon receiving a message ELECTION(epoch, j)
+    def receive_election(self, body):
+        epoch, id = _parse_election_body(body)
         self._logger.log_election(
-            'Upon receiving a message LEADER(j): {}'.format(leader_id))
+            'Received ELECTION({}, {})'.format(epoch, id))
+        if not id or not self._enter_epoch(epoch):
+            return
+        if self.elected and epoch is not None:
+            # Late message of a finished election
+            return
+        self.election.receive_election(self.election_epoch, id)
+
+    # Upon receiving a message LEADER(epoch, j)
+    def receive_leader(self, body):
+        epoch, leader_id = _parse_election_body(body)
+        if not self._enter_epoch(epoch):
+            return
+        started_at = self.election_state[3]
         self.leader_id[0] = leader_id
+        self.election_state[2] = self.election_epoch
+        duration = self._now() - started_at
+        if epoch is not None:
+            self._election_seconds.observe(duration)
+        if trace.current() is not None:
+            trace.current().hop('leader known')
         self._logger.log_election(
-            'Leader changed to {}'.format(leader_id))
-        if self.id != leader_id:
-            # send(LEADER, j)
-            self.send_next_node(MessageType.LEADER_REQ, leader_id)
-        pass
+            'Leader changed to {} in election {} after {:.3f}s'.format(
+                leader_id, self.election_epoch, duration))
+        self.election.receive_leader(self.election_epoch, leader_id)
 
     def raise_leader(self):
         self.leader_id[0] = self.id
-        print('I am the leader', self.leader_id[0])
-        pass
+        if self._election_state is not None:
+            self.election_state[2] = self.election_epoch
+        self._logger.log_election('I am the leader {}', self.leader_id[0])
 
     def start_p_send_heartbeat(self):
-        print('Starting heartbeat')
+        self._logger.log_replica('Starting heartbeat')
         self.send_heartbeat_p = Process(target=self.send_heartbeat)
         self.send_heartbeat_p.start()
 
+    def _now(self):
+        return time.monotonic()
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
     def send_heartbeat(self):
         while True:
-            time.sleep(10)  # Heartbeat interval
-            next_node = self.get_next_node()
-            if next_node is not None:
-                message = self.send_next_node(MessageType.PING_REQ, self.id)
-                if message is None:
-                    print('Node is dead')
-                    # remove nodes from the list
-                    self.remove_node(next_node)
-                    # refresh the ring
-                    self.form_ring()
-                    # broadcast removal of node
-                    self.send_remove_node(next_node)
-                    if (next_node.toJSON() == self.leader_id[0]):
-                        # start the election process
-                        print('Leader is dead. Starting election')
-                        self.inititate_election()
+            self._sleep(self.heartbeat_interval)
+            self.check_next_node()
+
+    def check_next_node(self):
+        # Ping the successor. A missed ping makes it suspect and is retried
+        # with doubling delay. The successor is dead only after
+        # heartbeat_retries missed retries, and once the failure detector no
+        # longer considers it available. A successor that never answered has
+        # no heartbeats to judge by and is dead after the retries.
+        self.check_leader()
+        next_node = self.get_next_node()
+        if next_node is None or self.ping(next_node):
+            return
+        self.nodes.update(next_node, status=SUSPECT)
+        peer = str(next_node.address)
+        detector = self.failure_detector
+        delay = self.heartbeat_interval / 10
+        missed = 0
+        while missed < self.heartbeat_retries or (
+                detector.has_heartbeats(peer) and detector.is_available(peer, self._now())):
+            self._sleep(delay)
+            if self.ping(next_node):
+                return
+            missed += 1
+            delay = min(delay * 2, self.heartbeat_interval)
+        self._logger.log_replica('Node is dead: {}', next_node)
+        self.failure_detector.remove(peer)
+        # remove nodes from the list
+        self.remove_node(next_node)
+        # refresh the ring
+        self.form_ring()
+        # broadcast removal of node
+        self.send_remove_node(next_node)
+        if (next_node.toJSON() == self.leader_id[0]):
+            # start the election process
+            self._logger.log_election('Leader is dead. Starting election')
+            self.inititate_election()
+
+    def ping(self, node):
+        message = Message(host=self.address.host, port=self.address.port, message=self.id,
+                          type=MessageType.PING_REQ)
+        started = time.perf_counter()
+        if self.sock_send(message, node.replica_address) is None:
+            self._heartbeat_missed.inc()
+            return False
+        self._heartbeat_rtt.observe(time.perf_counter() - started)
+        self.failure_detector.heartbeat(str(node.address), self._now())
+        self.nodes.update(node, status=ALIVE, last_seen=time.time())
+        return True
 
     def send_remove_node(self, node):
-        self.send_next_node(MessageType.REMOVE_NODE, node.toJSON())
+        self.send_next_node(MessageType.REMOVE_NODE, node.toJSON(), wait=False)
         pass
 
     def receive_heartbeat(self, node_id):
-        print(f"Received heartbeat from next node")
+        self._logger.debug('replica', 'Received heartbeat from next node')
 
     def set_nodes(self, nodes):
         self.nodes = nodes
 
     def remove_node(self, node):
         # Remove node from the list
-        node_json = node.toJSON()
-        for i in range(len(self.nodes)):
-            if self.nodes[i] == node_json:
-                self.nodes[i] = " "
-                break
-        print('Node removed from the list')
+        if self.nodes.remove(node):
+            self._logger.debug('replica', 'Node removed from the list')
 
     def __str__(self):
         return "Election: {} Leader: {}".format(self.id, self.leader_id)
@@ -0,0 +1,88 @@
+from collections import deque
+import math
+import os
+import time
+
+
+# Heartbeat history of one peer: the last `size` inter-arrival times with
+# their running sum and sum of squares.
+class ArrivalWindow():
+    def __init__(self, size, first_interval, first_std):
+        self.intervals = deque(maxlen=size)
+        self.total = 0.0
+        self.squares = 0.0
+        self.last = None
+        # Two made up intervals so the first real heartbeats do not make the
+        # estimate jump
+        for interval in (first_interval - first_std, first_interval + first_std):
+            self._add(interval)
+
+    def _add(self, interval):
+        if len(self.intervals) == self.intervals.maxlen:
+            old = self.intervals[0]
+            self.total -= old
+            self.squares -= old * old
+        self.intervals.append(interval)
+        self.total += interval
+        self.squares += interval * interval
+
+    def arrival(self, now):
+        if self.last is not None:
+            self._add(now - self.last)
+        self.last = now
+
+    def mean(self):
+        return self.total / len(self.intervals)
+
+    def std(self):
+        mean = self.mean()
+        return math.sqrt(max(0.0, self.squares / len(self.intervals) - mean * mean))
+
+
+# Phi accrual failure detector (Hayashibara et al.). Instead of a yes/no
+# timeout it gives the suspicion level
+#
+#   phi = -log10(P(next heartbeat arrives later than now))
+#
+# from the normal distribution of the inter-arrival times of the peer's
+# heartbeats. phi 1 means a 10% chance that the peer is still alive, phi 8 a
+# 1e-8 chance. A peer with phi below the threshold is available.
+class PhiAccrualDetector():
+    def __init__(self, threshold=None, interval=None, window=100, min_std=None):
+        self.threshold = float(threshold or os.getenv('PHI_THRESHOLD') or 8)
+        self.interval = float(interval or os.getenv('HEARTBEAT_INTERVAL') or 5)
+        self.window = window
+        # Keeps very regular heartbeats from making phi jump on small delays
+        self.min_std = min_std or self.interval / 10
+        self._peers = {}
+
+    def heartbeat(self, peer, now=None):
+        now = time.monotonic() if now is None else now
+        history = self._peers.get(peer)
+        if history is None:
+            history = self._peers[peer] = ArrivalWindow(
+                self.window, self.interval, self.interval / 4)
+        history.arrival(now)
+
+    def phi(self, peer, now=None):
+        # 0 for peers without heartbeats yet
+        history = self._peers.get(peer)
+        if history is None or history.last is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        std = max(history.std(), self.min_std)
+        y = (now - history.last - history.mean()) / (std * math.sqrt(2))
+        later = 0.5 * math.erfc(y)
+        if later <= 0:
+            return float('inf')
+        return -math.log10(later)
+
+    def has_heartbeats(self, peer):
+        history = self._peers.get(peer)
+        return history is not None and history.last is not None
+
+    def is_available(self, peer, now=None):
+        return self.phi(peer, now) < self.threshold
+
+    def remove(self, peer):
+        self._peers.pop(peer, None)
@@ -0,0 +1,100 @@
+import struct
+
+from lib.message import ChatMessage
+
+# Every frame is a 4 byte big endian payload length followed by the payload
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+def encode_frame(payload: bytes) -> bytes:
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_message(message: ChatMessage) -> bytes:
+    return encode_frame(str.encode(message.toJSON()))
+
+
+def encode_client_message(message: ChatMessage) -> bytes:
+    # Frame fanned out to clients, the trace stays on the servers
+    if message.trace is None:
+        return encode_message(message)
+    message_trace, message.trace = message.trace, None
+    try:
+        return encode_message(message)
+    finally:
+        message.trace = message_trace
+
+
+# Incremental decoder for length prefixed frames. Data is received straight
+# into one reusable buffer (recv_into / get_buffer), and whole frames are cut
+# out of it, no matter how TCP split or coalesced the writes.
+class FrameDecoder():
+    def __init__(self, buffer_size=65536, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        # Unconsumed data lives in _buffer[_start:_end]
+        self._start = 0
+        self._end = 0
+        # Size of the frame currently being received, 0 when unknown
+        self._needed = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def get_buffer(self, min_size=4096):
+        # Free space at the end of the buffer, made big enough to hold the
+        # frame being received when its size is known
+        needed = max(min_size, self._needed - len(self))
+        if len(self._buffer) - self._end < needed:
+            self._make_room(needed)
+        return self._view[self._end:]
+
+    def advance(self, nbytes):
+        self._end += nbytes
+
+    def recv_into(self, sock):
+        nbytes = sock.recv_into(self.get_buffer())
+        self.advance(nbytes)
+        return nbytes
+
+    def feed(self, data):
+        self.get_buffer(len(data))[:len(data)] = data
+        self.advance(len(data))
+
+    def frames(self):
+        while len(self) >= HEADER.size:
+            size, = HEADER.unpack_from(self._buffer, self._start)
+            if size > self.max_frame_size:
+                raise ValueError(
+                    'Frame of {} bytes exceeds the limit of {} bytes'.format(size, self.max_frame_size))
+            if len(self) < HEADER.size + size:
+                self._needed = HEADER.size + size
+                break
+            start = self._start + HEADER.size
+            self._start = start + size
+            self._needed = 0
+            yield bytes(self._view[start:self._start])
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def messages(self):
+        for frame in self.frames():
+            yield ChatMessage.fromJSON(frame)
+
+    def _make_room(self, needed):
+        used = len(self)
+        size = len(self._buffer)
+        while size - used < needed:
+            size *= 2
+        if size != len(self._buffer):
+            buffer = bytearray(size)
+            buffer[:used] = self._buffer[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(self._buffer)
+        else:
+            # Move the partial frame to the front of the buffer
+            self._buffer[:used] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = used
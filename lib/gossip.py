@@ -0,0 +1,239 @@
+import concurrent.futures
+import math
+import os
+import random
+import time
+
+from lib.address import Address
+from lib.logger import Logger
+from lib.membership import ALIVE, DEAD, SUSPECT, Member
+from lib.message import Message, MessageType
+
+
+# SWIM style gossip membership (Das et al.), an alternative to every node
+# pinging only its successor in the ring.
+#
+# Every GOSSIP_INTERVAL a node pings one member, taking the members in a
+# shuffled round robin order. Without an ack it asks GOSSIP_INDIRECT other
+# members to ping the target for it (GOSSIP_PING_REQ), and without any ack
+# at the end of the period the target becomes SUSPECT. A suspect that does
+# not refute within the suspicion timeout becomes DEAD.
+#
+# Membership updates are not sent separately: every ping and ack carries the
+# members with gossip transmissions left (piggybacking), and every change
+# is transmitted about 3 * log2(N) times, so it reaches all nodes in
+# O(log N) periods. Incarnation numbers order the updates about a member;
+# a node that hears it is suspected raises its incarnation and gossips that
+# it is alive. A DEAD member stays in the table as a tombstone, with its
+# incarnation, until updates from before its death are gossiped out, so a
+# stale ALIVE cannot bring it back.
+#
+# The state lives in the shared membership table, so the probing loop and
+# the replica listener, which run in different processes, share it.
+class GossipMember():
+    # Members piggybacked on one message
+    MAX_PIGGYBACK = 8
+    # Transmissions of one update are RETRANSMIT_MULT * log2(N + 1)
+    RETRANSMIT_MULT = 3
+    # Suspicion timeout is SUSPICION_MULT * max(1, log10(N)) periods
+    SUSPICION_MULT = 4
+    # Tombstones are kept TOMBSTONE_MULT times as long as an update is gossiped
+    TOMBSTONE_MULT = 2
+
+    def __init__(self, node, membership, request, interval=None, indirect=None):
+        self._logger = Logger()
+        self.node = node
+        self.nodes = membership
+        # request(message, address) sends a replica request and returns a
+        # Future of the response
+        self.request = request
+        self.interval = float(interval or os.getenv('GOSSIP_INTERVAL') or 1)
+        self.indirect = int(indirect or os.getenv('GOSSIP_INDIRECT') or 3)
+        self.random = random.Random()
+        self._probe_order = []
+        # Called with the Member declared DEAD
+        self.on_dead = lambda node: None
+        # Called after every protocol period
+        self.on_probe = lambda: None
+        self.messages_sent = 0
+
+    def _now(self):
+        return time.time()
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _wait(self, futures, timeout):
+        # The first response of the futures within timeout, or None
+        deadline = time.monotonic() + timeout
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, timeout=max(0, deadline - time.monotonic()),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                return None
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+        return None
+
+    def run(self):
+        while True:
+            self._sleep(self.interval)
+            self.probe()
+
+    # ________probing_________________
+
+    def probe(self):
+        # One protocol period
+        self.expire_suspects()
+        target = self._next_target()
+        if target is None:
+            return
+        response = self._wait([self._send(MessageType.GOSSIP_PING, target)],
+                              self.interval / 4)
+        if response is None:
+            others = [member for member in self._live_members()
+                      if member.address != target.address]
+            helpers = self.random.sample(others, min(self.indirect, len(others)))
+            target_address = [target.address.host, target.address.port,
+                              target.replica_address.host, target.replica_address.port]
+            response = self._wait([self._send(MessageType.GOSSIP_PING_REQ, helper,
+                                              target=target_address)
+                                   for helper in helpers], self.interval / 2)
+        if response is None:
+            self.suspect(target)
+        else:
+            self.receive(response)
+        self.on_probe()
+
+    def _live_members(self):
+        return [member for member in self.nodes.members()
+                if member.status != DEAD and member.address != self.node.address]
+
+    def _next_target(self):
+        if not self._probe_order:
+            self._probe_order = self._live_members()
+            self.random.shuffle(self._probe_order)
+        while self._probe_order:
+            target = self._probe_order.pop()
+            member = self.nodes.get(target)
+            if member is not None and member.status != DEAD:
+                return member
+        return None
+
+    def _send(self, type, member, **body):
+        self.messages_sent += 1
+        message = Message(message=self.payload(**body), type=type,
+                          host=self.node.address.host, port=self.node.address.port)
+        return self.request(message, member.replica_address)
+
+    def payload(self, **body):
+        body['updates'] = [[m.address.host, m.address.port, m.replica_address.host,
+                            m.replica_address.port, m.status, m.incarnation]
+                           for m in self.nodes.piggyback(self.MAX_PIGGYBACK)]
+        return body
+
+    # ________received messages_________________
+
+    def handle_ping(self, message):
+        # Returns the body of the ack
+        self.receive(message)
+        self._tell_dead(message)
+        return self.payload()
+
+    def handle_ping_req(self, message):
+        # Pings the target for the sender, returns the body of the ack or None
+        self.receive(message)
+        host, port, replica_host, replica_port = message.message['target']
+        target = Member(Address(host, port), Address(replica_host, replica_port))
+        response = self._wait([self._send(MessageType.GOSSIP_PING, target)],
+                              self.interval / 4)
+        if response is None:
+            return None
+        self.receive(response)
+        return self.payload()
+
+    def receive(self, message):
+        # Applies the updates piggybacked on a ping or ack
+        body = message.message if isinstance(message.message, dict) else {}
+        for host, port, replica_host, replica_port, status, incarnation in body.get('updates', []):
+            self.apply(Member(Address(host, port), Address(replica_host, replica_port)),
+                       status, incarnation)
+
+    def _tell_dead(self, message):
+        # A member we hold a tombstone of pings us: it restarted, or missed
+        # its own death. Gossiping the tombstone again lets it refute.
+        member = self.nodes.get(Member(Address(message.host, message.port), Address()))
+        if member is not None and member.status == DEAD and member.gossip == 0:
+            self.nodes.update(member, gossip=1)
+
+    def apply(self, node, status, incarnation):
+        # SWIM ordering of updates about one member: a higher incarnation
+        # wins, SUSPECT wins over ALIVE and DEAD over both of the same
+        # incarnation. A DEAD member only comes back with a higher one.
+        if node.address == self.node.address:
+            self._refute(status, incarnation)
+            return
+        member = self.nodes.get(node)
+        if member is None:
+            if status != DEAD:
+                self.nodes.add(node, status=status, last_seen=self._now(),
+                               incarnation=incarnation, gossip=self.retransmits())
+                self._logger.log_replica('Member joined: {}'.format(node.address))
+            return
+        if incarnation < member.incarnation or (
+                incarnation == member.incarnation and status <= member.status):
+            return
+        if status == DEAD:
+            self._declare_dead(member, incarnation)
+        elif member.status != DEAD or status == ALIVE:
+            self.nodes.update(member, status=status, incarnation=incarnation,
+                              last_seen=self._now(), gossip=self.retransmits())
+
+    def _refute(self, status, incarnation):
+        own = self.nodes.get(self.node)
+        if own is None or status == ALIVE or incarnation < own.incarnation:
+            return
+        # Suspected or declared dead: we are alive, with a higher incarnation
+        self.nodes.update(own, status=ALIVE, incarnation=incarnation + 1,
+                          gossip=self.retransmits())
+
+    # ________suspicion_________________
+
+    def suspect(self, member):
+        member = self.nodes.get(member)
+        if member is None or member.status != ALIVE:
+            return
+        self._logger.log_replica('No ack from {}, suspect'.format(member.address))
+        self.nodes.update(member, status=SUSPECT, last_seen=self._now(),
+                          gossip=self.retransmits())
+
+    def expire_suspects(self):
+        now = self._now()
+        timeout = self.suspicion_timeout()
+        for member in self.nodes.members():
+            if member.status == SUSPECT and now - member.last_seen >= timeout:
+                self._declare_dead(member, member.incarnation)
+            elif (member.status == DEAD and member.gossip == 0
+                  and now - member.last_seen >= self.tombstone_timeout()):
+                # Everybody heard about it, and older updates are gone
+                self.nodes.remove(member)
+
+    def _declare_dead(self, member, incarnation):
+        self._logger.log_replica('Member dead: {}'.format(member.address))
+        self.nodes.update(member, status=DEAD, incarnation=incarnation,
+                          last_seen=self._now(), gossip=self.retransmits())
+        self.on_dead(member)
+
+    def retransmits(self):
+        return int(self.RETRANSMIT_MULT * math.ceil(math.log2(len(self.nodes) + 1)))
+
+    def suspicion_timeout(self):
+        return self.SUSPICION_MULT * max(1, math.log10(max(1, len(self.nodes)))) * self.interval
+
+    def tombstone_timeout(self):
+        # Seconds a DEAD member is kept after it was declared
+        return self.TOMBSTONE_MULT * self.retransmits() * self.interval
+
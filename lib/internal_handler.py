@@ -1,18 +1,27 @@
-import json
-from multiprocessing import Process
+from concurrent import futures
 import os
 import socket
 import time
 
 from lib.address import Address
+from lib.causal import CausalQueue
+from lib.channel import ReplicaChannel
+from lib.clock import DeltaEncoder, VectorClock
+from lib.dispatcher import Dispatcher, POOL
 from lib.election import Node, RingMember
-from lib.message import Message, MessageDecoder, MessageEncoder, MessageType
+from lib.gossip import GossipMember
+from lib.message import ChatMessage, Message, MessageType
+from lib.log_store import open_log
+from lib.replication import ChatLog, ChatReplicator
+from lib import trace, wire
 from lib.logger import Logger
-from multiprocessing.shared_memory import ShareableList
+from lib.membership import MembershipTable
+from multiprocessing import Process
 
 
 class InternalMessageHandler():
-    def __init__(self, server_address):
+    def __init__(self, server_address, membership=None, leader_id=None, election_state=None,
+                 chat_log=None):
         super().__init__()
         self._logger = Logger()
 
@@ -22,6 +31,7 @@ class InternalMessageHandler():
         self.status = 'up'
         self.last_heartbeat = time.time()
 
+        self.port = 5970
         if (os.getenv('REPLICA_PORT') and os.getenv('REPLICA_PORT').isdigit()):
             self.port = int(os.getenv('REPLICA_PORT'))
 
@@ -34,13 +44,68 @@ class InternalMessageHandler():
                 self.port += 1
         replica_address = Address(self.host, self.port)
 
-        self.nodes = ShareableList(
-            name="replica_list"+str(server_address.port))
+        # Outgoing replica requests, one channel shared by all requests
+        self.channel = ReplicaChannel()
+
+        # Members of the ring, shared with the other server processes
+        if membership is None:
+            membership = MembershipTable(
+                name="membership"+str(server_address.port))
+        self.nodes = membership
         node_address = Node(address=server_address,
                             replica_address=replica_address)
-        self.nodes[0] = node_address.toJSON()
+        self.nodes.add(node_address)
         self.election = RingMember(address=server_address, replica_address=Address(
-            self.host, self.port), send=self.send_message)
+            self.host, self.port), send=self.send_message, request=self.request_message,
+            membership=self.nodes, leader_id=leader_id, election_state=election_state)
+
+        # 'ring': every node pings its successor, 'gossip': SWIM style
+        # probing of random members, see lib/gossip.py
+        self.membership_mode = os.getenv('MEMBERSHIP_MODE', 'ring').lower()
+        self.gossip = GossipMember(node_address, self.nodes, self.request_message)
+        self.gossip.on_dead = self.on_member_dead
+        self.gossip.on_probe = self.election.check_leader
+
+        # Merged from the clocks of the chat messages this node delivered
+        self.clock = VectorClock(self.election.id)
+        self._clock_deltas = None
+
+        # Chat log, shipped by the leader to the other members, one per
+        # server under CHAT_LOG_DIR unless one is given
+        if chat_log is None:
+            chat_log = ChatLog(open_log('{}_{}'.format(server_address.host,
+                                                       server_address.port)))
+        self.replicator = ChatReplicator(
+            node_address, self.nodes, self.request_message,
+            epoch=lambda: self.election.election_epoch, log=chat_log)
+        # Holds back chat messages that arrive before those they depend on
+        self.causal = CausalQueue(self.clock, self._append_chat_message)
+
+        # Handlers of received messages, run inside the listener process.
+        # Election, leader and removal messages share one ordered lane so
+        # they are handled one at a time in arrival order. So do messages of
+        # other types, the default handler takes them as election messages.
+        self.dispatcher = Dispatcher(default=self.process_default, default_lane='election')
+        self.dispatcher.register(
+            MessageType.GET_LEADER, self.process_get_leader)
+        self.dispatcher.register(MessageType.PING_REQ, self.process_ping_req)
+        self.dispatcher.register(MessageType.PING_RES, self.process_ping_res)
+        self.dispatcher.register(
+            MessageType.ELECTION_REQ, self.process_election_req, lane='election')
+        self.dispatcher.register(
+            MessageType.LEADER_REQ, self.process_leader_req, lane='election')
+        self.dispatcher.register(
+            MessageType.REMOVE_NODE, self.process_remove_node, lane='election')
+        # Chat messages and log batches keep their order in the log
+        self.dispatcher.register(
+            MessageType.MESSAGE, self.process_chat_message, lane='log')
+        self.dispatcher.register(
+            MessageType.REPLICATE_REQ, self.process_replicate_req, lane='log')
+        self.dispatcher.register(
+            MessageType.GOSSIP_PING, self.process_gossip_ping)
+        # Waits for the ack of the target, so off the listener thread
+        self.dispatcher.register(
+            MessageType.GOSSIP_PING_REQ, self.process_gossip_ping_req, lane=POOL)
 
     def _create_socket(self, port):
         self.sock = socket.socket(
@@ -50,62 +115,66 @@ class InternalMessageHandler():
     def listen_message(self):
         self._logger.log_replica('Listening for replica messages on {}:{}...'.format(
             self.host, self.port))
+        # Gives up on lost chat messages also when no other one arrives
+        self.dispatcher.every('log', self.causal.timeout / 2, self.causal.expire)
         while True:
-            data, address = self.sock.recvfrom(1024)
-            jsonStr = data.decode("utf-8")
-            message = json.loads(json.loads(jsonStr), cls=MessageDecoder)
-            self._logger.log_replica(
-                "Connected by {}:{}".format(message.host, message.port))
-            t = Process(target=self.process_message,
-                        args=(message, address))
-            t.start()
-            t.join()
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except OSError:
+                break  # Closed by terminate
+            self.receive_datagram(data, address)
+
+    def receive_datagram(self, data, address):
+        try:
+            message = wire.loads(data)
+        except ValueError as e:
+            self._logger.log_error(
+                'Dropped malformed replica message from {}: {}'.format(address, e))
+            return
+        self._logger.debug('replica', 'Connected by {}:{}', message.host, message.port)
+        if message.trace is not None:
+            message.trace.hop('recv {}'.format(MessageType(message.type).name))
+        self.process_message(message, address)
 
     def process_message(self, message, client_address):
-        message_type = message.type
-        switcher = {
-            MessageType.GET_LEADER: self.process_get_leader,
-            MessageType.PING_REQ: self.process_ping_req,
-            MessageType.PING_RES: self.process_ping_res,
-            MessageType.ELECTION_REQ: self.process_election_req,
-            MessageType.LEADER_REQ: self.process_leader_req,
-            MessageType.REMOVE_NODE: self.process_remove_node,
-            MessageType.MESSAGE: self.process_message
-        }
-        # Get the function to handle the message type
-        handler = switcher.get(message_type, self.process_default)
-        # Call the handler function with the message and client address
-        handler(message, client_address)
+        # Call the handler of the message type with the message and client address
+        self.dispatcher.dispatch(message, client_address)
 
     def process_get_leader(self, message, client_address):
-        leader_id = ShareableList(
-            name="leader_id"+str(self.server_address.port))[0]
-        self._logger.log_replica('Leader id: {}'.format(leader_id))
+        leader_id = self.election.leader_id[0]
+        self._logger.debug('replica', 'Leader id: {}', leader_id)
         leader_id = leader_id.strip() if leader_id else ""
-        self.sock.sendto(
-            str.encode(leader_id), client_address)
+        if message.correlation_id is None:
+            # Legacy peers expect the raw leader id
+            self.sock.sendto(
+                str.encode(leader_id), client_address)
+        else:
+            self._reply(message, client_address,
+                        MessageType.RES_LEADER, leader_id)
 
     def process_ping_req(self, message, client_address):
-        res = Message(host=self.host, port=self.port, message="",
-                      type=MessageType.PING_RES)
-        res = MessageEncoder().encode(res)
-        self._logger.log_replica(
-            'PING RESPONSE to {}:{}'.format(message.host, message.port))
-        self.sock.sendto(
-            str.encode(res), client_address)
+        self._logger.debug('replica', 'PING RESPONSE to {}:{}', message.host, message.port)
+        self._reply(message, client_address, MessageType.PING_RES)
 
     def process_ping_res(self, message, client_address):
         node_id = str(client_address[0]) + ':' + str(client_address[1])
         self.election.receive_heartbeat(node_id)
 
     def process_election_req(self, message, client_address):
+        # Answer first, the bully strategy may send requests of its own
+        if message.correlation_id is None:
+            res = ""
+            self.sock.sendto(
+                str.encode(res), client_address)
+        else:
+            self._reply(message, client_address, MessageType.ELECTION_RES,
+                        self.election.election_reply())
         self.election.receive_election(message.message)
-        res = ""
-        self.sock.sendto(
-            str.encode(res), client_address)
 
     def process_leader_req(self, message, client_address):
         self.election.receive_leader(message.message)
+        if message.correlation_id is not None:
+            self._reply(message, client_address, MessageType.LEADER_RES)
 
     def process_remove_node(self, message, client_address):
         node = Node.fromJSON(message.message)
@@ -113,55 +182,137 @@ class InternalMessageHandler():
         if rm:  # If node was found, else ignore
             self.election.form_ring()
             self.election.send_remove_node(node)
-            res = Message(host=self.host, port=self.port,
-                          message="", type=MessageType.REMOVE_NODE_RES)
-            self.sock.sendto(
-                str.encode(MessageEncoder().encode(res)), client_address)
+        if rm or message.correlation_id is not None:
+            self._reply(message, client_address, MessageType.REMOVE_NODE_RES)
+
+    def process_gossip_ping(self, message, client_address):
+        self._reply(message, client_address, MessageType.GOSSIP_ACK,
+                    self.gossip.handle_ping(message))
+
+    def process_gossip_ping_req(self, message, client_address):
+        ack = self.gossip.handle_ping_req(message)
+        if ack is not None:  # Else the requester times out
+            self._reply(message, client_address, MessageType.GOSSIP_ACK, ack)
+
+    def process_chat_message(self, message, client_address):
+        # Sent by the chat servers to the leader, see submit_chat_message
+        if not self.election.is_leader():
+            self._logger.log_error('Not the leader, dropped message from {}:{}'.format(
+                message.host, message.port))
+            return
+        if message.clock is None:
+            self._append_chat_message(message)
+        else:
+            # Appended once the messages it depends on are
+            self.causal.push(self.clock.read_delta(message.clock), message)
+
+    def _append_chat_message(self, message):
+        try:
+            committed = self.replicator.append(message.message)
+        except ValueError as e:
+            self._logger.log_error('Dropped chat message from {}:{}: {}'.format(
+                message.host, message.port, e))
+            return
+        if message.trace is not None:
+            message.trace.hop('append')
+            committed.add_done_callback(lambda _: message.trace.hop('commit'))
+
+    def process_replicate_req(self, message, client_address):
+        reply = self.replicator.receive(message.message)
+        if reply is not None:  # Else an older leader, it times out
+            self._reply(message, client_address, MessageType.REPLICATE_RES, reply)
 
     def process_default(self, message, client_address):
         self.election.receive_election(message.message)
 
+    def _reply(self, request, client_address, type, message=""):
+        res = Message(host=self.host, port=self.port, message=message,
+                      type=type, correlation_id=request.correlation_id)
+        self.sock.sendto(wire.dumps(res), client_address)
+
     def send_message(self, message, address):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(5)
+        # Blocking request, returns the response or None on timeout. The
+        # channel times the request out, the wait has a bound of its own in
+        # case it does not.
         try:
-            sock.sendto(
-                str.encode(message), (address.host, address.port))
-            data, addr = sock.recvfrom(1024)
-            message = json.loads(data.decode("utf-8"))
-            self._logger.log_replica(
-                'Received response: {}'.format(message))
-            return message
-        except socket.timeout:
-            self._logger.log_replica(
-                'Replica message timed out. {}'.format(address))
+            response = self.request_message(message, address).result(
+                timeout=self.channel.max_timeout * 2)
+        except (TimeoutError, futures.TimeoutError):
             return None
+        self._logger.debug('replica', 'Received response: {}', response)
+        return response
+
+    def request_message(self, message, address):
+        # Non blocking request, returns a Future of the response
+        return self.channel.request(message, address)
+
+    def submit_chat_message(self, chat_message, clock=None):
+        # Sends a chat message of a client to the leader, which appends it
+        # to the replicated chat log, with the entries of the vector clock
+        # that changed since the last message to the leader. False when it
+        # was not sent.
+        leader_id = self.election.leader_id[0].strip()
+        if not leader_id:
+            self._logger.log_error('No leader, chat message not replicated')
+            return False
+        leader = Node.fromJSON(leader_id)
+        message_trace = chat_message.trace
+        if message_trace is not None:
+            # The trace goes in the replica message, not in the chat log
+            chat_message = ChatMessage(chat_message.sender, chat_message.message,
+                                       room=chat_message.room)
+            message_trace = message_trace.copy()
+            message_trace.hop('submit')
+        data = chat_message.toJSON()
+        if len(str.encode(data)) > self.replicator.max_entry:
+            self._logger.log_error('Chat message of {} bytes too large, not replicated'.format(
+                len(str.encode(data))))
+            return False
+        delta = None
+        if clock is not None:
+            if self._clock_deltas is None or self._clock_deltas.clock is not clock:
+                self._clock_deltas = DeltaEncoder(clock)
+            delta = self._clock_deltas.encode(leader.replica_address)
+        try:
+            self.channel.send(Message(message=data, type=MessageType.MESSAGE,
+                                      host=self.host, port=self.port, clock=delta,
+                                      trace=message_trace),
+                              leader.replica_address)
+        except OSError as e:
+            self._logger.log_error('Chat message not replicated: {}'.format(e))
+            return False
+        return True
 
     def add_node(self, node):
         # New node: broadcast to all nodes to ask leader
         # if receive no response, initiate election
-        node_json = node.toJSON()
-        if node_json in self.nodes:
-            return  # Node already exists, no need to add again
-        # interate throught the array and add the node to the position that is not 0
-        for i in range(len(self.nodes)):
-            # Check if the element at position i is space string
-            if self.nodes[i].startswith(' '):
-                self.nodes[i] = node_json
-                break
+        # Does nothing when the node already exists, the table grows as needed
+        self.nodes.add(node)
 
     def remove_node(self, node):
-        node_json = node.toJSON()
         # Remove node from the list
-        for i in range(len(self.nodes)):
-            if self.nodes[i] == node_json:
-                self.nodes[i] = " "
-                print('Node removed: {}'.format(node_json))
-                return True
+        if self.nodes.remove(node):
+            self._logger.log_replica('Node removed: {}', node.toJSON())
+            return True
         return False
 
+    def start_membership(self):
+        # Starts watching the other members in the configured mode
+        if self.membership_mode != 'gossip':
+            self.election.start_p_send_heartbeat()
+            return
+        # Gossip our own join
+        self.nodes.update(self.election, gossip=self.gossip.retransmits())
+        Process(target=self.gossip.run).start()
+
+    def on_member_dead(self, member):
+        node = Node(address=member.address, replica_address=member.replica_address)
+        if node.toJSON() == self.election.leader_id[0]:
+            self._logger.log_replica('Leader is dead. Starting election')
+            self.election.inititate_election()
+
     def query_next_node_for_leader(self):
-        list = [node for node in self.nodes if not node.startswith(' ')]
+        list = self.nodes.nodes()
         self._logger.log_replica(
             'Querying next node for leader: {}'.format(list))
         # If alone become leader
@@ -169,17 +320,19 @@ class InternalMessageHandler():
             return None
         else:
             next_node = self.election.get_next_node()
-            print('Querying next node for leader: {}'.format(next_node))
+            self._logger.debug('replica', 'Querying next node for leader: {}', next_node)
         pass
 
     def terminate(self):
+        self.dispatcher.stop()
         self.sock.close()
+        self.channel.close()
+        self.replicator.close()
         self._logger.log_replica('Replica shutdown')
-        self.nodes.shm.close()
-        self.nodes.shm.unlink()
+        self.nodes.close()
 
     def get_ring(self):
-        return [node for node in self.nodes if not node.startswith(' ')]
+        return [node.toJSON() for node in self.nodes.nodes()]
 
     def __str__(self):
         return f'{self.name} ({self.address})'
@@ -0,0 +1,384 @@
+from array import array
+import bisect
+import mmap
+import os
+import struct
+import time
+import zlib
+
+
+# Append-only record stores for the chat log, see ChatLog in
+# lib/replication.py. Records are (epoch, timestamp, data) with data in
+# bytes, and are numbered by their offset from 0. Timestamps never decrease.
+
+
+def open_log(name):
+    # The store configured by CHAT_LOG_DIR: a SegmentLog in its directory
+    # name, or a MemoryLog when it is not set
+    directory = os.getenv('CHAT_LOG_DIR')
+    if not directory:
+        return MemoryLog()
+    return SegmentLog(os.path.join(directory, name))
+
+
+class MemoryLog():
+    def __init__(self):
+        self._records = []
+
+    def __len__(self):
+        return len(self._records)
+
+    def append(self, data, epoch=0, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        if self._records:
+            timestamp = max(timestamp, self._records[-1][1])
+        self._records.append((epoch, timestamp, bytes(data)))
+        return len(self._records) - 1
+
+    def read(self, offset):
+        return self._records[offset]
+
+    def replay(self, offset=0):
+        for i in range(max(0, offset), len(self._records)):
+            yield (i,) + self._records[i]
+
+    def offset_for_time(self, timestamp):
+        return bisect.bisect_left([record[1] for record in self._records], timestamp)
+
+    def truncate(self, length):
+        del self._records[length:]
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Record: length of data (4) | crc32 (4) | timestamp (8) | epoch (4) | data
+# The checksum covers everything after it. All integers are big endian.
+RECORD_HEADER = struct.Struct('!IIdI')
+# Index entry: offset relative to the segment (4) | position (4) | timestamp (8)
+INDEX_ENTRY = struct.Struct('!IId')
+
+
+class _Segment():
+    def __init__(self, directory, base):
+        self.base = base
+        self.path = os.path.join(directory, '{:020d}.log'.format(base))
+        self.index_path = os.path.join(directory, '{:020d}.index'.format(base))
+        # Records and bytes in the file, records in the index
+        self.count = 0
+        self.size = 0
+        self.offsets = array('I')
+        self.positions = array('I')
+        self.timestamps = array('d')
+        self._map = None
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        for i in range(len(data) // INDEX_ENTRY.size):
+            offset, position, timestamp = INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size)
+            self.offsets.append(offset)
+            self.positions.append(position)
+            self.timestamps.append(timestamp)
+
+    def view(self, end):
+        # Memory map of the file covering end bytes at least
+        if self._map is None or len(self._map) < end:
+            self.unmap()
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def floor(self, offset):
+        # Closest indexed record at or before the relative offset
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        if i < 0:
+            return 0, 0
+        return self.offsets[i], self.positions[i]
+
+
+# Chat log on disk, in segment files of at most CHAT_LOG_SEGMENT_BYTES
+# named after the offset of their first record. Only the last segment is
+# written to.
+#
+# Appends are collected in a write buffer of CHAT_LOG_WRITE_BUFFER bytes
+# and written to the file in one call once it is full. Records are read
+# through a memory map of their segment, or from the write buffer while
+# they are still in it, so replaying a log never loads it all.
+#
+# Every segment has a sparse index with the position and timestamp of one
+# record per CHAT_LOG_INDEX_INTERVAL bytes, the first one included. A read
+# looks up the closest indexed record before it and scans forward from
+# there, and the timestamps of the index find the records since a time.
+#
+# The log is synced to disk (fsync) by the append after
+# CHAT_LOG_FSYNC_MESSAGES appends or CHAT_LOG_FSYNC_INTERVAL seconds,
+# whichever comes first, 0 disables either. Records after the last sync
+# can be lost when the machine crashes, and records still in the write
+# buffer when the process does. A torn record at the end of the log is
+# dropped when it is opened again.
+class SegmentLog():
+    def __init__(self, directory, segment_bytes=None, index_interval=None,
+                 write_buffer=None, fsync_messages=None, fsync_interval=None):
+        self.directory = directory
+        self.segment_bytes = int(segment_bytes or os.getenv('CHAT_LOG_SEGMENT_BYTES')
+                                 or 64 * 1024 * 1024)
+        self.index_interval = int(index_interval or os.getenv('CHAT_LOG_INDEX_INTERVAL') or 4096)
+        self.write_buffer = int(write_buffer or os.getenv('CHAT_LOG_WRITE_BUFFER') or 1024 * 1024)
+        self.fsync_messages = int(fsync_messages if fsync_messages is not None
+                                  else os.getenv('CHAT_LOG_FSYNC_MESSAGES') or 0)
+        self.fsync_interval = float(fsync_interval if fsync_interval is not None
+                                    else os.getenv('CHAT_LOG_FSYNC_INTERVAL') or 1)
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments = []
+        self._buffer = bytearray()
+        self._index_buffer = bytearray()
+        self._file = None
+        self._index_file = None
+        self._since_index = 0
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        self._last_timestamp = 0.0
+        self._open()
+
+    def _open(self):
+        bases = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                       if name.endswith('.log'))
+        for base in bases:
+            segment = _Segment(self.directory, base)
+            segment.load_index()
+            self._segments.append(segment)
+        for segment in self._segments[:-1]:
+            # Sealed segments were synced when the next one started
+            segment.size = os.path.getsize(segment.path)
+            segment.count = self._segments[self._segments.index(segment) + 1].base - segment.base
+        if self._segments:
+            self._recover(self._segments[-1])
+        else:
+            self._segments.append(_Segment(self.directory, 0))
+        self._open_files(self._segments[-1])
+
+    def _recover(self, segment):
+        # Counts the records of the last segment from its last index entry
+        # on, and drops a torn record at its end
+        size = os.path.getsize(segment.path)
+        while len(segment.positions) and segment.positions[-1] >= size:
+            self._pop_index(segment)
+        offset, position = segment.floor(2 ** 32 - 1)
+        with open(segment.path, 'rb') as f:
+            f.seek(position)
+            data = f.read()
+        end = 0
+        while end + RECORD_HEADER.size <= len(data):
+            length, crc, timestamp, epoch = RECORD_HEADER.unpack_from(data, end)
+            record_end = end + RECORD_HEADER.size + length
+            if record_end > len(data) or zlib.crc32(data[end + 8:record_end]) != crc:
+                break
+            if not len(segment.positions) or position + end - segment.positions[-1] >= self.index_interval:
+                segment.offsets.append(offset)
+                segment.positions.append(position + end)
+                segment.timestamps.append(timestamp)
+            self._last_timestamp = timestamp
+            offset += 1
+            end = record_end
+        segment.count = offset
+        segment.size = position + end
+        while len(segment.positions) and segment.positions[-1] >= segment.size:
+            self._pop_index(segment)
+        if segment.size < size:
+            os.truncate(segment.path, segment.size)
+        self._rewrite_index(segment)
+
+    def _pop_index(self, segment):
+        segment.offsets.pop()
+        segment.positions.pop()
+        segment.timestamps.pop()
+
+    def _rewrite_index(self, segment):
+        with open(segment.index_path, 'wb') as f:
+            for entry in zip(segment.offsets, segment.positions, segment.timestamps):
+                f.write(INDEX_ENTRY.pack(*entry))
+
+    def _open_files(self, segment):
+        self._file = open(segment.path, 'ab', buffering=0)
+        self._index_file = open(segment.index_path, 'ab', buffering=0)
+        self._since_index = (segment.size - segment.positions[-1]
+                             if len(segment.positions) else self.index_interval)
+
+    def __len__(self):
+        segment = self._segments[-1]
+        return segment.base + segment.count
+
+    def append(self, data, epoch=0, timestamp=None):
+        # Returns the offset of the record
+        timestamp = max(time.time() if timestamp is None else timestamp, self._last_timestamp)
+        self._last_timestamp = timestamp
+        segment = self._segments[-1]
+        record_size = RECORD_HEADER.size + len(data)
+        if segment.count and segment.size + record_size > self.segment_bytes:
+            segment = self._roll()
+        body = struct.pack('!dI', timestamp, epoch) + data
+        if self._since_index >= self.index_interval:
+            segment.offsets.append(segment.count)
+            segment.positions.append(segment.size)
+            segment.timestamps.append(timestamp)
+            self._index_buffer += INDEX_ENTRY.pack(segment.count, segment.size, timestamp)
+            self._since_index = 0
+        self._buffer += struct.pack('!II', len(data), zlib.crc32(body))
+        self._buffer += body
+        self._since_index += record_size
+        segment.size += record_size
+        segment.count += 1
+        if len(self._buffer) >= self.write_buffer:
+            self.flush()
+        self._unsynced += 1
+        if ((self.fsync_messages and self._unsynced >= self.fsync_messages) or
+                (self.fsync_interval and time.monotonic() - self._synced_at >= self.fsync_interval)):
+            self.sync()
+        return segment.base + segment.count - 1
+
+    def _roll(self):
+        self.sync()
+        self._file.close()
+        self._index_file.close()
+        segment = _Segment(self.directory, len(self))
+        self._segments.append(segment)
+        self._open_files(segment)
+        return segment
+
+    def flush(self):
+        # Writes the buffered records to the file, without syncing
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        if self._index_buffer:
+            self._index_file.write(self._index_buffer)
+            self._index_buffer = bytearray()
+
+    def sync(self):
+        self.flush()
+        os.fsync(self._file.fileno())
+        os.fsync(self._index_file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def _segment_for(self, offset):
+        return self._segments[bisect.bisect_right([s.base for s in self._segments], offset) - 1]
+
+    def _source(self, segment, position):
+        # Buffer holding the record at position and its start in it: the
+        # write buffer while it was not flushed yet, else the memory map
+        if segment is self._segments[-1]:
+            flushed = segment.size - len(self._buffer)
+            if position >= flushed:
+                return self._buffer, position - flushed
+        else:
+            flushed = segment.size
+        return segment.view(flushed), position
+
+    def _position(self, segment, relative):
+        # Position of the record at the relative offset, or of the end after
+        # the last one
+        offset, position = segment.floor(relative)
+        while offset < relative:
+            data, start = self._source(segment, position)
+            position += RECORD_HEADER.size + RECORD_HEADER.unpack_from(data, start)[0]
+            offset += 1
+        return position
+
+    def _records(self, segment, offset, position):
+        # Records of segment from the one at the relative offset and position
+        # on, as (relative offset, epoch, timestamp, data)
+        while offset < segment.count:
+            data, start = self._source(segment, position)
+            length, _, timestamp, epoch = RECORD_HEADER.unpack_from(data, start)
+            start += RECORD_HEADER.size
+            yield offset, epoch, timestamp, bytes(data[start:start + length])
+            offset += 1
+            position += RECORD_HEADER.size + length
+
+    def read(self, offset):
+        # (epoch, timestamp, data) of the record at offset
+        if not 0 <= offset < len(self):
+            raise IndexError('Offset {} out of range'.format(offset))
+        segment = self._segment_for(offset)
+        relative = offset - segment.base
+        position = self._position(segment, relative)
+        return next(self._records(segment, relative, position))[1:]
+
+    def replay(self, offset=0):
+        # (offset, epoch, timestamp, data) of the records from offset on
+        offset = max(0, offset)
+        if offset >= len(self):
+            return
+        first = self._segments.index(self._segment_for(offset))
+        for segment in self._segments[first:]:
+            relative = max(0, offset - segment.base)
+            position = self._position(segment, relative)
+            for current, epoch, timestamp, data in self._records(segment, relative, position):
+                yield segment.base + current, epoch, timestamp, data
+
+    def offset_for_time(self, timestamp):
+        # Offset of the first record at or after timestamp
+        first = bisect.bisect_left([s.timestamps[0] if len(s.timestamps) else float('inf')
+                                    for s in self._segments], timestamp)
+        segment = self._segments[max(0, first - 1)]
+        i = max(0, bisect.bisect_left(segment.timestamps, timestamp) - 1)
+        if not len(segment.offsets):
+            return len(self)
+        for offset, _, current, _ in self._records(segment, segment.offsets[i], segment.positions[i]):
+            if current >= timestamp:
+                return segment.base + offset
+        # After the last record of the segment, the first of the next one
+        return segment.base + segment.count
+
+    def replay_since(self, timestamp):
+        return self.replay(self.offset_for_time(timestamp))
+
+    def truncate(self, length):
+        # Drops the records from offset length on
+        if length >= len(self):
+            return
+        self.flush()
+        while len(self._segments) > 1 and self._segments[-1].base >= length:
+            segment = self._segments.pop()
+            segment.unmap()
+            os.remove(segment.path)
+            os.remove(segment.index_path)
+        segment = self._segments[-1]
+        self._file.close()
+        self._index_file.close()
+        relative = max(0, length - segment.base)
+        position = self._position(segment, relative)
+        segment.unmap()
+        os.truncate(segment.path, position)
+        while len(segment.offsets) and segment.offsets[-1] >= relative:
+            self._pop_index(segment)
+        self._rewrite_index(segment)
+        segment.count = relative
+        segment.size = position
+        self._open_files(segment)
+        self._last_timestamp = self.read(length - 1)[1] if length else 0.0
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.sync()
+        self._file.close()
+        self._index_file.close()
+        for segment in self._segments:
+            segment.unmap()
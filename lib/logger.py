@@ -1,67 +1,220 @@
-import os
-from colorama import Fore
+import atexit
+import json
 import logging
+import logging.handlers
+import multiprocessing.util
+import os
+import queue
+import sys
+import threading
 from colorama import just_fix_windows_console
 from termcolor import colored
 
 
 # Logger to UI
+#
+# Every category logs to the 'chat.<category>' logger. Records are put on a
+# queue and written by a background thread, so the caller never waits for
+# the terminal or the file. The handlers are set up once per process, by the
+# first Logger(). Levels and categories are gated before the message is
+# formatted: LOG_LEVEL is the lowest level written, LOG_CATEGORIES limits the
+# categories (all when empty) and LOG_JSON names a file that gets every
+# record as a line of JSON as well.
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+ERROR = logging.ERROR
+
+# category -> color on the terminal, or the variable that sets it
+CATEGORIES = {
+    'client': 'CLIENT_COLOR',
+    'broadcast': 'BROADCAST_COLOR',
+    'replica': 'REPLICA_COLOR',
+    'sys': 'magenta',
+    'election': 'blue',
+    'error': 'red',
+}
+_DEFAULT_COLORS = {'CLIENT_COLOR': 'green', 'BROADCAST_COLOR': 'yellow',
+                   'REPLICA_COLOR': 'cyan'}
+
+_lock = threading.Lock()
+_pipeline = None
+
+
+class _ConsoleFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__()
+        self.colors = {}
+        for category, color in CATEGORIES.items():
+            if color in _DEFAULT_COLORS:
+                color = (os.getenv(color) or _DEFAULT_COLORS[color]).lower()
+            self.colors[category] = color
+
+    def format(self, record):
+        category = record.name.rsplit('.', 1)[-1]
+        return colored('{}: {}'.format(category.upper(), record.getMessage()),
+                       self.colors.get(category))
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps({
+            'time': record.created,
+            'level': record.levelname,
+            'category': record.name.rsplit('.', 1)[-1],
+            'pid': record.process,
+            'message': record.getMessage(),
+        })
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Logger formats the message itself, so the record goes on the queue
+        # as it is. With the stdout of the caller, redirecting it still works
+        # like it did for print although the record is written later
+        record.stdout = sys.stdout
+        return record
+
+
+class _ConsoleHandler(logging.StreamHandler):
+    def emit(self, record):
+        self.stream = getattr(record, 'stdout', sys.stdout)
+        super().emit(record)
+
+
+class _Pipeline():
+    # The queue, the handler that fills it and the thread that drains it
+    def __init__(self):
+        level = os.getenv('LOG_LEVEL') or 'INFO'
+        self.level = logging.getLevelName(level.upper())
+        if not isinstance(self.level, int):
+            raise ValueError('Unknown LOG_LEVEL {}'.format(level))
+        categories = [name.strip() for name in (os.getenv('LOG_CATEGORIES') or '').split(',')
+                      if name.strip()]
+        self.categories = set(categories or CATEGORIES)
+
+        console = _ConsoleHandler(sys.stdout)
+        console.setFormatter(_ConsoleFormatter())
+        self.handlers = [console]
+        path = os.getenv('LOG_JSON')
+        if path:
+            sink = logging.FileHandler(path)
+            sink.setFormatter(_JsonFormatter())
+            self.handlers.append(sink)
+
+        self.queue_handler = _QueueHandler(queue.Queue())
+        root = logging.getLogger('chat')
+        root.handlers = [self.queue_handler]
+        root.setLevel(self.level)
+        # The root logger of the application has handlers of its own
+        root.propagate = False
+        self.listener = None
+        self.start()
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.queue_handler.queue, *self.handlers)
+        self.listener.start()
+
+    def after_fork(self):
+        # The writer thread does not survive a fork, the child gets its own
+        self.queue_handler.queue = queue.Queue()
+        self.start()
+
+    def flush(self):
+        self.queue_handler.queue.join()
+
+    def stop(self):
+        # Writes what is left on the queue
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+def _setup():
+    global _pipeline
+    with _lock:
+        if _pipeline is None:
+            just_fix_windows_console()
+            _pipeline = _Pipeline()
+            atexit.register(_stop)
+            # A multiprocessing child that was not forked, see below
+            if multiprocessing.parent_process() is not None:
+                _stop_at_exit()
+    return _pipeline
+
+
+def _after_fork():
+    if _pipeline is not None:
+        _pipeline.after_fork()
+
+
+def _stop_at_exit():
+    # Runs last among the finalizers of the exiting child
+    multiprocessing.util.Finalize(None, _stop, exitpriority=-100)
+
+
+def _stop():
+    if _pipeline is not None:
+        _pipeline.stop()
+
+
+# multiprocessing children leave with os._exit, which skips atexit, so they
+# stop the writer on their way out instead
+multiprocessing.util.register_after_fork(_stop_at_exit, lambda stop_at_exit: stop_at_exit())
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def flush():
+    # Waits until the records logged so far are written
+    if _pipeline is not None:
+        _pipeline.flush()
+
 
 class Logger:
     def __init__(self):
-        # use Colorama to make Termcolor work on Windows too
-        just_fix_windows_console()
-
-        logging.basicConfig(level=logging.INFO)
-        client_logger = logging.getLogger('client')
-        client_logger.setLevel(logging.INFO)
-        self.client_color = os.getenv("CLIENT_COLOR", "green")
-        formatter = logging.Formatter(
-            f"{Fore}{self.client_color}client: %(message)s")
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-        client_logger.addHandler(console_handler)
-        self._client_logger = client_logger
-
-        broadcast_logger = logging.getLogger('broadcast')
-        broadcast_logger.setLevel(logging.INFO)
-        self.broadcast_color = os.getenv("BROADCAST_COLOR", "yellow")
-        formatter = logging.Formatter(
-            f"{Fore}{self.broadcast_color}broadcast: %(message)s")
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-        broadcast_logger.addHandler(console_handler)
-        self._broadcast_logger = broadcast_logger
-
-        replica_logger = logging.getLogger('replica')
-        replica_logger.setLevel(logging.INFO)
-        self.replica_color = os.getenv("REPLICA_COLOR", "cyan")
-        formatter = logging.Formatter(
-            f"{Fore}{self.replica_color}replica: %(message)s")
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-        self._replica_logger = replica_logger
-
-    def log_client(self, message):
-        self._client_logger.info(message)
-        print(colored(f"CLIENT: {message}", self.client_color))
-
-    def log_broadcast(self, message):
-        self._broadcast_logger.info(message)
-        print(colored(f"BROADCAST: {message}", self.broadcast_color))
-
-    def log_replica(self, message):
-        self._replica_logger.info(message)
-        print(colored(f"REPLICA: {message}", self.replica_color))
-
-    def log_sys(self, message):
-        print(colored(f"SYSTEM: {message}", "magenta"))
-
-    def log_error(self, message):
-        print(colored(f"ERROR: {message}", "red"))
-
-    def log_election(self, message):
-        print(colored(f"ELECTION: {message}", "blue"))
+        pipeline = _setup()
+        self._loggers = {category: logging.getLogger('chat.' + category)
+                         for category in CATEGORIES}
+        # category -> lowest level written, categories left out write nothing
+        self._levels = {category: pipeline.level if category in pipeline.categories
+                        else logging.CRITICAL + 1 for category in CATEGORIES}
+
+    def enabled(self, category, level=INFO):
+        return level >= self._levels[category]
+
+    def log(self, category, level, message, *args):
+        # The message is formatted with args only when it is written
+        if level < self._levels[category]:
+            return
+        if args:
+            message = message.format(*args)
+        # Without the stack walk of Logger.log for the caller, which would
+        # name the log_* method anyway
+        logger = self._loggers[category]
+        logger.handle(logger.makeRecord(logger.name, level, '', 0, message, None, None))
+
+    def debug(self, category, message, *args):
+        self.log(category, DEBUG, message, *args)
+
+    def log_client(self, message, *args):
+        self.log('client', INFO, message, *args)
+
+    def log_broadcast(self, message, *args):
+        self.log('broadcast', INFO, message, *args)
+
+    def log_replica(self, message, *args):
+        self.log('replica', INFO, message, *args)
+
+    def log_sys(self, message, *args):
+        self.log('sys', INFO, message, *args)
+
+    def log_error(self, message, *args):
+        self.log('error', ERROR, message, *args)
+
+    def log_election(self, message, *args):
+        self.log('election', INFO, message, *args)
 
     def log_client_message(self, message):
+        # Chat output of the client, printed right away in between the prompt
         print(colored(f"{message}", "green"))
@@ -0,0 +1,402 @@
+from multiprocessing import Lock
+from multiprocessing.shared_memory import SharedMemory
+import struct
+import time
+
+from lib.address import Address
+
+# Membership table shared by all processes of a server.
+#
+# The table is two shared memory segments: a small header segment with a
+# fixed name, and a data segment of fixed size records named after the
+# epoch in the header. When the records run out the table grows: a writer
+# copies the records to a data segment twice the size and moves the header
+# to the next epoch. It shrinks the same way when it gets mostly empty,
+# never below the initial capacity.
+#
+#   header: magic (4) | version (2) | record size (2) | capacity (4)
+#           | count (4) | generation (8) | changes (8) | epoch (4)
+#           | minimum capacity (4)
+#   data:   capacity records, see RECORD
+#
+# Writers are serialized by a lock and make the generation odd while they
+# change records (a seqlock), so readers take consistent snapshots without
+# locking: read the generation, copy the records, and retry when the
+# generation was odd or changed in between. `changes` counts only adds and
+# removes and for members becoming or leaving DEAD; other updates leave it
+# alone, and with it the index of slots every process keeps. DEAD members stay in the table until they were gossiped, readers of
+# the live members use nodes().
+MAGIC = 0x4D454D42  # 'MEMB'
+VERSION = 3
+HEADER = struct.Struct('<IHHIIQQII')
+CAPACITY_OFFSET = 8
+COUNT_OFFSET = 12
+GENERATION_OFFSET = 16
+CHANGES_OFFSET = 24
+EPOCH_OFFSET = 32
+U32 = struct.Struct('<I')
+U64 = struct.Struct('<Q')
+HOST_SIZE = 64
+# status, gossip, incarnation, port, replica port, last seen, host,
+# replica host. Incarnation and gossip (transmissions left) are used by the
+# gossip membership, see lib/gossip.py. Last seen is the time of the last
+# contact or status change.
+RECORD = struct.Struct('<BxHIHHd{0}s{0}s'.format(HOST_SIZE))
+EMPTY_RECORD = bytes(RECORD.size)
+
+EMPTY = 0
+# Ordered, see GossipMember.apply
+ALIVE = 1
+SUSPECT = 2
+DEAD = 3
+
+
+class Member():
+    def __init__(self, address, replica_address, status=ALIVE, last_seen=0.0,
+                 incarnation=0, gossip=0):
+        self.address = address
+        self.replica_address = replica_address
+        self.status = status
+        self.last_seen = last_seen
+        self.incarnation = incarnation
+        self.gossip = gossip
+
+    def __repr__(self):
+        return 'Member({}, {}, status={}, incarnation={})'.format(
+            self.address, self.replica_address, self.status, self.incarnation)
+
+
+def _key(node):
+    return (node.address.host, node.address.port)
+
+
+class MembershipTable():
+    def __init__(self, name, capacity=None, create=False, lock=None):
+        # create=True makes a new table with room for `capacity` records,
+        # replacing a stale one of the same name. Processes that write must
+        # share the lock of the creator, e.g. by inheriting the table through
+        # fork.
+        self.name = name
+        self._lock = lock or Lock()
+        self._data = None
+        self._data_epoch = None
+        if create:
+            _unlink_stale(name)
+            self.shm = SharedMemory(name=name, create=True, size=HEADER.size)
+            self._data = _create_segment(_data_name(name, 0), capacity)
+            self._data_epoch = 0
+            HEADER.pack_into(self.shm.buf, 0, MAGIC, VERSION,
+                             RECORD.size, capacity, 0, 0, 0, 0, capacity)
+        else:
+            self.shm = SharedMemory(name=name)
+        magic, version, record_size, _, _, _, _, _, min_capacity = HEADER.unpack_from(
+            self.shm.buf, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise ValueError('{} is not a membership table'.format(name))
+        # Never shrinks below the initial capacity
+        self.min_capacity = min_capacity
+        # Per process index of node key -> slot and the free slots, valid
+        # while changes is _index_changes. Updates of a record leave the slots
+        # alone, so heartbeats and gossip do not invalidate it.
+        self._index = {}
+        self._free = []
+        self._index_changes = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = self.shm.name
+        state['_data'] = None
+        state['_data_epoch'] = None
+        state['_index'] = {}
+        state['_free'] = []
+        state['_index_changes'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = SharedMemory(name=state['shm'])
+
+    @property
+    def generation(self):
+        return U64.unpack_from(self.shm.buf, GENERATION_OFFSET)[0]
+
+    @property
+    def changes(self):
+        # Number of membership changes so far, see above
+        return U64.unpack_from(self.shm.buf, CHANGES_OFFSET)[0]
+
+    @property
+    def capacity(self):
+        return U32.unpack_from(self.shm.buf, CAPACITY_OFFSET)[0]
+
+    @property
+    def epoch(self):
+        return U32.unpack_from(self.shm.buf, EPOCH_OFFSET)[0]
+
+    def __len__(self):
+        return U32.unpack_from(self.shm.buf, COUNT_OFFSET)[0]
+
+    def __contains__(self, node):
+        return self.get(node) is not None
+
+    def nbytes(self):
+        # Shared memory used by the table
+        return self.shm.size + self._records().nbytes
+
+    def _records(self):
+        # Data segment of the current epoch, attached on first use
+        epoch = self.epoch
+        if epoch != self._data_epoch:
+            if self._data is not None:
+                self._data.close()
+            self._data = SharedMemory(name=_data_name(self.name, epoch))
+            self._data_epoch = epoch
+        return self._data.buf
+
+    # ________readers_________________
+
+    def snapshot(self):
+        # Consistent copy of all used records as {key: (slot, record tuple)}
+        generation, _, members = self._snapshot()
+        return generation, members
+
+    def _snapshot(self):
+        # Also the changes the copy is of
+        while True:
+            before = self.generation
+            if before & 1:
+                time.sleep(0)
+                continue
+            changes = self.changes
+            try:
+                records = bytes(self._records()[:self.capacity * RECORD.size])
+            except FileNotFoundError:
+                # The table was resized again while attaching
+                continue
+            if self.generation == before:
+                break
+        members = {}
+        for slot, record in enumerate(RECORD.iter_unpack(records)):
+            if record[0] != EMPTY:
+                members[(_host(record[6]), record[3])] = (slot, record)
+        return before, changes, members
+
+    def _slots(self):
+        if self.changes != self._index_changes:
+            _, changes, members = self._snapshot()
+            self._index = {key: slot for key, (slot, _) in members.items()}
+            used = set(self._index.values())
+            self._free = [slot for slot in range(self.capacity - 1, -1, -1)
+                          if slot not in used]
+            self._index_changes = changes
+        return self._index
+
+    def members(self):
+        _, members = self.snapshot()
+        return [_member(record) for _, record in members.values()]
+
+    def nodes(self):
+        # Nodes of the members that are not DEAD
+        from lib.election import Node
+        return [Node(address=m.address, replica_address=m.replica_address)
+                for m in self.members() if m.status != DEAD]
+
+    def get(self, node):
+        # O(1) while no member is added or removed. The record is read under
+        # the seqlock: when nothing was written meanwhile, the index was
+        # current and the record whole.
+        key = _key(node)
+        while True:
+            generation = self.generation
+            if generation & 1:
+                time.sleep(0)
+                continue
+            slot = self._slots().get(key)
+            try:
+                record = None if slot is None else RECORD.unpack_from(
+                    self._records(), slot * RECORD.size)
+            except (FileNotFoundError, struct.error):
+                continue
+            if self.generation == generation:
+                return None if record is None else _member(record)
+
+    # ________writers_________________
+    #
+    # Writers hold the lock, so nobody else changes the table between their
+    # _begin and _end. They keep their own index up to date instead of
+    # rebuilding it after every write.
+
+    def add(self, node, status=ALIVE, last_seen=None, incarnation=0, gossip=0) -> bool:
+        # Returns False when the node is already a member
+        with self._lock:
+            slots = self._slots()
+            if _key(node) in slots:
+                return False
+            self._begin()
+            if not self._free:
+                self._resize(self.capacity * 2)
+                slots = self._index
+            slot = self._free.pop()
+            RECORD.pack_into(self._records(), slot * RECORD.size,
+                             status, gossip, incarnation,
+                             node.address.port, node.replica_address.port,
+                             time.time() if last_seen is None else last_seen,
+                             str.encode(node.address.host),
+                             str.encode(node.replica_address.host))
+            slots[_key(node)] = slot
+            self._set_count(len(self) + 1)
+            self._end()
+            return True
+
+    def remove(self, node) -> bool:
+        with self._lock:
+            slots = self._slots()
+            slot = slots.pop(_key(node), None)
+            if slot is None:
+                return False
+            self._begin()
+            offset = slot * RECORD.size
+            self._records()[offset:offset + RECORD.size] = EMPTY_RECORD
+            self._free.append(slot)
+            self._set_count(len(self) - 1)
+            if len(self) * 4 <= self.capacity and self.capacity // 2 >= self.min_capacity:
+                self._resize(self.capacity // 2)
+            self._end()
+            return True
+
+    def update(self, node, status=None, last_seen=None, incarnation=None,
+               gossip=None) -> bool:
+        with self._lock:
+            slot = self._slots().get(_key(node))
+            if slot is None:
+                return False
+            records = self._records()
+            offset = slot * RECORD.size
+            record = RECORD.unpack_from(records, offset)
+            self._begin()
+            self._pack(records, offset, record, status, last_seen, incarnation, gossip)
+            if status is not None and (status == DEAD) != (record[0] == DEAD):
+                self._changed()
+            self._end()
+            return True
+
+    def piggyback(self, limit):
+        # Up to `limit` members with gossip transmissions left, most left
+        # first. Counts one transmission for each.
+        with self._lock:
+            _, members = self.snapshot()
+            chosen = sorted((entry for entry in members.values() if entry[1][1] > 0),
+                            key=lambda entry: -entry[1][1])[:limit]
+            if not chosen:
+                return []
+            records = self._records()
+            self._begin()
+            for slot, record in chosen:
+                self._pack(records, slot * RECORD.size, record, gossip=record[1] - 1)
+            self._end()
+            return [_member(record) for _, record in chosen]
+
+    def _pack(self, records, offset, record, status=None, last_seen=None,
+              incarnation=None, gossip=None):
+        RECORD.pack_into(records, offset,
+                         record[0] if status is None else status,
+                         record[1] if gossip is None else gossip,
+                         record[2] if incarnation is None else incarnation,
+                         record[3], record[4],
+                         record[5] if last_seen is None else last_seen,
+                         record[6], record[7])
+
+    def touch(self, node, now=None):
+        return self.update(node, last_seen=time.time() if now is None else now)
+
+    def _resize(self, capacity):
+        # Moves the used records to the front of a new data segment of the
+        # next epoch. Called between _begin and _end.
+        old = self._records()
+        epoch = self.epoch + 1
+        data = _create_segment(_data_name(self.name, epoch), capacity)
+        index = {}
+        for slot, key in enumerate(sorted(self._index, key=self._index.get)):
+            offset = self._index[key] * RECORD.size
+            data.buf[slot * RECORD.size:(slot + 1) * RECORD.size] = \
+                old[offset:offset + RECORD.size]
+            index[key] = slot
+        self._index = index
+        self._free = list(range(capacity - 1, len(index) - 1, -1))
+        U32.pack_into(self.shm.buf, CAPACITY_OFFSET, capacity)
+        U32.pack_into(self.shm.buf, EPOCH_OFFSET, epoch)
+        # Processes still attached to the old segment keep their mapping
+        # until they notice the new epoch
+        self._data.close()
+        self._data.unlink()
+        self._data = data
+        self._data_epoch = epoch
+
+    def _set_count(self, count):
+        U32.pack_into(self.shm.buf, COUNT_OFFSET, count)
+        self._changed()
+
+    def _changed(self):
+        U64.pack_into(self.shm.buf, CHANGES_OFFSET, self.changes + 1)
+
+    def _begin(self):
+        U64.pack_into(self.shm.buf, GENERATION_OFFSET, self.generation + 1)
+
+    def _end(self):
+        U64.pack_into(self.shm.buf, GENERATION_OFFSET, self.generation + 1)
+        self._index_changes = self.changes
+
+    def close(self):
+        if self.shm.buf is None:
+            return  # Already closed
+        # Remembers the epoch, the data segment may still be unlinked
+        self._data_epoch = self.epoch
+        if self._data is not None:
+            self._data.close()
+        self.shm.close()
+
+    def unlink(self):
+        epoch = self.epoch if self.shm.buf is not None else self._data_epoch
+        try:
+            SharedMemory(name=_data_name(self.name, epoch)).unlink()
+        except FileNotFoundError:
+            pass
+        self.shm.unlink()
+
+
+def _data_name(name, epoch):
+    return '{}_{}'.format(name, epoch)
+
+
+def _create_segment(name, capacity):
+    data = SharedMemory(name=name, create=True, size=max(1, capacity) * RECORD.size)
+    data.buf[:] = bytes(data.size)
+    return data
+
+
+def _unlink_stale(name):
+    # Header and data segment left behind by a crashed server
+    try:
+        shm = SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    try:
+        if shm.size >= HEADER.size:
+            try:
+                epoch = U32.unpack_from(shm.buf, EPOCH_OFFSET)[0]
+                SharedMemory(name=_data_name(name, epoch)).unlink()
+            except FileNotFoundError:
+                pass
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _host(raw):
+    return raw.rstrip(b'\0').decode()
+
+
+def _member(record):
+    status, gossip, incarnation, port, replica_port, last_seen, host, replica_host = record
+    return Member(Address(_host(host), port), Address(_host(replica_host), replica_port),
+                  status, last_seen, incarnation, gossip)
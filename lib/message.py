@@ -1,6 +1,9 @@
+import base64
 from enum import Enum
 import json
 
+from lib.trace import Trace
+
 
 class MessageType(str, Enum):
     MESSAGE = "MESSAGE"
@@ -16,6 +19,13 @@ class MessageType(str, Enum):
     RES_LEADER = "LEADER"
     REMOVE_NODE = "REMOVE_NODE"
     REMOVE_NODE_RES = "REMOVE_NODE_RESPONSE"
+    # Gossip membership, see lib/gossip.py
+    GOSSIP_PING = "GOSSIP_PING"
+    GOSSIP_PING_REQ = "GOSSIP_PING_REQUEST"  # ping a member for the sender
+    GOSSIP_ACK = "GOSSIP_ACK"
+    # Chat log replication, see lib/replication.py
+    REPLICATE_REQ = "REPLICATE_REQUEST"
+    REPLICATE_RES = "REPLICATE_RESPONSE"
 
     def toJSON(self):
         return self.name
@@ -26,23 +36,40 @@ class Message(object):
     message = None
     host = ''
     port = ''
-
-    def __init__(self, message, type, host='', port=''):
+    # Set on replica requests and echoed on their responses, see lib/channel.py
+    correlation_id = None
+    # Vector clock entries of the sender that changed, see lib/clock.py
+    clock = None
+    # Trace of a sampled chat message or election round, see lib/trace.py
+    trace = None
+
+    def __init__(self, message, type, host='', port='', correlation_id=None, clock=None,
+                 trace=None):
         self.message = message
         self.type = type
         self.host = host
         self.port = port
+        self.correlation_id = correlation_id
+        self.clock = clock
+        self.trace = trace
 
     def __str__(self):
         return 'Message: {} Type: {} Host: {} Port: {}'.format(self.message, self.type, self.host, self.port)
 
     def toJSON(self):
-        return json.dumps({
+        data = {
             'message': self.message,
             'type': self.type,
             'host': self.host,
             'port': self.port
-        })
+        }
+        if self.correlation_id is not None:
+            data['correlation_id'] = self.correlation_id
+        if self.clock is not None:
+            data['clock'] = base64.b64encode(self.clock).decode()
+        if self.trace is not None:
+            data['trace'] = self.trace.toJSON()
+        return json.dumps(data)
 
 
 class MessageEncoder(json.JSONEncoder):
@@ -55,33 +82,61 @@ class MessageEncoder(json.JSONEncoder):
 class MessageDecoder(json.JSONDecoder):
     def decode(self, s):
         data = json.loads(s)
-        return Message(data['message'], data['type'], data['host'], data['port'])
+        clock = data.get('clock')
+        trace = data.get('trace')
+        return Message(data['message'], data['type'], data['host'], data['port'],
+                       data.get('correlation_id'),
+                       base64.b64decode(clock) if clock is not None else None,
+                       Trace.fromJSON(trace) if trace is not None else None)
 
 
 class ChatMessageType(str, Enum):
-    JOIN = "JOIN"
+    JOIN = "JOIN"  # join a room, answered with JOIN once joined
     LEAVE = "LEAVE"
     MESSAGE = "MESSAGE"
+    # The room is served by the server at the address in the message, see
+    # lib/rooms.py
+    REDIRECT = "REDIRECT"
 
     def toJSON(self):
         return self.name
 
 
 class ChatMessage:
-    def __init__(self, sender: str, message: str):
+    def __init__(self, sender: str, message: str, trace=None,
+                 type=ChatMessageType.MESSAGE, room=None):
         self.sender = sender
         self.message = message
+        # Trace of a sampled message, see lib/trace.py
+        self.trace = trace
+        self.type = type
+        # None is the room of the clients that joined none
+        self.room = room
 
     def __str__(self):
         return 'Message: {} Sender: {}'.format(self.message, self.sender)
 
     def toJSON(self):
-        return json.dumps({
+        data = {
             'message': self.message,
             'sender': self.sender
-        })
+        }
+        if self.trace is not None:
+            data['trace'] = self.trace.toJSON()
+        if self.type != 'MESSAGE':
+            data['type'] = self.type
+        if self.room is not None:
+            data['room'] = self.room
+        return json.dumps(data)
 
     @staticmethod
     def fromJSON(data: str):
         data = json.loads(data)
-        return ChatMessage(data['message'], data['sender'])
+        trace = data.get('trace')
+        message = ChatMessage(sender=data['sender'], message=data['message'],
+                              trace=Trace.fromJSON(trace) if trace is not None else None)
+        # Most messages have neither, the defaults are cheaper than the enum
+        if 'type' in data:
+            message.type = ChatMessageType(data['type'])
+        message.room = data.get('room')
+        return message
@@ -0,0 +1,284 @@
+from bisect import bisect_left
+from multiprocessing import Lock
+from multiprocessing.shared_memory import SharedMemory
+import mmap
+import os
+import struct
+import weakref
+
+# Metrics of a server, counted by all its processes.
+#
+# The values live in one shared memory segment with a row of slots per
+# process. A process claims a free row, or the row of an exited process,
+# the first time it writes, and then adds to its own row without locking.
+# Readers sum the rows. Metrics are registered before the server forks, so
+# every process knows the slots of every metric.
+#
+#   header: magic (4) | version (2) | pad (2) | rows (4) | slots (4)
+#   pids:   rows int64, the process that writes the row, 0 when free
+#   values: rows * slots float64
+#
+# Counters only go up. Gauges add up over the processes, so inc() and dec()
+# work from any process and set() only from one. Histograms have fixed
+# buckets, a slot per bucket, one for values above the last and one for the
+# sum. A counter of an exited process stays counted when its row is reused,
+# the next process adds to it.
+MAGIC = 0x4D455452  # 'METR'
+VERSION = 1
+HEADER = struct.Struct('<IHxxII')
+# Seconds, from half a millisecond to ten seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+_registries = weakref.WeakSet()
+
+
+class Counter():
+    type = 'counter'
+
+    def __init__(self, registry, name, help, slot):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.slot = slot
+        self.size = 1
+
+    def inc(self, amount=1):
+        values = self._registry.values or self._registry.claim()
+        values[self.slot] += amount
+
+    def value(self, totals):
+        return totals[self.slot]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1):
+        values = self._registry.values or self._registry.claim()
+        values[self.slot] -= amount
+
+    def set(self, value):
+        values = self._registry.values or self._registry.claim()
+        values[self.slot] = value
+
+
+class Histogram():
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, slot, buckets):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.slot = slot
+        self.buckets = tuple(buckets)
+        # A slot per bucket, one above the last bucket and the sum
+        self.size = len(self.buckets) + 2
+
+    def observe(self, value):
+        values = self._registry.values or self._registry.claim()
+        values[self.slot + bisect_left(self.buckets, value)] += 1
+        values[self.slot + self.size - 1] += value
+
+    def value(self, totals):
+        # Cumulative count per upper bound, the sum and the count
+        counts = []
+        count = 0
+        for i in range(len(self.buckets) + 1):
+            count += totals[self.slot + i]
+            counts.append(count)
+        return {'buckets': list(zip(self.buckets + (float('inf'),), counts)),
+                'sum': totals[self.slot + self.size - 1], 'count': count}
+
+
+class Registry():
+    def __init__(self, name=None, create=False, processes=None, slots=None, lock=None):
+        # Without a name the values are in anonymous shared memory, shared
+        # with the processes forked afterwards. create=True makes a new
+        # segment, replacing a stale one of the same name.
+        self.name = name
+        self._lock = lock or Lock()
+        self._metrics = {}
+        self._next_slot = 0
+        self.shm = None
+        if name is None or create:
+            self.rows = int(processes or os.getenv('METRICS_PROCESSES') or 64)
+            self.slots = int(slots or os.getenv('METRICS_SLOTS') or 512)
+            size = HEADER.size + self.rows * 8 + self.rows * self.slots * 8
+            if name is None:
+                self._map = mmap.mmap(-1, size)
+                buf = memoryview(self._map)
+            else:
+                _unlink_stale(name)
+                self.shm = SharedMemory(name=name, create=True, size=size)
+                buf = self.shm.buf
+                buf[:size] = bytes(size)
+            HEADER.pack_into(buf, 0, MAGIC, VERSION, self.rows, self.slots)
+        else:
+            self.shm = SharedMemory(name=name)
+            buf = self.shm.buf
+            magic, version, self.rows, self.slots = HEADER.unpack_from(buf, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('{} is not a metrics registry'.format(name))
+        values_offset = HEADER.size + self.rows * 8
+        self._pids = buf[HEADER.size:values_offset].cast('q')
+        self._values = buf[values_offset:values_offset + self.rows * self.slots * 8].cast('d')
+        # The row of this process, claimed on the first write
+        self.values = None
+        _registries.add(self)
+
+    # ________registration_________________
+
+    def counter(self, name, help=''):
+        return self._register(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._register(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, buckets)
+
+    def _register(self, kind, name, help, *args):
+        # Registering a metric again returns the one there is
+        metric = self._metrics.get(name)
+        if metric is not None:
+            if metric.type != kind.type:
+                raise ValueError('{} is a {}'.format(name, metric.type))
+            return metric
+        metric = kind(self, name, help, self._next_slot, *args)
+        if self._next_slot + metric.size > self.slots:
+            raise ValueError('No slots left for {}, raise METRICS_SLOTS'.format(name))
+        self._next_slot += metric.size
+        self._metrics[name] = metric
+        return metric
+
+    # ________writing_________________
+
+    def claim(self):
+        # The row of this process: its own, a free one or one of an exited
+        # process. With every row taken by a live process the last row is
+        # shared, adds to it may then get lost.
+        pid = os.getpid()
+        with self._lock:
+            free = None
+            for row in range(self.rows):
+                owner = self._pids[row]
+                if owner == pid:
+                    free = row
+                    break
+                if free is None and (owner == 0 or not _alive(owner)):
+                    free = row
+            if free is None:
+                free = self.rows - 1
+            else:
+                self._pids[free] = pid
+        self.values = self._values[free * self.slots:(free + 1) * self.slots]
+        return self.values
+
+    def _after_fork(self):
+        self.values = None
+
+    # ________reading_________________
+
+    def totals(self):
+        # Sum of every slot over the rows in use
+        totals = [0.0] * self._next_slot
+        for row in range(self.rows):
+            if self._pids[row] == 0:
+                continue
+            values = self._values[row * self.slots:row * self.slots + self._next_slot]
+            for slot, value in enumerate(values):
+                totals[slot] += value
+        return totals
+
+    def metrics(self):
+        return list(self._metrics.values())
+
+    def collect(self):
+        totals = self.totals()
+        return {metric.name: metric.value(totals) for metric in self._metrics.values()}
+
+    def close(self):
+        if self.shm is None or self.shm.buf is None:
+            return
+        # The views keep the segment mapped
+        if self.values is not None:
+            self.values.release()
+            self.values = None
+        self._pids.release()
+        self._values.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def prometheus(registry):
+    # The metrics in the Prometheus text format
+    totals = registry.totals()
+    lines = []
+    for metric in registry.metrics():
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        value = metric.value(totals)
+        if metric.type != 'histogram':
+            lines.append('{} {}'.format(metric.name, _number(value)))
+            continue
+        for bound, count in value['buckets']:
+            lines.append('{}_bucket{{le="{}"}} {}'.format(
+                metric.name, '+Inf' if bound == float('inf') else _number(bound), _number(count)))
+        lines.append('{}_sum {}'.format(metric.name, _number(value['sum'])))
+        lines.append('{}_count {}'.format(metric.name, _number(value['count'])))
+    return '\n'.join(lines) + '\n'
+
+
+_registry = None
+
+
+def registry():
+    # The registry of this process, private until setup() shares one
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+    return _registry
+
+
+def setup(name):
+    # Makes the named registry the one of this process, before the metrics
+    # are registered and the server forks
+    global _registry
+    _registry = Registry(name, create=True)
+    return _registry
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _unlink_stale(name):
+    # Segment left behind by a crashed server
+    try:
+        shm = SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def _after_fork():
+    for registry in list(_registries):
+        registry._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
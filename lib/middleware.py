@@ -1,4 +1,5 @@
 import socket
+import time
 
 
 class Middleware:
@@ -10,3 +11,28 @@ class Middleware:
         response = self.app(environ, start_response)
         # Do something with the response
         return response
+
+
+# Counts the requests to the app and times them, errors are the responses
+# with a status of 400 and up
+class TimingMiddleware(Middleware):
+    def __init__(self, app, registry, prefix='admin'):
+        super().__init__(app)
+        self.requests = registry.counter(prefix + '_requests_total', 'Requests served')
+        self.errors = registry.counter(prefix + '_errors_total', 'Requests answered with an error')
+        self.seconds = registry.histogram(prefix + '_request_seconds', 'Time to answer a request')
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+
+        def timed_start_response(status, headers, exc_info=None):
+            if int(status.split(' ', 1)[0]) >= 400:
+                self.errors.inc()
+            return start_response(status, headers, exc_info)
+
+        try:
+            # Joined here, so the time includes building the body
+            return [b''.join(self.app(environ, timed_start_response))]
+        finally:
+            self.requests.inc()
+            self.seconds.observe(time.perf_counter() - started)
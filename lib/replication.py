@@ -0,0 +1,294 @@
+from collections import deque
+from concurrent.futures import Future
+import itertools
+import os
+import threading
+
+from lib.log_store import MemoryLog
+from lib.logger import Logger
+from lib.message import ChatMessage, Message, MessageType
+
+
+# Acknowledgement modes, when an entry counts as committed
+ACKS_LEADER = 'leader'  # appended by the leader, replication is asynchronous
+ACKS_ONE = 'one'  # held by one follower
+ACKS_QUORUM = 'quorum'  # held by a majority of all members, the leader included
+ACKS_ALL = 'all'  # held by every follower
+ACK_MODES = (ACKS_LEADER, ACKS_ONE, ACKS_QUORUM, ACKS_ALL)
+
+# Most bytes of one chat log entry and of the entries of one batch. The JSON
+# escaping of the legacy wire format grows them up to 4 times, and the
+# REPLICATE_REQ still has to fit in one datagram.
+MAX_ENTRY_BYTES = 12000
+
+
+# Ordered chat log. Entries are (epoch, data) with indexes from 1, data is
+# the JSON of a ChatMessage and epoch the election epoch of the leader that
+# appended it. The records are kept by a store of lib/log_store.py, in memory
+# or on disk.
+class ChatLog():
+    def __init__(self, store=None):
+        self.store = store if store is not None else MemoryLog()
+        self.commit_index = 0
+
+    def __len__(self):
+        return len(self.store)
+
+    def append(self, epoch, data):
+        return self.store.append(str.encode(data), epoch) + 1
+
+    def flush(self):
+        # Hands the appended entries to the operating system, so they
+        # survive a crash of the process
+        self.store.flush()
+
+    def epoch_at(self, index):
+        return self.store.read(index - 1)[0] if 0 < index <= len(self.store) else 0
+
+    def entries_from(self, index, max_entries, max_bytes):
+        # Up to max_entries entries from index on, at least one, and no more
+        # than max_bytes of data after the first
+        batch = []
+        size = 0
+        for _, epoch, _, data in itertools.islice(self.store.replay(index - 1), max_entries):
+            size += len(data)
+            if batch and size > max_bytes:
+                break
+            batch.append((epoch, data.decode()))
+        return batch
+
+    def truncate(self, length):
+        self.store.truncate(length)
+        self.commit_index = min(self.commit_index, length)
+
+    def replay(self, index=1):
+        # ChatMessages from index on
+        for _, _, _, data in self.store.replay(index - 1):
+            yield ChatMessage.fromJSON(data)
+
+    def replay_since(self, timestamp):
+        # ChatMessages appended at or after timestamp
+        return self.replay(self.store.offset_for_time(timestamp) + 1)
+
+
+class _Follower():
+    def __init__(self, node, next_index):
+        self.node = node
+        # Next entry to send, and the length of the log the follower
+        # acknowledged
+        self.next_index = next_index
+        self.match_index = 0
+        self.in_flight = 0
+        # Raised whenever the leader goes back to an earlier entry, failures
+        # of batches sent before are already handled then
+        self.generation = 0
+
+
+# Leader driven replication of the chat log to the other members.
+#
+# The leader appends every chat message to its log and ships the log in
+# batches (REPLICATE_REQ) of up to REPLICATION_BATCH entries and
+# REPLICATION_BATCH_BYTES bytes. Shipping is pipelined: up to
+# REPLICATION_WINDOW batches per follower are in flight at once, and the
+# entries appended while the window is full leave together in the next
+# batch, so batches grow with the load (group commit).
+#
+# Followers acknowledge cumulatively with the length of their log, so a lost
+# acknowledgement is covered by the next one. A lost batch is sent again
+# from the last acknowledged entry after its timeout (go-back-N), and a
+# follower that misses entries or holds entries of an older leader answers
+# with the length up to which it agrees, from where the leader sends again.
+#
+# An entry is committed once REPLICATION_ACKS members hold it, see
+# ACK_MODES. The followers of one leader are the other members of the ring.
+#
+# Batches are sent as single datagrams, so entries over REPLICATION_MAX_ENTRY
+# bytes are refused and batches hold no more than that, see MAX_ENTRY_BYTES.
+class ChatReplicator():
+    def __init__(self, node, membership, request, epoch, acks=None,
+                 window=None, batch=None, batch_bytes=None, log=None, max_entry=None):
+        self.node = node
+        self.nodes = membership
+        # request(message, address) sends a replica request and returns a
+        # Future of the response
+        self.request = request
+        # epoch() is the current election epoch
+        self.epoch = epoch
+        self.acks = (acks or os.getenv('REPLICATION_ACKS') or ACKS_QUORUM).lower()
+        if self.acks not in ACK_MODES:
+            raise ValueError('REPLICATION_ACKS must be one of {}'.format(', '.join(ACK_MODES)))
+        self.window = int(window or os.getenv('REPLICATION_WINDOW') or 4)
+        self.batch = int(batch or os.getenv('REPLICATION_BATCH') or 256)
+        self.max_entry = int(max_entry or os.getenv('REPLICATION_MAX_ENTRY') or MAX_ENTRY_BYTES)
+        self.batch_bytes = min(self.max_entry, int(
+            batch_bytes or os.getenv('REPLICATION_BATCH_BYTES') or 16384))
+
+        self.log = log if log is not None else ChatLog()
+        self._logger = Logger()
+        # Highest leader epoch seen as follower, older leaders are ignored
+        self.leader_epoch = 0
+        self._lock = threading.RLock()
+        self._followers = {}
+        self._followers_epoch = None
+        # (index, Future) of the appended entries not committed yet
+        self._waiting = deque()
+        self.batches_sent = 0
+        self.entries_sent = 0
+        self.retransmits = 0
+
+    # ________leader_________________
+
+    def append(self, data) -> Future:
+        # Appends a chat message, returns a Future of its index that is set
+        # once the entry is committed. Raises ValueError when the message is
+        # too large to replicate.
+        if len(str.encode(data)) > self.max_entry:
+            raise ValueError('Chat message of {} bytes, at most {} are replicated'.format(
+                len(str.encode(data)), self.max_entry))
+        future = Future()
+        with self._lock:
+            followers = self._current_followers()
+            index = self.log.append(self._followers_epoch, data)
+            self.log.flush()
+            self._waiting.append((index, future))
+            self._advance_commit()
+            for follower in followers:
+                self._ship(follower)
+        return future
+
+    def _current_followers(self):
+        # Followers of the current membership, a new epoch starts over
+        epoch = self.epoch()
+        if epoch != self._followers_epoch:
+            self._followers = {}
+            self._followers_epoch = epoch
+        followers = {}
+        for node in self.nodes.nodes():
+            if node == self.node:
+                continue
+            follower = self._followers.get(node.address)
+            if follower is None:
+                # Optimistic: assume the follower is up to date, it answers
+                # with its length otherwise
+                follower = _Follower(node, len(self.log) + 1)
+            followers[node.address] = follower
+        self._followers = followers
+        return list(followers.values())
+
+    def _ship(self, follower):
+        while follower.in_flight < self.window and follower.next_index <= len(self.log):
+            prev = follower.next_index - 1
+            entries = self.log.entries_from(follower.next_index, self.batch, self.batch_bytes)
+            body = {
+                'epoch': self._followers_epoch,
+                'prev': prev,
+                'prev_epoch': self.log.epoch_at(prev),
+                'entries': entries,
+                'commit': self.log.commit_index,
+            }
+            message = Message(message=body, type=MessageType.REPLICATE_REQ,
+                              host=self.node.address.host, port=self.node.address.port)
+            try:
+                future = self.request(message, follower.node.replica_address)
+            except OSError as e:
+                # Sent again with the next append or response
+                self._logger.log_error('Cannot replicate to {}: {}'.format(
+                    follower.node.replica_address, e))
+                return
+            follower.next_index += len(entries)
+            follower.in_flight += 1
+            self.batches_sent += 1
+            self.entries_sent += len(entries)
+            future.add_done_callback(
+                lambda future, follower=follower, generation=follower.generation:
+                self._on_response(follower, generation, future))
+
+    def _on_response(self, follower, generation, future):
+        try:
+            response = future.result()
+            reply = response.message if isinstance(response, Message) else None
+        except TimeoutError:
+            reply = None
+        with self._lock:
+            follower.in_flight -= 1
+            if follower is not self._followers.get(follower.node.address):
+                return  # Left the ring or the epoch is over
+            if isinstance(reply, dict) and reply.get('ok'):
+                follower.match_index = max(follower.match_index, reply['match'])
+                follower.next_index = max(follower.next_index, follower.match_index + 1)
+                self._advance_commit()
+            elif generation == follower.generation:
+                self.retransmits += 1
+                follower.generation += 1
+                if isinstance(reply, dict):
+                    # Missing or conflicting entries, reply['match'] is
+                    # where the follower may agree with us
+                    follower.match_index = min(follower.match_index, reply['match'])
+                    follower.next_index = min(reply['match'], len(self.log)) + 1
+                else:
+                    # Lost, send again from the last acknowledged entry
+                    follower.next_index = follower.match_index + 1
+            self._ship(follower)
+
+    def required_acks(self):
+        # Followers that must hold an entry for it to commit
+        followers = len(self._followers)
+        if self.acks == ACKS_LEADER or followers == 0:
+            return 0
+        if self.acks == ACKS_ONE:
+            return 1
+        if self.acks == ACKS_QUORUM:
+            return (followers + 1) // 2
+        return followers
+
+    def _advance_commit(self):
+        required = self.required_acks()
+        if required == 0:
+            commit = len(self.log)
+        else:
+            matches = sorted((follower.match_index for follower in self._followers.values()),
+                             reverse=True)
+            commit = matches[required - 1]
+        self.log.commit_index = max(self.log.commit_index, min(commit, len(self.log)))
+        while self._waiting and self._waiting[0][0] <= self.log.commit_index:
+            index, future = self._waiting.popleft()
+            future.set_result(index)
+
+    # ________follower_________________
+
+    def receive(self, body):
+        # Handles a REPLICATE_REQ, returns the reply or None for a request
+        # of an older leader
+        with self._lock:
+            if body['epoch'] < self.leader_epoch:
+                return None
+            self.leader_epoch = body['epoch']
+            prev = body['prev']
+            if prev > len(self.log) or self.log.epoch_at(prev) != body['prev_epoch']:
+                # Missing entries, or ours conflict: agree up to before prev
+                return {'ok': False, 'match': min(len(self.log), prev - 1)}
+            for i, (epoch, data) in enumerate(body['entries']):
+                index = prev + 1 + i
+                if index <= len(self.log):
+                    if self.log.epoch_at(index) == epoch:
+                        continue  # Already have it, e.g. a retransmission
+                    # Entries of an older leader that were never committed
+                    self.log.truncate(index - 1)
+                self.log.append(epoch, data)
+            self.log.flush()
+            match = prev + len(body['entries'])
+            self.log.commit_index = max(self.log.commit_index, min(body['commit'], match))
+            return {'ok': True, 'match': match}
+
+    def stats(self):
+        with self._lock:
+            return {
+                'length': len(self.log),
+                'commit_index': self.log.commit_index,
+                'batches_sent': self.batches_sent,
+                'entries_sent': self.entries_sent,
+                'retransmits': self.retransmits,
+            }
+
+    def close(self):
+        self.log.store.close()
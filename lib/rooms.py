@@ -0,0 +1,75 @@
+from bisect import bisect
+import hashlib
+import os
+
+# Ownership of chat rooms by the ring members.
+#
+# Every member is put on a hash ring at ROOM_VNODES points (virtual nodes),
+# and a room belongs to the member of the first point after the hash of its
+# name. With many points per member the rooms spread evenly over the
+# members, and a member that joins or leaves only takes or gives away the
+# rooms next to its own points, about 1/N of them. Hashes are 64 bit
+# BLAKE2b of the names, the same on every server, unlike hash().
+#
+# The chat server of a room holds all of its clients, so messages to a room
+# fan out on one server. A client that joins a room on another server is
+# redirected to the owner, see AsyncChatServer.join.
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+def room_key(room):
+    # Room as a number for shared memory, 0 for no room
+    return 0 if room is None else _hash(room) | 1
+
+
+class HashRing():
+    def __init__(self, nodes=(), vnodes=None):
+        # nodes: the chat addresses of the members
+        self.vnodes = int(vnodes or os.getenv('ROOM_VNODES') or 256)
+        self.nodes = list(nodes)
+        points = sorted(((_hash('{}#{}'.format(node, i)), node)
+                         for node in self.nodes for i in range(self.vnodes)),
+                        key=lambda point: point[0])
+        self._hashes = [point[0] for point in points]
+        self._owners = [point[1] for point in points]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def owner(self, room):
+        # The member the room belongs to, None when the ring is empty
+        if not self._hashes:
+            return None
+        i = bisect(self._hashes, _hash(room))
+        return self._owners[i if i < len(self._owners) else 0]
+
+
+# Room ring of the members a RingMember knows, rebuilt on its next use after
+# a membership change like the ring view of the member
+class RoomDirectory():
+    def __init__(self, member, vnodes=None):
+        self.member = member
+        # Chat address of this server
+        self.address = member.address
+        self.vnodes = vnodes
+        self._ring = HashRing(vnodes=vnodes)
+        self._generation = None
+
+    def ring(self):
+        generation = self.member.nodes.changes
+        if generation != self._generation:
+            self._ring = HashRing([node.address for node in self.member.sorted_ring()],
+                                  self.vnodes)
+            self._generation = generation
+        return self._ring
+
+    def owner(self, room):
+        # Chat address of the server of the room, this one while the ring
+        # is empty
+        return self.ring().owner(room) or self.address
+
+    def is_local(self, room):
+        return self.owner(room) == self.address
@@ -0,0 +1,141 @@
+from collections import deque
+from enum import Enum
+import os
+import socket
+
+
+class OverflowPolicy(str, Enum):
+    DROP_OLDEST = "DROP_OLDEST"  # drop the oldest queued frames
+    DISCONNECT = "DISCONNECT"  # evict the slow consumer
+    PAUSE = "PAUSE"  # stop reading from the sender until the queue drains
+
+    def toJSON(self):
+        return self.name
+
+
+def config_from_env():
+    return {
+        'high_watermark': int(os.getenv('SEND_QUEUE_HIGH_WATERMARK') or 1024 * 1024),
+        'low_watermark': int(os.getenv('SEND_QUEUE_LOW_WATERMARK') or 256 * 1024),
+        'policy': OverflowPolicy((os.getenv('SEND_QUEUE_POLICY') or 'DROP_OLDEST').upper()),
+        'max_write': int(os.getenv('SEND_QUEUE_MAX_WRITE') or 256 * 1024),
+    }
+
+
+# Bounded outbound queue of one client connection. Frames are queued without
+# blocking and drained in coalesced writes of up to max_write bytes. Once the
+# queued bytes pass the high watermark the overflow policy applies; a paused
+# queue resumes when it drains below the low watermark.
+class SendQueue():
+    def __init__(self, high_watermark=1024 * 1024, low_watermark=256 * 1024,
+                 policy=OverflowPolicy.DROP_OLDEST, max_write=256 * 1024):
+        if low_watermark > high_watermark:
+            raise ValueError('low_watermark must not exceed high_watermark')
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = OverflowPolicy(policy)
+        self.max_write = max_write
+
+        self._frames = deque()
+        # The head frame was partly written and must not be dropped
+        self._head_partial = False
+        self.nbytes = 0
+
+        self.paused = False
+        self.evicted = False
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.overflows = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def push(self, frame) -> bool:
+        # Returns False when the frame was not queued because the consumer is
+        # (or just got) evicted
+        if self.evicted:
+            return False
+        self._frames.append(frame)
+        self.nbytes += len(frame)
+        if self.nbytes > self.high_watermark:
+            self.overflows += 1
+            if self.policy == OverflowPolicy.DROP_OLDEST:
+                self._drop_oldest()
+            elif self.policy == OverflowPolicy.DISCONNECT:
+                self.evict()
+                return False
+            else:
+                self.paused = True
+        return True
+
+    def _drop_oldest(self):
+        first = 1 if self._head_partial else 0
+        while self.nbytes > self.high_watermark and len(self._frames) > first + 1:
+            if first:
+                head = self._frames.popleft()
+                frame = self._frames.popleft()
+                self._frames.appendleft(head)
+            else:
+                frame = self._frames.popleft()
+            self.nbytes -= len(frame)
+            self.dropped += 1
+
+    def evict(self):
+        self.evicted = True
+        self.dropped += len(self._frames)
+        self._frames.clear()
+        self.nbytes = 0
+
+    def pop_batch(self) -> bytes:
+        # Coalesce queued frames into one write of at most max_write bytes,
+        # always taking at least one frame
+        frames = []
+        size = 0
+        while self._frames and (not frames or size + len(self._frames[0]) <= self.max_write):
+            frame = self._frames.popleft()
+            frames.append(frame)
+            size += len(frame)
+        self.nbytes -= size
+        self._head_partial = False
+        self._check_resume()
+        return frames[0] if len(frames) == 1 else b''.join(frames)
+
+    def push_front(self, remainder):
+        # Put back the unwritten end of a batch after a partial write
+        self._frames.appendleft(bytes(remainder))
+        self.nbytes += len(remainder)
+        self._head_partial = True
+
+    def sent(self, nbytes):
+        self.bytes_sent += nbytes
+
+    def flush(self, sock) -> bool:
+        # Write as much as the socket takes without blocking. Returns True when
+        # the queue is empty. Only for a queue that is the one writer of the
+        # socket, the rest of a partly written frame stays queued.
+        while self._frames:
+            batch = self.pop_batch()
+            try:
+                nbytes = sock.send(batch, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                nbytes = 0
+            self.sent(nbytes)
+            if nbytes < len(batch):
+                self.push_front(memoryview(batch)[nbytes:])
+                return False
+        return True
+
+    def _check_resume(self):
+        if self.paused and self.nbytes <= self.low_watermark:
+            self.paused = False
+
+    def stats(self):
+        return {
+            'depth': len(self._frames),
+            'bytes': self.nbytes,
+            'bytes_sent': self.bytes_sent,
+            'dropped': self.dropped,
+            'overflows': self.overflows,
+            'paused': self.paused,
+            'evicted': self.evicted,
+        }
@@ -0,0 +1,797 @@
+import collections
+from concurrent.futures import Future
+import contextlib
+import heapq
+import itertools
+import os
+import random
+import time
+
+from lib import wire
+from lib.address import Address
+from lib.channel import RttEstimator, _decode_response
+from lib.discovery import Discovery
+from lib.election import Node, RingMember
+from lib.gossip import GossipMember
+from lib.internal_handler import InternalMessageHandler
+from lib.membership import MembershipTable
+from lib.message import Message, MessageType
+from lib.replication import ChatLog, ChatReplicator
+
+# Deterministic in-process cluster simulator.
+#
+# Runs N servers in one process on a virtual clock: the real Discovery,
+# InternalMessageHandler, RingMember and GossipMember of every node, with
+# their sockets replaced by an in-memory network that delays, drops and
+# partitions datagrams. Nothing is forked and nothing is bound, so clusters
+# of 1000 nodes run on one core, and the same seed gives the same run.
+#
+# Events (datagram deliveries, timers) run one at a time in time order. A
+# handler that blocks, sleeping or waiting for a response, moves the clock
+# forward for the rest of its own event only. Requests a sender blocks on
+# are delivered at once, with the clock set to their arrival time while the
+# receiver handles them, and complete at the arrival time of the response.
+#
+#   cluster = SimCluster(100, seed=1)
+#   cluster.start(stagger=0.1)
+#   cluster.run_until(cluster.converged, timeout=60)
+#   cluster.report()
+#
+# SimLinks runs one component without the nodes around it: RingMember,
+# GossipMember or ChatReplicator objects that call each other directly, on
+# the same clock, for the tests and benches of that component.
+
+
+class Simulator():
+    # Virtual clock and event queue. Also charges the CPU time of every
+    # event to its owner, nested deliveries to theirs.
+    def __init__(self, seed=0):
+        self.now = 0.0
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.events_run = 0
+        self.cpu = collections.Counter()
+        self._events = []
+        self._seq = itertools.count()
+        self._charging = []
+
+    def at(self, when, function, owner=None):
+        heapq.heappush(self._events, (when, next(self._seq), function, owner))
+
+    def later(self, delay, function, owner=None):
+        self.at(self.now + delay, function, owner)
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def wait(self, futures, timeout=None):
+        # The first successful result of futures completed by the
+        # simulation, or None. Moves the clock to when it arrived, or by
+        # timeout when none did.
+        deadline = float('inf') if timeout is None else self.now + timeout
+        done = [future for future in futures
+                if future.done() and future.exception() is None and future.sim_time <= deadline]
+        if not done:
+            failed = [future.sim_time for future in futures if future.done()]
+            self.now = min(deadline, max(failed, default=self.now))
+            return None
+        first = min(done, key=lambda future: future.sim_time)
+        self.now = max(self.now, first.sim_time)
+        return first.result()
+
+    def run(self, until=None):
+        # Runs the events due until `until`, or all of them
+        while self._events and (until is None or self._events[0][0] <= until):
+            when, _, function, owner = heapq.heappop(self._events)
+            self.now = when
+            with self.charge(owner):
+                function()
+            self.events_run += 1
+        if until is not None:
+            self.now = max(self.now, until)
+
+    @contextlib.contextmanager
+    def charge(self, owner):
+        # CPU time of the block goes to owner, minus nested blocks charged
+        # to others
+        frame = [0.0]
+        self._charging.append(frame)
+        start = time.process_time()
+        try:
+            yield
+        finally:
+            elapsed = time.process_time() - start
+            self._charging.pop()
+            self.cpu[owner] += elapsed - frame[0]
+            if self._charging:
+                self._charging[-1][0] += elapsed
+
+
+class SimNetwork():
+    # In-memory datagram network: one way latency plus uniform jitter,
+    # random loss, crashed hosts and partitions between groups of hosts.
+    BROADCAST_HOST = '255.255.255.255'
+
+    def __init__(self, sim, latency=0.0005, jitter=0.0, loss=0.0):
+        self.sim = sim
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.down = set()
+        self.sent = collections.Counter()
+        self.delivered = 0
+        self.dropped = 0
+        self.bytes = 0
+        self._endpoints = {}
+        self._hosts_by_port = collections.defaultdict(set)
+        self._groups = {}
+        self._ephemeral = itertools.count(40000)
+
+    def bind(self, sock, address):
+        if address in self._endpoints:
+            raise OSError('Address already in use: {}:{}'.format(*address))
+        self._endpoints[address] = sock
+        self._hosts_by_port[address[1]].add(address[0])
+
+    def unbind(self, address):
+        if self._endpoints.pop(address, None) is not None:
+            self._hosts_by_port[address[1]].discard(address[0])
+
+    def ephemeral_port(self):
+        return next(self._ephemeral)
+
+    def partition(self, *groups):
+        # Hosts of different groups cannot reach each other. Hosts in no
+        # group form one more group.
+        self._groups = {host: i for i, group in enumerate(groups) for host in group}
+
+    def heal(self):
+        self._groups = {}
+
+    def reachable(self, source_host, destination_host):
+        return (source_host not in self.down and destination_host not in self.down
+                and self._groups.get(source_host, -1) == self._groups.get(destination_host, -1))
+
+    def sendto(self, data, source, destination, inline=False):
+        # inline=True delivers at once, see above
+        self.bytes += len(data)
+        self.sent[_type_name(data)] += 1
+        host, port = destination
+        if host == self.BROADCAST_HOST:
+            # Sorted, so that the delivery order does not depend on hashing
+            for target in sorted(self._hosts_by_port[port]):
+                self._deliver(data, source, (target, port), inline)
+        else:
+            self._deliver(data, source, (host, port), inline)
+
+    def _deliver(self, data, source, destination, inline):
+        sock = self._endpoints.get(destination)
+        if (sock is None or not self.reachable(source[0], destination[0])
+                or (self.loss and self.sim.random.random() < self.loss)):
+            self.dropped += 1
+            return
+        self.delivered += 1
+        delay = self.latency + (self.jitter and self.sim.random.uniform(0, self.jitter))
+        if not (inline or sock.inline):
+            self.sim.later(delay, lambda: sock.receive(data, source), sock.owner)
+            return
+        sent_at = self.sim.now
+        self.sim.now += delay
+        try:
+            with self.sim.charge(sock.owner):
+                sock.receive(data, source)
+        finally:
+            self.sim.now = sent_at
+
+
+def _type_name(data):
+    if wire.is_binary(data) and len(data) > 2:
+        type = wire.CODE_TYPES.get(data[2])
+        return type.name if type is not None else 'unknown'
+    try:
+        return MessageType(wire.loads(data).type).name
+    except (ValueError, KeyError, TypeError):
+        return 'raw'
+
+
+class SimSocket():
+    # The parts of a UDP socket the components use. Received datagrams are
+    # passed to receive(data, address); inline sockets get them at once.
+    def __init__(self, network, host, owner=None, receive=None, inline=False):
+        self.network = network
+        self.host = host
+        self.owner = owner
+        self.receive = receive or (lambda data, address: None)
+        self.inline = inline
+        self.address = None
+
+    def bind(self, address):
+        host, port = address
+        address = (host or self.host, port or self.network.ephemeral_port())
+        self.network.bind(self, address)
+        self.address = address
+
+    def sendto(self, data, address):
+        if self.address is None:
+            self.bind(('', 0))
+        self.network.sendto(data, self.address, (address[0], address[1]))
+
+    def setsockopt(self, *args):
+        pass
+
+    def setblocking(self, flag):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        if self.address is not None:
+            self.network.unbind(self.address)
+            self.address = None
+
+
+class SimChannel():
+    # ReplicaChannel on a SimNetwork, with the same adaptive timeouts.
+    # request() delivers after the latency, call() at once for a sender that
+    # blocks on the response. Futures carry the virtual time they completed
+    # at in sim_time.
+    def __init__(self, sim, network, host, owner=None, min_timeout=None, max_timeout=None):
+        self.sim = sim
+        self.network = network
+        self.min_timeout = float(min_timeout or os.getenv('REPLICA_MIN_TIMEOUT') or 0.2)
+        self.max_timeout = float(max_timeout or os.getenv('REPLICA_TIMEOUT') or 5)
+        self.sock = SimSocket(network, host, owner, self._on_response, inline=True)
+        self.sock.bind((host, 0))
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._rtt = {}
+
+    def _estimator(self, address):
+        estimator = self._rtt.get(address)
+        if estimator is None:
+            estimator = RttEstimator(self.max_timeout, self.min_timeout, self.max_timeout)
+            self._rtt[address] = estimator
+        return estimator
+
+    def timeout_for(self, address):
+        return self._estimator(Address(*address)).timeout
+
+    def request(self, message, address, inline=False):
+        address = Address(*address)
+        future = Future()
+        future.sim_time = None
+        message.correlation_id = next(self._ids) & 0xFFFFFFFF
+        correlation_id = message.correlation_id
+        timeout = self._estimator(address).timeout
+        self._pending[correlation_id] = (future, address, self.sim.now)
+        self.network.sendto(wire.dumps(message), self.sock.address,
+                            (address.host, address.port), inline=inline)
+        if inline:
+            if not future.done():
+                self._expire(correlation_id, self.sim.now + timeout)
+        else:
+            self.sim.later(timeout, lambda: self._expire(correlation_id, self.sim.now),
+                           self.sock.owner)
+        return future
+
+    def call(self, message, address):
+        return self.request(message, address, inline=True)
+
+    def send(self, message, address):
+        self.network.sendto(wire.dumps(message), self.sock.address, (address[0], address[1]))
+
+    def _on_response(self, data, address):
+        response = _decode_response(data)
+        pending = self._pending.pop(getattr(response, 'correlation_id', None), None)
+        if pending is None:
+            return
+        future, peer, sent_at = pending
+        self._estimator(peer).sample(self.sim.now - sent_at)
+        future.sim_time = self.sim.now
+        future.set_result(response)
+
+    def _expire(self, correlation_id, at):
+        pending = self._pending.pop(correlation_id, None)
+        if pending is None:
+            return
+        future, peer, _ = pending
+        self._estimator(peer).backoff()
+        future.sim_time = at
+        future.set_exception(TimeoutError('No response from {}'.format(peer)))
+
+    def in_flight(self):
+        return len(self._pending)
+
+    def close(self):
+        self.sock.close()
+
+
+class SimReplicaHandler(InternalMessageHandler):
+    # InternalMessageHandler on the simulated network. Handlers run inline,
+    # in delivery order, and blocking requests block on virtual time.
+    def __init__(self, node):
+        self.node = node
+        # The chat log stays in memory, whatever CHAT_LOG_DIR says
+        super().__init__(node.address, membership=node.membership,
+                         leader_id=[" " * 256], election_state=[0, 0, 0, 0.0],
+                         chat_log=ChatLog())
+        sim = node.sim
+        self.channel = SimChannel(sim, node.network, self.host, owner=node.name)
+        self.election._now = lambda: sim.now
+        self.election._sleep = sim.sleep
+        self.gossip._now = lambda: sim.now
+        self.gossip._wait = sim.wait
+        self.gossip.request = self.channel.call
+        self.gossip.random = random.Random('{}:{}'.format(sim.seed, node.name))
+
+    def _create_socket(self, port):
+        self.sock = SimSocket(self.node.network, self.host, owner=self.node.name,
+                              receive=self.receive_datagram)
+        self.sock.bind(("", port))
+
+    def process_message(self, message, client_address):
+        self.dispatcher.dispatch(message, client_address, inline=True)
+
+    def send_message(self, message, address):
+        return self.node.sim.wait([self.channel.call(message, address)])
+
+
+class SimDiscovery(Discovery):
+    # Discovery on the simulated network, with timers instead of socket
+    # timeouts
+    def __init__(self, node, broadcast_port):
+        self.node = node
+        super().__init__(node.address.host, node.address.port, broadcast_port)
+        self.random = random.Random('{}:{}:discovery'.format(node.sim.seed, node.name))
+        self._discovering = False
+        self._suppressing = False
+
+    def setup_broadcast_socket(self):
+        network = self.node.network
+        self.send_socket = SimSocket(network, self.node.address.host, owner=self.node.name,
+                                     receive=self._on_response)
+        self.recv_socket = SimSocket(network, self.node.address.host, owner=self.node.name,
+                                     receive=self.process_message)
+        self.recv_socket.bind(("", self.BROADCAST_PORT))
+
+    def _now(self):
+        return self.node.sim.now
+
+    def send_discovery_message(self):
+        self._discovering = True
+        self._suppressing = False
+        self.start_discovery()
+        self.node.sim.later(self.DISCOVERY_WAIT, self._finish, self.node.name)
+
+    def _finish(self):
+        self._discovering = False
+        self.on_finish_discovery()
+
+    def _on_response(self, data, address):
+        if not self._discovering:
+            return
+        try:
+            message = wire.loads(data)
+        except (ValueError, KeyError):
+            return
+        if message.type == MessageType.DISCOVERY_RES:
+            self.handle_response(message)
+            if not self._suppressing:
+                # Let the other early answers arrive, then suppress the rest
+                self._suppressing = True
+                self.node.sim.later(self.REPLY_JITTER / 10, self._suppress, self.node.name)
+
+    def _suppress(self):
+        if self._discovering:
+            self.suppress_replies()
+
+    def handle_request(self, message, address, now):
+        super().handle_request(message, address, now)
+        pending = self._pending_replies.get((message.host, message.port))
+        if pending is not None:
+            self.node.sim.at(pending[0], lambda: self.send_due_replies(self._now()),
+                             self.node.name)
+
+
+class SimNode():
+    # One server: discovery, replica handler, ring member and gossip, wired
+    # up as in server.Server
+    def __init__(self, cluster, index, host, port=3000):
+        self.cluster = cluster
+        self.sim = cluster.sim
+        self.network = cluster.network
+        self.address = Address(host, port)
+        self.name = str(self.address)
+        self.membership = MembershipTable('{}_{}'.format(cluster.name, index),
+                                          capacity=cluster.capacity, create=True)
+        self.handler = SimReplicaHandler(self)
+        self.election = self.handler.election
+        if cluster.mode is not None:
+            self.handler.membership_mode = cluster.mode
+        if cluster.heartbeat_interval is not None:
+            self.election.heartbeat_interval = cluster.heartbeat_interval
+        if cluster.gossip_interval is not None:
+            self.handler.gossip.interval = cluster.gossip_interval
+        self.discovery = SimDiscovery(self, cluster.broadcast_port)
+        self.discovery.on_discovery = self.on_discovery
+        self.discovery.on_finish_discovery = self.on_finish_discovery
+        self.discovery.set_replica_address(Address(self.handler.host, self.handler.port))
+        self.discovery.set_get_members(self.election.get_ring)
+        self.up = False
+
+    @property
+    def leader_id(self):
+        return self.election.leader_id[0].strip()
+
+    def start(self):
+        self.up = True
+        self.discovery.send_discovery_message()
+
+    def on_discovery(self, message):
+        replica_address = Address.from_string(message.message)
+        self.handler.add_node(Node(address=Address(host=message.host, port=message.port),
+                                   replica_address=replica_address))
+        self.election.form_ring()
+
+    def on_finish_discovery(self):
+        if not self.up:
+            return
+        if len(self.election.get_ring()) <= 1:
+            self.election.raise_leader()
+        else:
+            self.election.join_ring()
+        self.start_membership()
+
+    def start_membership(self, phase=None):
+        # InternalMessageHandler.start_membership, with timers instead of
+        # processes. The first period ends after phase seconds, by default
+        # after a full one.
+        if self.handler.membership_mode != 'gossip':
+            self._every(self.election.heartbeat_interval, self.election.check_next_node, phase)
+            return
+        gossip = self.handler.gossip
+        self.membership.update(self.election, gossip=gossip.retransmits())
+        self._every(gossip.interval, gossip.probe, phase)
+
+    def _every(self, interval, function, phase=None):
+        # Like a loop of sleep and function, which may block
+        def tick():
+            if self.up:
+                function()
+                self.sim.later(interval, tick, self.name)
+        self.sim.later(interval if phase is None else phase, tick, self.name)
+
+    def crash(self):
+        self.up = False
+        self.network.down.add(self.address.host)
+
+    def close(self):
+        self.discovery.send_socket.close()
+        self.discovery.recv_socket.close()
+        self.handler.sock.close()
+        self.handler.channel.close()
+        self.handler.replicator.close()
+        self.membership.close()
+        self.membership.unlink()
+
+
+_clusters = itertools.count()
+
+
+class SimCluster():
+    def __init__(self, nr_nodes, seed=0, latency=0.0005, jitter=0.0, loss=0.0,
+                 mode=None, heartbeat_interval=None, gossip_interval=None, capacity=8):
+        # mode is the MEMBERSHIP_MODE of the nodes, by default the one of
+        # the environment
+        self.name = 'sim{}_{}'.format(os.getpid(), next(_clusters))
+        self.sim = Simulator(seed)
+        self.network = SimNetwork(self.sim, latency, jitter, loss)
+        self.mode = mode
+        self.heartbeat_interval = heartbeat_interval
+        self.gossip_interval = gossip_interval
+        self.capacity = capacity
+        self.broadcast_port = int(os.getenv('BROADCAST_PORT') or Discovery.BROADCAST_PORT)
+        self.nodes = []
+        try:
+            for i in range(nr_nodes):
+                self.nodes.append(SimNode(self, i, _host(i)))
+        except BaseException:
+            self.close()
+            raise
+
+    def start(self, stagger=0.0):
+        # Starts the nodes stagger seconds apart, as servers started one
+        # after another
+        for i, node in enumerate(self.nodes):
+            self.sim.at(self.sim.now + i * stagger, node.start, node.name)
+
+    def bootstrap(self):
+        # Starts the nodes as if discovery and the first election were over:
+        # every node knows every node and the highest one is the leader.
+        # Skips the O(N^2) discovery broadcasts for large clusters.
+        leader = max(self.nodes, key=lambda node: node.election.key)
+        for node in self.nodes:
+            node.up = True
+            for other in self.nodes:
+                node.membership.add(other.election)
+            node.election.leader_id[0] = leader.election.id
+        for node in self.nodes:
+            interval = (node.handler.gossip.interval if node.handler.membership_mode == 'gossip'
+                        else node.election.heartbeat_interval)
+            node.start_membership(phase=self.sim.random.uniform(0, interval))
+
+    def live_nodes(self):
+        return [node for node in self.nodes if node.up]
+
+    def converged(self):
+        # Every live node has every live node as member, and no other, and
+        # they agree on a live leader
+        live = self.live_nodes()
+        leaders = {node.leader_id for node in live}
+        if len(leaders) != 1 or leaders.pop() not in {node.election.id for node in live}:
+            return False
+        expected = {node.address for node in live}
+        return all(len(node.membership) == len(expected) for node in live) and all(
+            {node.address for node in node.membership.nodes()} == expected for node in live)
+
+    def run_until(self, predicate, timeout, resolution=0.01):
+        # Virtual seconds until predicate() holds, checked every resolution
+        # seconds, or None after timeout
+        start = self.sim.now
+        while self.sim.now - start < timeout:
+            self.sim.run(until=self.sim.now + resolution)
+            if predicate():
+                return self.sim.now - start
+        return None
+
+    def report(self):
+        cpu = [self.sim.cpu[node.name] for node in self.nodes]
+        return {
+            'nodes': len(self.nodes),
+            'virtual_time_s': round(self.sim.now, 3),
+            'events': self.sim.events_run,
+            'datagrams': sum(self.network.sent.values()),
+            'delivered': self.network.delivered,
+            'dropped': self.network.dropped,
+            'bytes': self.network.bytes,
+            'messages': dict(sorted(self.network.sent.items())),
+            'cpu_ms_per_node': round(sum(cpu) / max(1, len(cpu)) * 1e3, 3),
+            'cpu_ms_max_node': round(max(cpu, default=0) * 1e3, 3),
+        }
+
+    def close(self):
+        for node in self.nodes:
+            node.close()
+        self.nodes = []
+
+
+class SimLinks():
+    # Direct calls between components of one kind. Members are registered
+    # by replica address. A message to an unknown or down member is lost,
+    # as is every message and response with probability loss; a lost
+    # request costs the sender the timeout.
+    def __init__(self, sim=None, latency=0.0005, timeout=0.2, loss=0.0, seed=0):
+        self.name = 'links{}_{}'.format(os.getpid(), next(_clusters))
+        self.sim = sim or Simulator(seed)
+        self.latency = latency
+        self.timeout = timeout
+        self.loss = loss
+        self.members = {}
+        self.down = set()
+        self.messages = 0
+        # Requests held for pump(), as (message, address, future)
+        self.held = []
+        # Held requests that fail to send, like a datagram that is too long
+        self.send_errors = 0
+        self._tables = []
+
+    def table(self, capacity=8):
+        # A new membership table, unlinked by close()
+        table = MembershipTable('{}_{}'.format(self.name, len(self._tables)),
+                                capacity=capacity, create=True)
+        self._tables.append(table)
+        return table
+
+    def add(self, address, member):
+        self.members[Address(*address)] = member
+
+    def receiver(self, address):
+        # The member a message to address reaches, or None
+        self.messages += 1
+        address = Address(*address)
+        member = self.members.get(address)
+        if member is None or address in self.down or self._lost():
+            return None
+        return member
+
+    def _lost(self):
+        return bool(self.loss) and self.sim.random.random() < self.loss
+
+    def call(self, message, address, handle, timeout=None):
+        # Blocking request: handle(receiver, message) after a round trip,
+        # or None after the timeout
+        timeout = self.timeout if timeout is None else timeout
+        sent_at = self.sim.now
+        receiver = self.receiver(address)
+        if receiver is not None:
+            self.sim.sleep(2 * self.latency)
+            response = handle(receiver, message)
+            if response is not None and not self._lost():
+                return response
+        self.sim.now = sent_at + timeout
+        return None
+
+    def post(self, message, address, handle):
+        # One way message, handle(receiver, message) runs after the
+        # latency. Returns a Future of None, as nobody waits for a response.
+        receiver = self.receiver(address)
+        if receiver is not None:
+            self.sim.later(self.latency, lambda: handle(receiver, message))
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def answer(self, message, address, handle):
+        # A Future of handle(receiver, message), completed at once, or
+        # failed with TimeoutError when there is no response
+        receiver = self.receiver(address)
+        response = None if receiver is None else handle(receiver, message)
+        future = Future()
+        if response is None or self._lost():
+            future.set_exception(TimeoutError('No response from {}'.format(address)))
+        else:
+            future.set_result(response)
+        return future
+
+    def hold(self, message, address):
+        # A Future of the response to message, delivered by pump()
+        if self.send_errors:
+            self.send_errors -= 1
+            raise OSError('Message too long')
+        future = Future()
+        self.held.append((message, address, future))
+        return future
+
+    def pump(self, handle, max_requests=10000):
+        # Delivers the held requests in random order, those sent meanwhile
+        # too. A request without a response fails with TimeoutError.
+        for _ in range(max_requests):
+            if not self.held:
+                break
+            self.sim.random.shuffle(self.held)
+            message, address, future = self.held.pop()
+            receiver = self.receiver(address)
+            response = None if receiver is None else handle(receiver, message)
+            if response is None or self._lost():
+                future.set_exception(TimeoutError('No response from {}'.format(address)))
+            else:
+                future.set_result(response)
+
+    def run(self):
+        self.sim.run()
+
+    def close(self):
+        for table in self._tables:
+            table.close()
+            table.unlink()
+        self._tables = []
+
+
+class SimRingMember(RingMember):
+    # RingMember on SimLinks, on the virtual clock. send blocks for a round
+    # trip, request is one way. Election messages are handled after the
+    # reply, as by the replica handler.
+    def __init__(self, links, address, replica_address=None, membership=None):
+        self.links = links
+        replica_address = replica_address or address
+        super().__init__(
+            address=address, replica_address=replica_address,
+            send=lambda message, to: links.call(message, to, _handle),
+            request=lambda message, to: links.post(message, to, _deliver),
+            membership=links.table() if membership is None else membership,
+            leader_id=[" " * 256], election_state=[0, 0, 0, 0.0])
+        self.nodes.add(self)
+        links.add(replica_address, self)
+        self.pings = 0
+        # Virtual time this member last learned of a new leader
+        self.known_at = None
+
+    def _now(self):
+        return self.links.sim.now
+
+    def _sleep(self, seconds):
+        self.links.sim.sleep(seconds)
+
+    def handle(self, message):
+        if message.type == MessageType.PING_REQ:
+            self.pings += 1
+            self.nodes.touch(Node(Address(message.host, message.port), Address()))
+            return message
+        self.links.sim.later(0, lambda: self.deliver(message))
+        return Message(message=self.election_reply(), type=MessageType.ELECTION_RES,
+                       host=self.address.host, port=self.address.port)
+
+    def deliver(self, message):
+        if message.type == MessageType.ELECTION_REQ:
+            self.receive_election(message.message)
+        else:
+            self.receive_leader(message.message)
+
+    def raise_leader(self):
+        super().raise_leader()
+        self.known_at = self._now()
+
+    def receive_leader(self, body):
+        super().receive_leader(body)
+        if self.elected:
+            self.known_at = self._now()
+
+
+class SimGossipMember(GossipMember):
+    # GossipMember on SimLinks with a membership table of its own. Pings
+    # are answered at once, the caller moves the clock between rounds.
+    def __init__(self, links, node, interval=1, indirect=3):
+        self.links = links
+        super().__init__(node, links.table(),
+                         lambda message, to: links.answer(message, to, _handle),
+                         interval=interval, indirect=indirect)
+        self.random = random.Random('{}:{}'.format(links.sim.seed, node.replica_address))
+        self.nodes.add(node)
+        links.add(node.replica_address, self)
+
+    def _now(self):
+        return self.links.sim.now
+
+    def handle(self, message):
+        if message.type == MessageType.GOSSIP_PING:
+            body = self.handle_ping(message)
+        else:
+            body = self.handle_ping_req(message)
+        if body is None:
+            return None
+        return Message(message=body, type=MessageType.GOSSIP_ACK,
+                       host=self.node.address.host, port=self.node.replica_address.port)
+
+
+class SimReplicators():
+    # The ChatReplicators of a ring of nr_members on SimLinks, the first
+    # one the leader. Batches are held until pump().
+    def __init__(self, links, nr_members, **kwargs):
+        self.links = links
+        self.epoch = 1
+        self.ring = [Node(Address(_host(i), 3000), Address(_host(i), 5970))
+                     for i in range(nr_members)]
+        self.members = [ChatReplicator(node, self, links.hold, lambda: self.epoch, **kwargs)
+                        for node in self.ring]
+        for node, member in zip(self.ring, self.members):
+            links.add(node.replica_address, member)
+        self.leader = self.members[0]
+
+    def nodes(self):
+        # The membership of every member
+        return self.ring
+
+    def pump(self, max_requests=10000):
+        self.links.pump(SimReplicators._receive, max_requests)
+
+    @staticmethod
+    def _receive(member, message):
+        reply = member.receive(message.message)
+        return None if reply is None else Message(message=reply,
+                                                  type=MessageType.REPLICATE_RES)
+
+    def logs(self):
+        return [member.log.entries_from(1, 10000, 1 << 30) for member in self.members]
+
+
+def _handle(member, message):
+    return member.handle(message)
+
+
+def _deliver(member, message):
+    member.deliver(message)
+
+
+def _host(i):
+    return '10.0.{}.{}'.format(i // 250, i % 250 + 1)
@@ -0,0 +1,237 @@
+from contextlib import contextmanager
+from multiprocessing import Lock
+from multiprocessing.shared_memory import SharedMemory
+import json
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+
+# Trace context of sampled chat messages and election rounds.
+#
+# A trace is an id and the hops the message took so far, each a name and a
+# wall clock time. It travels with the ChatMessage from the client to the
+# server and with the replica Messages between the servers. Every node that
+# adds a hop also records the span from the previous hop to it in its span
+# buffer, so the spans of one trace from the buffers of all servers give the
+# latency of every hop: network, queues and processing. Times are wall clock
+# times of different hosts, legs across hosts are only as exact as their
+# clocks are synchronized.
+#
+# Handlers of replica messages run with the trace of their message as the
+# current trace of the thread, and the replica channel attaches the current
+# trace to what it sends, see Dispatcher and ReplicaChannel.
+#
+# Wire format, big endian, see lib/wire.py FLAG_TRACE:
+#
+#   id (8) | hop count (1) | hops: name length (1) | name | time (8)
+#
+# Span buffer, a ring of the last spans shared by the processes of a server:
+#
+#   header: magic (4) | version (2) | pad (2) | capacity (4) | pad (4)
+#           | spans written (8)
+#   spans:  capacity records of id (8) | start (8) | end (8) | name (NAME_SIZE)
+TRACE = struct.Struct('!QB')
+HOP = struct.Struct('!d')
+MAX_HOPS = 64
+MAGIC = 0x54524143  # 'TRAC'
+VERSION = 1
+HEADER = struct.Struct('<IHxxIxxxxQ')
+WRITTEN_OFFSET = 16
+WRITTEN = struct.Struct('<Q')
+NAME_SIZE = 48
+SPAN = struct.Struct('<Qdd{}s'.format(NAME_SIZE))
+
+_node = ''
+_sample = None
+_local = threading.local()
+
+
+class Trace():
+    __slots__ = ('id', 'hops')
+
+    def __init__(self, id, hops=None):
+        self.id = id
+        self.hops = hops if hops is not None else []
+
+    def __repr__(self):
+        return 'Trace({:016x}, {} hops)'.format(self.id, len(self.hops))
+
+    def hop(self, event):
+        # Adds the hop and records the span since the previous one
+        name = '{} {}'.format(_node, event) if _node else event
+        now = time.time()
+        start = self.hops[-1][1] if self.hops else now
+        self.hops.append((name, now))
+        if len(self.hops) > MAX_HOPS:
+            # Keeps the first hop, the spans of the others are recorded
+            del self.hops[1]
+        spans().record(self.id, name, start, now)
+
+    def copy(self):
+        return Trace(self.id, list(self.hops))
+
+    def encode(self):
+        parts = [TRACE.pack(self.id, len(self.hops))]
+        for name, at in self.hops:
+            name = name.encode()[:255]
+            parts += (bytes((len(name),)), name, HOP.pack(at))
+        return b''.join(parts)
+
+    @staticmethod
+    def decode(data):
+        id, count = TRACE.unpack_from(data, 0)
+        offset = TRACE.size
+        hops = []
+        for _ in range(count):
+            length = data[offset]
+            offset += 1
+            name = bytes(data[offset:offset + length]).decode(errors='replace')
+            offset += length
+            at, = HOP.unpack_from(data, offset)
+            offset += HOP.size
+            hops.append((name, at))
+        return Trace(id, hops)
+
+    def toJSON(self):
+        return {'id': '{:016x}'.format(self.id), 'hops': [list(hop) for hop in self.hops]}
+
+    @staticmethod
+    def fromJSON(data):
+        return Trace(int(data['id'], 16), [tuple(hop) for hop in data['hops']])
+
+
+def start(rate=None):
+    # A new trace for rate of the calls, TRACE_SAMPLE by default, else None
+    global _sample
+    if rate is None:
+        if _sample is None:
+            _sample = float(os.getenv('TRACE_SAMPLE') or 0.01)
+        rate = _sample
+    if rate <= 0 or random.random() >= rate:
+        return None
+    return Trace(random.getrandbits(64) | 1)
+
+
+def set_node(name):
+    # Name of this server in the hops, e.g. its address
+    global _node
+    _node = name
+
+
+def current():
+    # The trace of the message handled by this thread
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def use(trace):
+    previous = current()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+class SpanBuffer():
+    def __init__(self, name=None, create=False, capacity=None, lock=None):
+        # Without a name the spans are in anonymous shared memory, shared
+        # with the processes forked afterwards. create=True makes a new
+        # buffer, replacing a stale one of the same name.
+        self.name = name
+        self._lock = lock or Lock()
+        self.shm = None
+        if name is None or create:
+            self.capacity = int(capacity or os.getenv('TRACE_BUFFER') or 4096)
+            size = HEADER.size + self.capacity * SPAN.size
+            if name is None:
+                self._map = mmap.mmap(-1, size)
+                self.buf = memoryview(self._map)
+            else:
+                _unlink_stale(name)
+                self.shm = SharedMemory(name=name, create=True, size=size)
+                self.buf = self.shm.buf
+                self.buf[:size] = bytes(size)
+            HEADER.pack_into(self.buf, 0, MAGIC, VERSION, self.capacity, 0)
+        else:
+            self.shm = SharedMemory(name=name)
+            self.buf = self.shm.buf
+            magic, version, self.capacity, _ = HEADER.unpack_from(self.buf, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('{} is not a span buffer'.format(name))
+
+    def record(self, id, name, start, end):
+        with self._lock:
+            written, = WRITTEN.unpack_from(self.buf, WRITTEN_OFFSET)
+            SPAN.pack_into(self.buf, HEADER.size + written % self.capacity * SPAN.size,
+                           id, start, end, name.encode()[:NAME_SIZE])
+            WRITTEN.pack_into(self.buf, WRITTEN_OFFSET, written + 1)
+
+    def spans(self):
+        # The spans in the buffer, oldest first
+        with self._lock:
+            written, = WRITTEN.unpack_from(self.buf, WRITTEN_OFFSET)
+            data = bytes(self.buf[HEADER.size:HEADER.size + self.capacity * SPAN.size])
+        first = max(0, written - self.capacity)
+        spans = []
+        for n in range(first, written):
+            id, start, end, name = SPAN.unpack_from(data, n % self.capacity * SPAN.size)
+            spans.append({'trace': '{:016x}'.format(id), 'name': name.rstrip(b'\0').decode(
+                errors='replace'), 'start': start, 'end': end,
+                'ms': round((end - start) * 1000, 3)})
+        return spans
+
+    def traces(self):
+        # trace id -> its spans in the order of their hops
+        traces = {}
+        for span in self.spans():
+            traces.setdefault(span['trace'], []).append(span)
+        for trace_spans in traces.values():
+            trace_spans.sort(key=lambda span: span['end'])
+        return traces
+
+    def dump(self, file):
+        # The spans as lines of JSON
+        for span in self.spans():
+            file.write(json.dumps(span) + '\n')
+
+    def close(self):
+        if self.shm is None or self.shm.buf is None:
+            return
+        self.buf.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+_spans = None
+
+
+def spans():
+    # The span buffer of this process, private until setup() shares one
+    global _spans
+    if _spans is None:
+        _spans = SpanBuffer()
+    return _spans
+
+
+def setup(name):
+    # Makes the named span buffer the one of this process, before the
+    # server forks
+    global _spans
+    _spans = SpanBuffer(name, create=True)
+    return _spans
+
+
+def _unlink_stale(name):
+    # Buffer left behind by a crashed server
+    try:
+        shm = SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
@@ -0,0 +1,174 @@
+import json
+import os
+import struct
+
+from lib.message import Message, MessageDecoder, MessageEncoder, MessageType
+from lib.trace import Trace
+
+# Binary encoding of lib.message.Message for replica and discovery datagrams.
+#
+#   magic (1) | version (1) | type (1) | flags (1) | port (2)
+#   host length (1) | host | message length (4) | message
+#   [correlation id (4)] [clock length (2) | clock] [trace length (2) | trace]
+#
+# Optional trailing fields are present when their flag is set.
+# All integers are big endian. The magic byte can never start the legacy
+# double encoded JSON datagrams (they start with a quote), so receivers accept
+# both formats and a cluster can be upgraded one node at a time.
+MAGIC = 0xDB
+VERSION = 1
+HEADER = struct.Struct('!BBBBH')
+HOST_LENGTH = struct.Struct('!B')
+MESSAGE_LENGTH = struct.Struct('!I')
+CORRELATION_ID = struct.Struct('!I')
+CLOCK_LENGTH = struct.Struct('!H')
+TRACE_LENGTH = struct.Struct('!H')
+
+# The message field is JSON instead of UTF-8 text
+FLAG_JSON_BODY = 0x01
+# The port field is empty ('') instead of a number
+FLAG_NO_PORT = 0x02
+# A correlation id follows the message
+FLAG_CORRELATION = 0x04
+# Vector clock entries follow, see VectorClock.encode_delta
+FLAG_CLOCK = 0x08
+# A trace follows, see lib/trace.py
+FLAG_TRACE = 0x10
+
+# Wire codes of the message types. Codes are part of the format, never reuse
+# or renumber them.
+TYPE_CODES = {
+    MessageType.MESSAGE: 1,
+    MessageType.DISCOVERY_REQ: 2,
+    MessageType.DISCOVERY_RES: 3,
+    MessageType.ELECTION_REQ: 4,
+    MessageType.ELECTION_RES: 5,
+    MessageType.LEADER_REQ: 6,
+    MessageType.LEADER_RES: 7,
+    MessageType.PING_REQ: 8,
+    MessageType.PING_RES: 9,
+    MessageType.GET_LEADER: 10,
+    MessageType.RES_LEADER: 11,
+    MessageType.REMOVE_NODE: 12,
+    MessageType.REMOVE_NODE_RES: 13,
+    MessageType.GOSSIP_PING: 14,
+    MessageType.GOSSIP_PING_REQ: 15,
+    MessageType.GOSSIP_ACK: 16,
+    MessageType.REPLICATE_REQ: 17,
+    MessageType.REPLICATE_RES: 18,
+}
+CODE_TYPES = {code: type for type, code in TYPE_CODES.items()}
+
+
+def wire_format():
+    # 'json' keeps sending the legacy format, 'binary' the format above
+    return os.getenv('WIRE_FORMAT', 'json').lower()
+
+
+def is_binary(data) -> bool:
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def encode(message: Message) -> bytes:
+    flags = 0
+    body = message.message
+    if body is None or not isinstance(body, str):
+        flags |= FLAG_JSON_BODY
+        body = json.dumps(body)
+    body = str.encode(body)
+    port = message.port
+    if port == '' or port is None:
+        flags |= FLAG_NO_PORT
+        port = 0
+    host = str.encode(message.host or '')
+    trailer = b''
+    if message.correlation_id is not None:
+        flags |= FLAG_CORRELATION
+        trailer = CORRELATION_ID.pack(message.correlation_id)
+    if message.clock is not None:
+        flags |= FLAG_CLOCK
+        trailer += CLOCK_LENGTH.pack(len(message.clock)) + message.clock
+    if message.trace is not None:
+        flags |= FLAG_TRACE
+        trace = message.trace.encode()
+        trailer += TRACE_LENGTH.pack(len(trace)) + trace
+    return b''.join((
+        HEADER.pack(MAGIC, VERSION, TYPE_CODES[MessageType(message.type)], flags, int(port)),
+        HOST_LENGTH.pack(len(host)), host,
+        MESSAGE_LENGTH.pack(len(body)), body, trailer))
+
+
+def decode(data) -> Message:
+    # Raises ValueError when the datagram is not one whole message
+    magic, version, code, flags, port = _unpack(HEADER, data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(
+            'Unsupported wire format {:#x} version {}'.format(magic, version))
+    offset = HEADER.size
+    host_length, = _unpack(HOST_LENGTH, data, offset)
+    host, offset = _take(data, offset + HOST_LENGTH.size, host_length)
+    host = host.decode()
+    body_length, = _unpack(MESSAGE_LENGTH, data, offset)
+    body, offset = _take(data, offset + MESSAGE_LENGTH.size, body_length)
+    body = body.decode()
+    if flags & FLAG_JSON_BODY:
+        body = json.loads(body)
+    if flags & FLAG_NO_PORT:
+        port = ''
+    correlation_id = None
+    if flags & FLAG_CORRELATION:
+        correlation_id, = _unpack(CORRELATION_ID, data, offset)
+        offset += CORRELATION_ID.size
+    clock = None
+    if flags & FLAG_CLOCK:
+        clock_length, = _unpack(CLOCK_LENGTH, data, offset)
+        clock, offset = _take(data, offset + CLOCK_LENGTH.size, clock_length)
+    trace = None
+    if flags & FLAG_TRACE:
+        trace_length, = _unpack(TRACE_LENGTH, data, offset)
+        trace, offset = _take(data, offset + TRACE_LENGTH.size, trace_length)
+        try:
+            trace = Trace.decode(trace)
+        except (struct.error, IndexError) as e:
+            raise ValueError('Malformed trace: {!r}'.format(e)) from e
+    if offset != len(data):
+        raise ValueError('{} bytes after the message'.format(len(data) - offset))
+    if code not in CODE_TYPES:
+        raise ValueError('Unknown message type code {}'.format(code))
+    return Message(message=body, type=CODE_TYPES[code], host=host, port=port,
+                   correlation_id=correlation_id, clock=clock, trace=trace)
+
+
+def _unpack(format, data, offset):
+    if offset + format.size > len(data):
+        raise ValueError('Truncated message')
+    return format.unpack_from(data, offset)
+
+
+def _take(data, offset, length):
+    # The length bytes at offset and the offset after them
+    if offset + length > len(data):
+        raise ValueError('Truncated message')
+    return bytes(data[offset:offset + length]), offset + length
+
+
+def dumps(message: Message) -> bytes:
+    # Encode in the format selected by WIRE_FORMAT
+    if wire_format() == 'binary':
+        return encode(message)
+    return str.encode(MessageEncoder().encode(message))
+
+
+def loads(data) -> Message:
+    # Decode a datagram in either format. Raises ValueError on anything that
+    # is not a whole message, whatever went wrong decoding it.
+    try:
+        if is_binary(data):
+            return decode(data)
+        # The legacy format is a JSON string holding the JSON object
+        text = json.loads(bytes(data).decode('utf-8'))
+        if not isinstance(text, str) or not text.lstrip().startswith('{'):
+            raise ValueError('Not a message object')
+        return json.loads(text, cls=MessageDecoder)
+    except (TypeError, AttributeError, KeyError, IndexError, struct.error) as e:
+        raise ValueError('Malformed message: {!r}'.format(e)) from e
@@ -0,0 +1,314 @@
+'''Headless load generator for the chat servers.
+
+Connects --users simulated chat users with client.Client to the servers,
+spread round robin, and lets the first --senders of them send messages of
+--size bytes at --rate messages a second each for --duration seconds. Every
+second --churn of the users disconnect and connect again. The users are
+split over --processes worker processes, each serving its share on one
+selector. Prints JSON:
+
+    throughput_msg_s    messages sent a second, after the --warmup
+    deliveries_s        messages received a second by all users
+    latency_ms          end-to-end latency from the send on the sender to
+                        the arrival at a receiver: p50, p99, p999, max
+    fanout_ms           per message, from its first to its last arrival
+    connect_ms          time to connect a user
+    senders_detail      per sender, the latency of its messages at all
+    receivers_detail    receivers, and per receiver of every message it got
+
+Latencies use the wall clock of the sending and receiving process, run the
+load generator on one host or with synchronized clocks.
+
+    python loadgen.py --servers 127.0.0.1:3000,127.0.0.1:3001 --users 2000
+'''
+
+import argparse
+import heapq
+import json
+import math
+import multiprocessing
+import os
+import random
+import selectors
+import sys
+import time
+
+from client import Client, Timers
+from lib.address import Address
+from lib.message import ChatMessageType
+
+
+# Latencies in buckets that grow by 2%, mergeable across processes
+class Histogram():
+    BASE = 1.02
+    UNIT = 1e-6  # seconds of the first bucket
+
+    def __init__(self, buckets=None):
+        self.buckets = dict(buckets or {})
+        self.count = sum(self.buckets.values())
+
+    def add(self, seconds):
+        bucket = int(math.log(max(seconds, self.UNIT) / self.UNIT, self.BASE))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+
+    def percentile(self, q):
+        # Upper bound of the bucket holding the q-th value, in ms
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                return round(self.UNIT * self.BASE ** (bucket + 1) * 1000, 3)
+
+    def summary(self):
+        return {'count': self.count, 'p50': self.percentile(0.5), 'p99': self.percentile(0.99),
+                'p999': self.percentile(0.999), 'max': self.percentile(1)}
+
+
+class _User():
+    def __init__(self, name, address, selector, timers, worker):
+        self.name = name
+        self.address = address
+        self.selector = selector
+        self.timers = timers
+        self.worker = worker
+        self.latency = Histogram()
+        self.client = None
+
+    def connect(self):
+        started = time.perf_counter()
+        self.client = Client(self.address.host, self.address.port, self.name,
+                             selector=self.selector, timers=self.timers)
+        self.client.on_message = self.on_message
+        try:
+            self.client.connect()
+        except ConnectionError:
+            self.worker.gave_up += 1
+            return
+        self.worker.connect.add(time.perf_counter() - started)
+
+    def disconnect(self):
+        self.client.shutdown()
+        self.client = None
+
+    def on_message(self, message):
+        arrived = time.time()
+        if message.type != ChatMessageType.MESSAGE:
+            return
+        # Other clients of the servers send other messages
+        try:
+            seq, sent, _ = message.message.split(' ', 2)
+            seq, sent = int(seq), float(sent)
+        except (AttributeError, ValueError):
+            return
+        if sent < self.worker.measure_from:
+            return
+        latency = arrived - sent
+        self.latency.add(latency)
+        self.worker.received += 1
+        key = (message.sender, seq)
+        first_last = self.worker.messages.get(key)
+        if first_last is None:
+            self.worker.messages[key] = [arrived, arrived]
+        else:
+            first_last[0] = min(first_last[0], arrived)
+            first_last[1] = max(first_last[1], arrived)
+        by_sender = self.worker.by_sender.get(message.sender)
+        if by_sender is None:
+            by_sender = self.worker.by_sender[message.sender] = Histogram()
+        by_sender.add(latency)
+
+
+class _Worker():
+    def __init__(self, args, servers, users):
+        self.args = args
+        self.selector = selectors.DefaultSelector()
+        # Reconnects of the users run on the selector loop, see client.Timers
+        self.timers = Timers()
+        self.users = [_User('u{}'.format(n), servers[n % len(servers)], self.selector,
+                            self.timers, self)
+                      for n in users]
+        self.senders = [user for n, user in zip(users, self.users) if n < args.senders]
+        self.random = random.Random(users.start)
+        self.connect = Histogram()
+        self.by_sender = {}  # sender name -> Histogram
+        self.messages = {}  # (sender, seq) -> [first arrival, last arrival]
+        self.sent = {}  # sender name -> messages sent after the warmup
+        self.received = 0
+        self.reconnects = 0
+        # Users whose client found no server and gave up
+        self.gave_up = 0
+        self.measure_from = float('inf')
+        self.padding = 'x' * args.size
+
+    def run(self):
+        for user in self.users:
+            user.connect()
+        start = time.time()
+        self.measure_from = start + self.args.warmup
+        end = self.measure_from + self.args.duration
+        # (due, sender index) of the next message of every sender
+        due = [(start + self.random.expovariate(self.args.rate), index)
+               for index in range(len(self.senders))]
+        heapq.heapify(due)
+        seqs = [0] * len(self.senders)
+        churn_interval = 1 / (self.args.churn * len(self.users)) if self.args.churn else None
+        next_churn = start + churn_interval if churn_interval else float('inf')
+
+        while True:
+            now = time.time()
+            if now >= end:
+                break
+            while due and due[0][0] <= now:
+                at, index = heapq.heappop(due)
+                user = self.senders[index]
+                if user.client is not None:
+                    user.client.send_message('{} {:.6f} {}'.format(
+                        seqs[index], time.time(), self.padding))
+                    seqs[index] += 1
+                    if now >= self.measure_from:
+                        self.sent[user.name] = self.sent.get(user.name, 0) + 1
+                # From the due time, so a late loop does not lower the rate
+                heapq.heappush(due, (at + self.random.expovariate(self.args.rate), index))
+            if now >= next_churn:
+                user = self.random.choice(self.users)
+                user.disconnect()
+                user.connect()
+                self.reconnects += 1
+                next_churn += churn_interval
+            self._poll(min(due[0][0] if due else end, next_churn, end) - time.time())
+        # Messages still on their way
+        drain = time.time() + self.args.drain
+        while time.time() < drain:
+            self._poll(drain - time.time())
+        for user in self.users:
+            user.disconnect()
+        return self.result()
+
+    def _poll(self, timeout):
+        for key, mask in self.selector.select(self.timers.timeout(max(0, timeout))):
+            self._step(key.data, mask)
+        while not self._step(self.timers.run):
+            pass
+
+    def _step(self, callback, *args):
+        # A user whose client gave up stays disconnected, the others go on
+        try:
+            callback(*args)
+            return True
+        except ConnectionError:
+            self.gave_up += 1
+            return False
+
+    def result(self):
+        return {
+            'sent': self.sent,
+            'received': self.received,
+            'reconnects': self.reconnects,
+            'gave_up': self.gave_up,
+            'connect': self.connect.buckets,
+            'receivers': {user.name: user.latency.buckets for user in self.users},
+            'by_sender': {name: hist.buckets for name, hist in self.by_sender.items()},
+            'messages': list(self.messages.items()),
+        }
+
+
+def _work(args, servers, users, results):
+    # Keeps the connection messages of the clients out of the output
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        results.put(_Worker(args, servers, users).run())
+    except Exception as e:
+        results.put({'error': repr(e)})
+
+
+def run(args):
+    servers = [Address.from_string(server) for server in args.servers.split(',')]
+    results = multiprocessing.Queue()
+    processes = []
+    for index in range(args.processes):
+        users = range(index, args.users, args.processes)
+        process = multiprocessing.Process(target=_work, args=(args, servers, users, results))
+        process.start()
+        processes.append(process)
+    parts = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    errors = [part['error'] for part in parts if 'error' in part]
+    if errors:
+        raise RuntimeError('Worker failed: {}'.format(errors[0]))
+
+    latency, connect = Histogram(), Histogram()
+    by_sender, receivers, messages, sent = {}, {}, {}, {}
+    for part in parts:
+        connect.merge(Histogram(part['connect']))
+        sent.update(part['sent'])
+        for name, buckets in part['receivers'].items():
+            receivers[name] = Histogram(buckets)
+            latency.merge(receivers[name])
+        for name, buckets in part['by_sender'].items():
+            by_sender.setdefault(name, Histogram()).merge(Histogram(buckets))
+        for key, (first, last) in part['messages']:
+            key = tuple(key)
+            if key in messages:
+                messages[key] = (min(first, messages[key][0]), max(last, messages[key][1]))
+            else:
+                messages[key] = (first, last)
+    fanout = Histogram()
+    for first, last in messages.values():
+        fanout.add(last - first)
+
+    result = {
+        'servers': len(servers),
+        'users': args.users,
+        'senders': args.senders,
+        'rate': args.rate,
+        'size': args.size,
+        'churn': args.churn,
+        'duration': args.duration,
+        'throughput_msg_s': round(sum(sent.values()) / args.duration, 1),
+        'deliveries_s': round(latency.count / args.duration, 1),
+        'reconnects': sum(part['reconnects'] for part in parts),
+        'gave_up': sum(part['gave_up'] for part in parts),
+        'latency_ms': latency.summary(),
+        'fanout_ms': fanout.summary(),
+        'connect_ms': connect.summary(),
+    }
+    if not args.summary:
+        result['senders_detail'] = {name: dict(by_sender[name].summary(), sent=sent.get(name, 0))
+                                    for name in sorted(by_sender)}
+        result['receivers_detail'] = {name: hist.summary() for name, hist in receivers.items()}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--servers', required=True, help='host:port of the servers, comma separated')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--senders', type=int, default=10,
+                        help='users that send, the others only receive')
+    parser.add_argument('--rate', type=float, default=10, help='messages a second per sender')
+    parser.add_argument('--size', type=int, default=100, help='bytes of padding per message')
+    parser.add_argument('--churn', type=float, default=0,
+                        help='share of the users that reconnect every second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--drain', type=float, default=1,
+                        help='seconds to wait for messages still on their way')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--summary', action='store_true', help='leave out the per user results')
+    args = parser.parse_args()
+    args.processes = max(1, min(args.processes, args.users))
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,38 @@
-import json
 from multiprocessing.shared_memory import ShareableList
 from multiprocessing import Lock, Manager, Process
 from multiprocessing.sharedctypes import Value, Array
+import fcntl
+import select
 import signal
 import socket
 import os
 from dotenv import load_dotenv
+import struct
 import sys
+import termios
+import time
 
+from lib import metrics, trace
+from lib.admin import create_admin_server
+from lib.async_server import AsyncChatServer, ChatMetrics
 from lib.clock import VectorClock
 from lib.discovery import Discovery
 from lib.address import Address
 from lib.election import Node
+from lib.framing import FrameDecoder, encode_client_message, encode_message
 from lib.internal_handler import InternalMessageHandler
 from lib.logger import Logger
+from lib.membership import MembershipTable
+from lib.message import ChatMessage, ChatMessageType
+from lib.rooms import RoomDirectory, room_key
+from lib.send_queue import OverflowPolicy, config_from_env
+
+# Locks of the client sockets in process mode, a socket takes the one of
+# its file descriptor number, the same in all processes
+CLIENT_LOCKS = 64
+# Rooms of the clients in process mode, by the file descriptor number of
+# their socket
+CLIENT_SLOTS = 65536
 
 
 # Starting point, listening to client messages
@@ -36,19 +55,30 @@ class Server():
             except OSError:
                 self.port += 1
 
-        # Sharable list
+        # Sharable membership table, MAX_REPLICA is only its initial size
         nr_replicas = int(os.getenv('MAX_REPLICA') or 3)
         self._create_shared_memory(nr_replicas)
 
+        # Metrics of all processes of the server, registered by the
+        # components below before the processes are forked
+        self._metrics = metrics.setup('metrics' + str(self.port))
+        self._chat_metrics = ChatMetrics(self._metrics)
+        # Spans of sampled chat messages and elections, see lib/trace.py
+        self._spans = trace.setup('traces' + str(self.port))
+        trace.set_node('{}:{}'.format(self.host, self.port))
+
         # Logger
         self._logger = Logger()
 
         # For ring and election
         self._internal_msg_handler = InternalMessageHandler(server_address=Address(
-            host=self.host, port=self.port))
+            host=self.host, port=self.port), membership=self._membership,
+            leader_id=self._leader_id, election_state=self._election_state)
         replica_address = Address(
             self._internal_msg_handler.host, self._internal_msg_handler.port)
         self.id = self._internal_msg_handler.election.id
+        # Servers of the chat rooms, on the ring of the members
+        self._rooms = RoomDirectory(self._internal_msg_handler.election)
 
         # For automatic discovery of host
         self._discovery_thread = Discovery(
@@ -57,9 +87,32 @@ class Server():
         self._discovery_thread.on_finish_discovery = self.on_finish_discovery
         self._discovery_thread.set_replica_address(replica_address)
         self._discovery_thread.set_on_message(self.on_message)
+        self._discovery_thread.set_get_members(
+            self._internal_msg_handler.election.get_ring)
+        self._discovery_thread.set_get_leader(self.get_leader_address)
 
         # Global vectorclock
         self._client_list = []
+        # Chat messages of this server sent to the leader, the own entry of
+        # the vector clock of every client process, see _submit
+        self._clock_count = Value('Q', 0)
+
+        # Chat serving mode: 'process' forks per client, 'asyncio' serves all
+        # clients on one event loop
+        self.server_mode = os.getenv('SERVER_MODE', 'process').lower()
+
+        # Bounded outbound queue per client in asyncio mode, see
+        # lib/send_queue.py. In process mode every client process writes to
+        # every client, so frames are written whole under the lock of the
+        # client socket, see _send_frame.
+        self._send_queue_config = config_from_env()
+        self._client_locks = [Lock() for _ in range(CLIENT_LOCKS)]
+        self.send_timeout = float(os.getenv('CLIENT_SEND_TIMEOUT') or 5)
+        # Room of every client as room_key, written by its client process
+        # and read by all that fan out, see lib/rooms.py
+        self._client_rooms = Array('Q', CLIENT_SLOTS, lock=False)
+        # Seconds between checks for a room that moved to another server
+        self.room_check_interval = float(os.getenv('ROOM_CHECK_INTERVAL') or 1)
 
     def run(self):
         # Get network
@@ -75,13 +128,26 @@ class Server():
             target=self._internal_msg_handler.listen_message)
 
         # Chatting function
-        t = Process(target=self.process_listen_client)
+        if self.server_mode == 'asyncio':
+            t = Process(target=self.serve_asyncio)
+        else:
+            t = Process(target=self.process_listen_client)
 
         dis_send_p.start()
         dis_start.start()
         p.start()
         t.start()
 
+        # Admin endpoint with the metrics, ADMIN_PORT empty disables it
+        admin_port = os.getenv('ADMIN_PORT')
+        if admin_port:
+            self._admin_server = create_admin_server(
+                os.getenv('ADMIN_HOST') or '127.0.0.1', int(admin_port), self._metrics,
+                self._spans)
+            self._logger.log_sys('Admin endpoint on http://{}:{}/metrics'.format(
+                *self._admin_server.server_address[:2]))
+            Process(target=self._admin_server.serve_forever).start()
+
     # ________chatting function _______________
 
     def _create_server_socket(self, host, port):
@@ -97,7 +163,13 @@ class Server():
         self._vector_clock = VectorClock(self.id)
         while True:
             client_soc, address = self.server_socket.accept()
-            print('Connected by {}:{}'.format(address[0], address[1]))
+            self._logger.debug('client', 'Connected by {}:{}', address[0], address[1])
+            if client_soc.fileno() >= CLIENT_SLOTS:
+                self._logger.log_error('Too many clients, closing {}:{}'.format(*address))
+                client_soc.close()
+                continue
+            self._client_rooms[client_soc.fileno()] = room_key(None)
+            self._chat_metrics.clients.inc()
             if client_soc not in self._client_list:
                 self._client_list.append(client_soc)
             t = Process(target=self._msgHandler,
@@ -105,32 +177,204 @@ class Server():
             t.start()
 
     def _msgHandler(self, client_sock, addr, vector_clock: VectorClock):
-        while True:
-            data = client_sock.recv(1024)
-            if len(data) == 0:
-                break
-            print(addr, ' >> ', data)
-            vector_clock.increment(self.id)
-            message = json.loads(data.decode())
-            self.broadcast_client_message(message, client_sock)
+        decoder = FrameDecoder()
+        room = None
+        checked_ring = None
+        # Queued bytes and slowness of the client in the queue gauges
+        reported = (0, False)
+        next_check = time.monotonic() + self.room_check_interval
+        try:
+            while True:
+                if time.monotonic() >= next_check:
+                    checked_ring = self._check_room(client_sock, room, checked_ring)
+                    reported = self._report_queue(client_sock, reported)
+                    next_check = time.monotonic() + self.room_check_interval
+                if not select.select([client_sock], [], [],
+                                     max(0, next_check - time.monotonic()))[0]:
+                    continue
+                if decoder.recv_into(client_sock) == 0:
+                    break
+                try:
+                    messages = list(decoder.messages())
+                except (ValueError, KeyError) as e:
+                    # Oversized frame or malformed message, as ChatConnection
+                    self._logger.log_error('Client {}:{} dropped: {}'.format(addr[0], addr[1], e))
+                    self._drop(client_sock)
+                    break
+                for message in messages:
+                    self._logger.debug('client', '{} >> {}', addr, message)
+                    if message.type != ChatMessageType.MESSAGE:
+                        room = self._join(message, client_sock, room)
+                        continue
+                    message.room = room
+                    self._chat_metrics.messages_in.inc()
+                    # Traces are sampled here, a trace the client sent is dropped
+                    message.trace = trace.start()
+                    if message.trace is not None:
+                        message.trace.hop('recv')
+                    self._submit(message, vector_clock)
+                    self.broadcast_client_message(message, client_sock)
+        finally:
+            self._client_rooms[client_sock.fileno()] = room_key(None)
+            self._chat_metrics.queued_bytes.dec(reported[0])
+            self._chat_metrics.slow_clients.dec(int(reported[1]))
+            self._chat_metrics.clients.dec()
+
+    def _drop(self, client_sock):
+        # The server and the other client processes hold the socket too, so
+        # closing it here would not end the connection
+        try:
+            client_sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _join(self, message, client_sock, room):
+        # Room of the client after a JOIN or LEAVE. Every client process
+        # fans out to the clients of the room in the shared room table.
+        if message.type != ChatMessageType.JOIN:
+            room = None
+        elif message.room is not None and not self._rooms.is_local(message.room):
+            self._redirect(client_sock, message.room)
+            return room
+        else:
+            room = message.room
+        self._client_rooms[client_sock.fileno()] = room_key(room)
+        if message.type == ChatMessageType.JOIN:
+            self._send_control(client_sock, ChatMessage(
+                '', '', type=ChatMessageType.JOIN, room=room))
+        return room
+
+    def _redirect(self, client_sock, room):
+        self._chat_metrics.redirects.inc()
+        # The client closes the connection, it stays in its room until then
+        self._send_control(client_sock, ChatMessage(
+            '', str(self._rooms.owner(room)), type=ChatMessageType.REDIRECT, room=room))
+
+    def _check_room(self, client_sock, room, checked_ring):
+        # After a membership change, redirects the client when its room
+        # moved to another server. Returns the ring checked.
+        if room is None:
+            return checked_ring
+        ring = self._rooms.ring()
+        if ring is not checked_ring and not self._rooms.is_local(room):
+            self._redirect(client_sock, room)
+        return ring
+
+    def _report_queue(self, client_sock, reported):
+        # Adds the change of the bytes waiting in the socket buffer of the
+        # client, its queue, to the gauges that every client process adds to
+        try:
+            queued, = struct.unpack('i', fcntl.ioctl(client_sock.fileno(), termios.TIOCOUTQ,
+                                                    b'\0\0\0\0'))
+        except OSError:
+            return reported
+        slow = queued > self._send_queue_config['low_watermark']
+        self._chat_metrics.queued_bytes.inc(queued - reported[0])
+        self._chat_metrics.slow_clients.inc(int(slow) - int(reported[1]))
+        return queued, slow
+
+    def _send_control(self, client_sock, message):
+        # Join answers and redirects wait for the client instead of being
+        # dropped, under the lock of the socket like the chat messages
+        self._send_frame(client_sock, encode_message(message), OverflowPolicy.PAUSE)
+
+    def serve_asyncio(self):
+        self._logger.log_client('Server started listening on {}:{} (asyncio)'.format(
+            self.host, self.port))
+        self._vector_clock = VectorClock(self.id)
+        self._chat_server = AsyncChatServer(
+            self.server_socket, on_message=self._on_client_message,
+            send_queue_config=self._send_queue_config, rooms=self._rooms)
+        self._chat_server.run()
+
+    def _on_client_message(self, message, address):
+        self._submit(message, self._vector_clock)
+
+    def _submit(self, message, vector_clock):
+        # Sends the message to the leader with the next count of the server
+        # in its clock. The client processes share the count, so the leader
+        # orders their messages as those of one sender, and a message that
+        # was not sent leaves no gap.
+        with self._clock_count.get_lock():
+            self._clock_count.value += 1
+            vector_clock.set(self.id, self._clock_count.value)
+            if not self._internal_msg_handler.submit_chat_message(message, vector_clock):
+                self._clock_count.value -= 1
+                vector_clock.set(self.id, self._clock_count.value)
 
     def broadcast_client_message(self, message, sock):
-        for client in self._client_list:
+        started = time.perf_counter()
+        data = encode_client_message(message)
+        sent = 0
+        room = room_key(message.room)
+        for client in list(self._client_list):
+            if self._client_rooms[client.fileno()] != room:
+                continue
             try:
-                client.send(str.encode(json.dumps(message)))
-            except BrokenPipeError:
-                self._client_list.remove(client)
-                print('Client disconnected')
+                if self._send_frame(client, data):
+                    sent += 1
+            except socket.timeout:
+                # Cut off inside a frame, the stream of the client is broken
+                self._logger.log_error('Evicting slow client {}'.format(client.getpeername()))
+                self._chat_metrics.evictions.inc()
+                client.shutdown(socket.SHUT_RDWR)
+                self._remove_client(client)
+            except (BrokenPipeError, ConnectionError, OSError):
+                self._remove_client(client)
+                self._logger.debug('client', 'Client disconnected')
+        self._chat_metrics.messages_out.inc(sent)
+        self._chat_metrics.fanout_seconds.observe(time.perf_counter() - started)
+        if message.trace is not None:
+            message.trace.hop('fanout to {}'.format(sent))
+
+    def _send_frame(self, client, data, policy=None):
+        # Writes the whole frame, or nothing when the client cannot take it.
+        # The socket buffer of the client is its queue: the policy applies
+        # when it is full before the frame starts. Returns False when the
+        # frame was dropped. Raises socket.timeout when the client took part
+        # of the frame but not the rest within send_timeout.
+        policy = policy or self._send_queue_config['policy']
+        with self._client_locks[client.fileno() % len(self._client_locks)]:
+            wait = self.send_timeout if policy == OverflowPolicy.PAUSE else 0
+            if not select.select([], [client], [], wait)[1]:
+                if policy == OverflowPolicy.DROP_OLDEST:
+                    self._chat_metrics.dropped.inc()
+                    return False
+                raise socket.timeout('Client does not read')
+            # Non blocking sends, the blocking mode of the socket is shared
+            # with the other client processes
+            view = memoryview(data)
+            deadline = time.monotonic() + self.send_timeout
+            while view:
+                try:
+                    nbytes = client.send(view, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    nbytes = 0
+                view = view[nbytes:]
+                self._chat_metrics.bytes_sent.inc(nbytes)
+                if view and not select.select(
+                        [], [client], [], max(0, deadline - time.monotonic()))[1]:
+                    raise socket.timeout('Client stopped reading inside a frame')
+        return True
+
+    def _remove_client(self, client):
+        if client in self._client_list:
+            self._client_list.remove(client)
 
     # ________broadcast listener _________________
 
     def on_message(self, message, address):
-        print('On message message: {} from {}'.format(message, address))
+        self._logger.debug('broadcast', 'On message message: {} from {}', message, address)
 
     # _______leader, worker and leader election_________________
     def get_network(self):
         self._discovery_thread.start_send_discovery()
 
+    def get_leader_address(self):
+        # Chat address of the leader, told to clients by discovery
+        leader_id = self._leader_id[0].strip()
+        return Node.fromJSON(leader_id).address if leader_id else None
+
     def on_discovery(self, message):
         replica_adr_str = message.message
         replica_adr = Address.from_string(replica_adr_str)
@@ -148,31 +392,45 @@ class Server():
             self._internal_msg_handler.election.raise_leader()
         else:
             self._internal_msg_handler.election.join_ring()
-        self._internal_msg_handler.election.start_p_send_heartbeat()
+        self._internal_msg_handler.start_membership()
 
     def _create_shared_memory(self, nr_replicas):
         try:
             port = self.port
-            self._replica_list = ShareableList(
-                [" " * 256] * nr_replicas, name="replica_list"+str(port))
+            # Replaces a stale table of a crashed server itself
+            self._membership = MembershipTable(
+                name="membership"+str(port), capacity=nr_replicas, create=True)
             self._leader_id = ShareableList(
                 [" " * 256], name="leader_id"+str(port))
-        except FileNotFoundError as e:
-            ShareableList(name="replica_list"+str(port)).shm.close()
-            ShareableList(name="replica_list"+str(port)).shm.unlink()
+        except FileExistsError as e:
             ShareableList(name="leader_id"+str(port)).shm.close()
             ShareableList(name="leader_id"+str(port)).shm.unlink()
-            self._replica_list = ShareableList(
-                [" " * 256] * nr_replicas, name="replica_list"+str(port))
             self._leader_id = ShareableList(
                 [" " * 256], name="leader_id"+str(port))
+        # Election epoch, epoch we take part in, epoch whose leader we know
+        # and its start time, see RingMember.inititate_election
+        try:
+            self._election_state = ShareableList(
+                [0, 0, 0, 0.0], name="election"+str(port))
+        except FileExistsError:
+            stale = ShareableList(name="election"+str(port))
+            stale.shm.close()
+            stale.shm.unlink()
+            self._election_state = ShareableList(
+                [0, 0, 0, 0.0], name="election"+str(port))
 
     def shutdown(self):
         self._discovery_thread.terminate()
         self._leader_id.shm.close()
         self._leader_id.shm.unlink()
-        self._replica_list.shm.close()
-        self._replica_list.shm.unlink()
+        self._election_state.shm.close()
+        self._election_state.shm.unlink()
+        self._membership.close()
+        self._membership.unlink()
+        self._metrics.close()
+        self._metrics.unlink()
+        self._spans.close()
+        self._spans.unlink()
         self._internal_msg_handler.terminate()
         self.server_socket.close()
         self._discovery_thread.terminate()
@@ -0,0 +1,178 @@
+# Test causal delivery of chat messages
+
+import multiprocessing
+import random
+import time
+import unittest
+from lib.causal import CausalQueue
+from lib.clock import ClockIndex, VectorClock
+from lib.dispatcher import Dispatcher
+from server import Server
+
+
+class TestCausalQueue(unittest.TestCase):
+    def setUp(self):
+        self.index = ClockIndex()
+        self.delivered = []
+
+    def make(self, **kwargs):
+        kwargs.setdefault('timeout', 10)
+        return CausalQueue(VectorClock('leader', self.index), self.delivered.append, **kwargs)
+
+    def entries(self, sender, counter, *depends):
+        return [(self.index.slot(sender), counter)] + [
+            (self.index.slot(id), count) for id, count in depends]
+
+    def test_fifo_per_sender(self):
+        queue = self.make()
+        queue.push(self.entries('a', 1), 'a1', now=0)
+        queue.push(self.entries('a', 3), 'a3', now=0)
+        queue.push(self.entries('a', 4), 'a4', now=0)
+        self.assertEqual(self.delivered, ['a1'])
+        self.assertEqual(len(queue), 2)
+        queue.push(self.entries('a', 2), 'a2', now=0)
+        self.assertEqual(self.delivered, ['a1', 'a2', 'a3', 'a4'])
+        self.assertEqual(len(queue), 0)
+        queue.push(self.entries('a', 3), 'a3', now=0)
+        self.assertEqual(queue.counts['duplicate'], 1)
+
+    def test_waits_for_dependencies(self):
+        queue = self.make()
+        queue.push(self.entries('a', 1), 'a1', now=0)
+        queue.push(self.entries('b', 1), 'b1', now=0)
+        # b2 saw a2, which is still on its way
+        queue.push(self.entries('b', 2, ('a', 2)), 'b2', now=0)
+        queue.push(self.entries('b', 3), 'b3', now=0)
+        self.assertEqual(self.delivered, ['a1', 'b1'])
+        queue.push(self.entries('a', 2), 'a2', now=0)
+        self.assertEqual(self.delivered, ['a1', 'b1', 'a2', 'b2', 'b3'])
+        self.assertEqual(queue.stats()['waiting'], 0)
+
+    def test_random_order(self):
+        # Chains of messages across 5 senders, each one depending on the
+        # previous message of another sender, arrive shuffled
+        rng = random.Random(7)
+        senders = ['s{}'.format(i) for i in range(5)]
+        counters = dict.fromkeys(senders, 0)
+        sent = []
+        previous = None
+        for _ in range(500):
+            sender = rng.choice(senders)
+            counters[sender] += 1
+            depends = [previous] if previous and previous[0] != sender else []
+            name = '{}:{}'.format(sender, counters[sender])
+            sent.append((self.entries(sender, counters[sender], *depends), name))
+            previous = (sender, counters[sender])
+        queue = self.make()
+        arrivals = list(sent)
+        rng.shuffle(arrivals)
+        for entries, name in arrivals:
+            queue.push(entries, name, now=0)
+        self.assertEqual(sorted(self.delivered), sorted(name for _, name in sent))
+        # Every message after the one it depends on
+        position = {name: i for i, name in enumerate(self.delivered)}
+        for entries, name in sent:
+            for slot, counter in entries[1:]:
+                self.assertLess(position['{}:{}'.format(self.index.ids[slot], counter)],
+                                position[name])
+        self.assertEqual(len(queue), 0)
+
+    def test_timeout_delivers(self):
+        queue = self.make(timeout=5)
+        queue.push(self.entries('a', 1), 'a1', now=0)
+        queue.push(self.entries('a', 3), 'a3', now=1)
+        queue.push(self.entries('a', 4), 'a4', now=2)
+        queue.push(self.entries('b', 1), 'b1', now=6)
+        # a2 is lost, a3 waited too long and takes a4 with it
+        self.assertEqual(self.delivered, ['a1', 'b1', 'a3', 'a4'])
+        self.assertEqual(queue.counts['lost'], 1)
+        queue.push(self.entries('a', 2), 'a2', now=7)
+        self.assertEqual(queue.counts['duplicate'], 1)
+
+    def test_expires_when_quiet(self):
+        # The timer of the log lane gives up on a2 without another arrival
+        queue = self.make(timeout=0.2)
+        dispatcher = Dispatcher()
+        self.addCleanup(dispatcher.stop)
+        dispatcher.every('log', 0.05, queue.expire)
+        queue.push(self.entries('a', 1), 'a1')
+        queue.push(self.entries('a', 3), 'a3')
+        deadline = time.monotonic() + 5
+        while len(self.delivered) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.delivered, ['a1', 'a3'])
+
+    def test_timeout_skips_only_lost(self):
+        queue = self.make(timeout=5)
+        queue.push(self.entries('a', 1), 'a1', now=0)
+        queue.push(self.entries('b', 1), 'b1', now=0)
+        # b2 saw a3, a2 is lost and a3 waits for it
+        queue.push(self.entries('b', 2, ('a', 3)), 'b2', now=1)
+        queue.push(self.entries('a', 3), 'a3', now=2)
+        queue.expire(now=6)
+        self.assertEqual(self.delivered, ['a1', 'b1', 'a3', 'b2'])
+        self.assertEqual(queue.stats(), {'delivered': 4, 'lost': 1, 'held': 0, 'waiting': 0})
+
+    def test_bounded_drop(self):
+        queue = self.make(max_held=2, policy='drop')
+        queue.push(self.entries('a', 1), 'a1', now=0)
+        for counter in (3, 4, 5):
+            queue.push(self.entries('a', counter), 'a{}'.format(counter), now=0)
+        # a3 was dropped once three waited, a4 and a5 follow the gap
+        self.assertEqual(self.delivered, ['a1', 'a4', 'a5'])
+        self.assertEqual(queue.counts['dropped'], 1)
+        self.assertEqual(len(queue), 0)
+
+    def test_new_leader_and_restart(self):
+        queue = self.make(timeout=1)
+        # Earlier messages went to the previous leader
+        queue.push(self.entries('a', 41), 'a41', now=0)
+        queue.push(self.entries('a', 42), 'a42', now=0.5)
+        self.assertEqual(self.delivered, [])
+        queue.push(self.entries('b', 1), 'b1', now=1)
+        self.assertEqual(self.delivered, ['b1', 'a41', 'a42'])
+        self.assertEqual(queue.counts['lost'], 1)
+        queue.push(self.entries('a', 1), 'again', now=1)
+        self.assertEqual(self.delivered, ['b1', 'a41', 'a42', 'again'])
+
+
+class _Leader():
+    # Replica handler of a client process, records the count of the server
+    # in every message it sends
+    def __init__(self, counts):
+        self.counts = counts
+        self.fail = False
+
+    def submit_chat_message(self, message, clock=None):
+        if self.fail:
+            return False
+        self.counts.put(clock['server'])
+        return True
+
+
+class TestServerClock(unittest.TestCase):
+    def test_client_processes_share_count(self):
+        context = multiprocessing.get_context('fork')
+        counts = context.Queue()
+        server = Server.__new__(Server)
+        server.id = 'server'
+        server._clock_count = context.Value('Q', 0)
+        server._internal_msg_handler = _Leader(counts)
+
+        def client(n):
+            clock = VectorClock('server', ClockIndex())
+            for _ in range(n):
+                server._submit(None, clock)
+
+        processes = [context.Process(target=client, args=(5,)) for _ in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(sorted(counts.get(timeout=5) for _ in range(15)), list(range(1, 16)))
+        # A message that was not sent leaves no gap
+        server._internal_msg_handler.fail = True
+        client(1)
+        server._internal_msg_handler.fail = False
+        client(1)
+        self.assertEqual(counts.get(timeout=5), 16)
@@ -0,0 +1,102 @@
+# Test replica request channel
+
+import socket
+import threading
+import unittest
+from lib import wire
+from lib.address import Address
+from lib.channel import ReplicaChannel, RttEstimator
+from lib.message import Message, MessageType
+
+
+class Responder():
+    # Answers requests in reverse order, once `batch` requests arrived
+    def __init__(self, batch=1, legacy=False):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = Address(*self.sock.getsockname())
+        self.batch = batch
+        self.legacy = legacy
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        received = []
+        while True:
+            data, address = self.sock.recvfrom(65535)
+            received.append((wire.loads(data), address))
+            if len(received) < self.batch:
+                continue
+            for request, address in reversed(received):
+                if self.legacy:
+                    self.sock.sendto(b'legacy', address)
+                    continue
+                res = Message(message=request.message, type=MessageType.PING_RES,
+                              correlation_id=request.correlation_id)
+                self.sock.sendto(wire.encode(res), address)
+            received = []
+
+
+class TestChannel(unittest.TestCase):
+    def setUp(self):
+        self.channel = ReplicaChannel(
+            host='127.0.0.1', min_timeout=0.05, max_timeout=0.5)
+
+    def tearDown(self):
+        self.channel.close()
+
+    def test_responses_matched_out_of_order(self):
+        responder = Responder(batch=3)
+        futures = [self.channel.request(Message(str(i), MessageType.PING_REQ), responder.address)
+                   for i in range(3)]
+        self.assertEqual([f.result(timeout=2).message for f in futures], ['0', '1', '2'])
+        self.assertEqual(self.channel.in_flight(), 0)
+        self.assertLess(self.channel.timeout_for(responder.address), 0.5)
+
+    def test_timeout(self):
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent.bind(('127.0.0.1', 0))
+        try:
+            future = self.channel.request(Message('', MessageType.PING_REQ),
+                                          silent.getsockname())
+            with self.assertRaises(TimeoutError):
+                future.result(timeout=2)
+        finally:
+            silent.close()
+
+    def test_bad_replies(self):
+        responder = Responder()
+        self.channel.request(Message('', MessageType.PING_REQ), responder.address).result(
+            timeout=2)
+        garbage = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # A truncated binary reply and one that is not UTF-8 either
+            for data in (b'\xdb\x01', b'\xff', b'"[]"'):
+                garbage.sendto(data, self.channel.sock.getsockname())
+        finally:
+            garbage.close()
+        future = self.channel.request(Message('ok', MessageType.PING_REQ), responder.address)
+        self.assertEqual(future.result(timeout=2).message, 'ok')
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent.bind(('127.0.0.1', 0))
+        try:
+            future = self.channel.request(Message('', MessageType.PING_REQ),
+                                          silent.getsockname())
+            with self.assertRaises(TimeoutError):
+                future.result(timeout=2)
+        finally:
+            silent.close()
+
+    def test_legacy_response(self):
+        responder = Responder(legacy=True)
+        future = self.channel.request(Message('', MessageType.GET_LEADER), responder.address)
+        self.assertEqual(future.result(timeout=2), 'legacy')
+
+
+class TestRttEstimator(unittest.TestCase):
+    def test_adapts_and_backs_off(self):
+        estimator = RttEstimator(5, 0.1, 5)
+        for _ in range(10):
+            estimator.sample(0.01)
+        self.assertEqual(estimator.timeout, 0.1)
+        estimator.backoff()
+        self.assertEqual(estimator.timeout, 0.2)
@@ -0,0 +1,159 @@
+# Test the chat client against servers on localhost
+
+import asyncio
+from contextlib import redirect_stdout
+import io
+import os
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+from client import Client
+from lib.address import Address
+from lib.async_server import AsyncChatServer
+from lib.discovery import Discovery
+from lib.framing import encode_frame
+
+
+class LocalServer():
+    # AsyncChatServer on its own event loop thread, stop() kills it and
+    # every client connection
+    def __init__(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen()
+        self.address = Address(*sock.getsockname())
+        self.server = AsyncChatServer(sock)
+        self.loop = asyncio.new_event_loop()
+        self.task = self.loop.create_task(self.server.serve())
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        def kill():
+            for connection in list(self.server._clients):
+                connection.transport.abort()
+            self.task.cancel()
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(kill)
+            self.thread.join(5)
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.servers = [LocalServer(), LocalServer()]
+        for server in self.servers:
+            self.addCleanup(server.stop)
+        # The second server answers discovery and names itself the leader
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        self.broadcast_port = probe.getsockname()[1]
+        probe.close()
+        leader = self.servers[1].address
+        self.discovery = Discovery(leader.host, leader.port, self.broadcast_port)
+        self.discovery.set_replica_address(Address(leader.host, 1))
+        self.discovery.set_get_members(lambda: [])
+        self.discovery.set_get_leader(lambda: leader)
+        thread = threading.Thread(target=self.discovery.listen, daemon=True)
+        thread.start()
+        self.addCleanup(self.stop_discovery, thread)
+
+    def stop_discovery(self, thread):
+        self.discovery._stop_req = True
+        self.discovery.recv_socket.sendto(b'', ('127.0.0.1', self.broadcast_port))
+        thread.join(5)
+        self.discovery.terminate()
+
+    def make_client(self, address):
+        client = Client(address.host, address.port, 'alice', broadcast_ip='127.0.0.1',
+                        broadcast_port=self.broadcast_port)
+        client.received = []
+        client.on_message = lambda message: client.received.append(message.message)
+        self.addCleanup(client.shutdown)
+        return client
+
+    def wait_for(self, client, message):
+        deadline = time.monotonic() + 5
+        while message not in client.received and time.monotonic() < deadline:
+            client.poll(0.05)
+        self.assertIn(message, client.received)
+
+    def test_batched_sends(self):
+        client = self.make_client(self.servers[0].address)
+        client.connect()
+        for i in range(1000):
+            client.send_message('message {}'.format(i))
+        self.wait_for(client, 'message 999')
+        self.assertEqual(client.received, ['message {}'.format(i) for i in range(1000)])
+
+    def test_reconnect_to_leader(self):
+        client = self.make_client(self.servers[0].address)
+        client.connect()
+        client.send_message('one')
+        self.wait_for(client, 'one')
+        self.servers[0].stop()
+        client.send_message('two')
+        self.wait_for(client, 'two')
+        self.assertEqual(client.address, self.servers[1].address)
+        self.assertEqual(client.reconnects, 1)
+
+    def test_malformed_frame(self):
+        # A server that sends garbage is dropped like a lost one
+        garbage = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(garbage.close)
+        garbage.bind(('127.0.0.1', 0))
+        garbage.listen()
+        client = self.make_client(Address(*garbage.getsockname()))
+        client.connect()
+        connection, _ = garbage.accept()
+        self.addCleanup(connection.close)
+        connection.sendall(encode_frame(b'not json'))
+        deadline = time.monotonic() + 5
+        while client.reconnects == 0 and time.monotonic() < deadline:
+            client.poll(0.05)
+        client.send_message('after')
+        self.wait_for(client, 'after')
+        self.assertEqual(client.address, self.servers[1].address)
+
+    def test_first_server_down(self):
+        self.servers[0].stop()
+        client = self.make_client(self.servers[0].address)
+        client.connect()
+        self.assertEqual(client.address, self.servers[1].address)
+
+    def test_gives_up(self):
+        # Discovery names a server that is gone: the client keeps the loop
+        # responsive while it retries, and gives up after the timeout
+        self.servers[0].stop()
+        self.servers[1].stop()
+        client = self.make_client(self.servers[0].address)
+        client.reconnect_timeout = 1
+        started = time.monotonic()
+        client.reconnect()
+        with self.assertRaises(ConnectionError):
+            while time.monotonic() - started < 5:
+                polled = time.monotonic()
+                client.poll(0.05)
+                self.assertLess(time.monotonic() - polled, 0.5)
+        self.assertLess(time.monotonic() - started, 3)
+
+    def test_run_exits_when_given_up(self):
+        self.servers[1].stop()
+        client = self.make_client(self.servers[0].address)
+        client.reconnect_timeout = 1
+        read, write = os.pipe()
+        self.addCleanup(os.close, write)
+        stdin = os.fdopen(read)
+        self.addCleanup(stdin.close)
+        threading.Timer(0.5, self.servers[0].stop).start()
+        started = time.monotonic()
+        with mock.patch('sys.stdin', stdin), redirect_stdout(io.StringIO()):
+            self.assertFalse(client.run())
+        self.assertLess(time.monotonic() - started, 5)
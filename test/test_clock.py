@@ -0,0 +1,100 @@
+# Test vector clocks and their delta encoding
+
+from multiprocessing import Pipe
+import unittest
+from lib import clock
+from lib.clock import (AFTER, BEFORE, CONCURRENT, EQUAL, ClockIndex, DeltaEncoder,
+                       VectorClock, compare_many)
+
+
+class TestVectorClock(unittest.TestCase):
+    def setUp(self):
+        self.index = ClockIndex()
+
+    def make(self, id):
+        return VectorClock(id, self.index)
+
+    def test_compare(self):
+        a, b = self.make('a'), self.make('b')
+        self.assertEqual(a.compare(b), EQUAL)
+        a.increment()
+        self.assertEqual(b.compare(a), BEFORE)
+        self.assertTrue(b.happens_before(a))
+        b.merge(a)
+        b.increment()
+        self.assertEqual(b.compare(a), AFTER)
+        a.increment()
+        self.assertEqual(a.compare(b), CONCURRENT)
+        self.assertFalse(a.happens_before(b))
+        self.assertEqual(b.vcDictionary, {'a': 1, 'b': 1})
+
+    def test_merge_takes_maximum(self):
+        a, b = self.make('a'), self.make('b')
+        for _ in range(3):
+            a.increment()
+        b.increment('a')
+        b.increment()
+        b.merge(a)
+        self.assertEqual((b['a'], b['b']), (3, 1))
+        # a was created before slot 'b' existed
+        a.merge(b)
+        self.assertEqual(a.compare(b), EQUAL)
+
+    def test_compare_many(self):
+        base = self.make('a')
+        base.increment()
+        others = [self.make('b'), base.copy(), base.copy(), base.copy()]
+        others[2].increment('a')
+        others[3].increment('c')
+        others[3].counters[0] = 0
+        self.assertEqual(compare_many(base, others), [AFTER, EQUAL, BEFORE, CONCURRENT])
+
+    def test_delta_between_processes(self):
+        # Every process has its own slots, deltas name the ids by digest
+        sender = VectorClock('a', ClockIndex())
+        receiver = VectorClock('b', ClockIndex())
+        sender.increment('c')
+        sender.increment()
+        receiver.merge_delta(sender.encode_delta())
+        self.assertEqual(receiver['a'], 1)
+        self.assertEqual(receiver['c'], 1)
+        self.assertEqual(receiver.compare(VectorClock('x', ClockIndex())), AFTER)
+
+    def test_delta_sends_changes_only(self):
+        a = self.make('a')
+        for id in ('b', 'c', 'd'):
+            a.increment(id)
+        deltas = DeltaEncoder(a, full_every=4)
+        entry = clock.DIGEST_SIZE + 1
+        self.assertEqual(len(deltas.encode('peer')), 4 * entry)
+        # The own entry is always sent, and first
+        self.assertEqual(deltas.encode('peer'), clock.digest('a') + b'\x00')
+        a.increment()
+        a.increment('c')
+        self.assertEqual(len(deltas.encode('peer')), 2 * entry)
+        self.assertEqual(len(deltas.encode('other')), 4 * entry)
+        self.assertEqual(len(deltas.encode('peer')), entry)
+        # Every fourth message after the first carries everything again
+        self.assertEqual(len(deltas.encode('peer')), 4 * entry)
+
+    def test_read_delta(self):
+        sender = VectorClock('a', ClockIndex())
+        sender.increment('c')
+        sender.increment()
+        receiver = VectorClock('b', ClockIndex())
+        slots = receiver.index
+        entries = receiver.read_delta(sender.encode_delta())
+        self.assertEqual(entries, [(slots.slot('a'), 1), (slots.slot('c'), 1)])
+
+    def test_large_counters(self):
+        a, b = VectorClock('a', ClockIndex()), VectorClock('b', ClockIndex())
+        a.counters[0] = 2 ** 40 + 5
+        b.merge_delta(a.encode_delta())
+        self.assertEqual(b['a'], 2 ** 40 + 5)
+
+    def test_send_and_receive_event(self):
+        a, b = self.make('a'), self.make('b')
+        sender, receiver = Pipe()
+        a.send_event(sender, a, 1)
+        b.receive_event(receiver, b, 2)
+        self.assertEqual((b['a'], b['b']), (1, 1))
@@ -0,0 +1,206 @@
+# Test discovery with simulated nodes
+
+import heapq
+import json
+import random
+import socket
+import threading
+import unittest
+from lib import wire
+from lib.address import Address
+from lib.discovery import Discovery, find_servers
+from lib.election import Node
+from lib.message import Message, MessageType
+
+
+class SimNetwork():
+    # Delivers datagrams between simulated nodes on a virtual clock
+    def __init__(self, seed=1, min_latency=0.0005, max_latency=0.005):
+        self.random = random.Random(seed)
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        self.now = 0
+        self.nodes = []
+        self.datagrams = 0
+        self.deliveries = 0
+        self._events = []
+        self._seq = 0
+
+    def schedule(self, at, callback):
+        self._seq += 1
+        heapq.heappush(self._events, (at, self._seq, callback))
+
+    def _deliver(self, callback):
+        self.deliveries += 1
+        self.schedule(self.now + self.random.uniform(self.min_latency, self.max_latency),
+                      callback)
+
+    def broadcast(self, sender, data):
+        self.datagrams += 1
+        for node in self.nodes:
+            if node.listening:
+                self._deliver(lambda node=node: node.receive(data, sender.send_address))
+
+    def unicast(self, data, address):
+        self.datagrams += 1
+        node = address[2]
+        self._deliver(lambda: node.receive_response(data))
+
+    def run(self, until):
+        while self._events and self._events[0][0] <= until:
+            self.now, _, callback = heapq.heappop(self._events)
+            callback()
+
+
+class SimDiscovery(Discovery):
+    def __init__(self, network, host, port):
+        self.network = network
+        self.listening = False
+        self.send_address = (host, port, self)
+        self.members = {(host, port): Address(host, port + 1000)}
+        super().__init__(host, port, broadcast_port=5972)
+        self.set_replica_address(Address(host, port + 1000))
+        self.on_discovery = self._on_discovery
+        self.set_get_members(lambda: [Node(Address(*address), replica)
+                                      for address, replica in self.members.items()])
+        self._suppress_scheduled = False
+
+    def setup_broadcast_socket(self):
+        pass
+
+    def _now(self):
+        return self.network.now
+
+    def _broadcast(self, data):
+        self.datagrams_sent += 1
+        self.network.broadcast(self, data)
+
+    def _reply(self, data, address):
+        self.datagrams_sent += 1
+        self.network.unicast(data, address)
+
+    def _on_discovery(self, message):
+        self.members[(message.host, message.port)] = Address.from_string(message.message)
+
+    def boot(self):
+        self.listening = True
+        self.start_discovery()
+
+    def receive(self, data, address):
+        self.process_message(data, address)
+        self._wake()
+
+    def _wake(self):
+        next_due = self.send_due_replies(self.network.now)
+        if next_due is not None:
+            self.network.schedule(next_due, self._wake)
+
+    def receive_response(self, data):
+        message = wire.loads(data)
+        if message.type != MessageType.DISCOVERY_RES:
+            return
+        self.handle_response(message)
+        if not self._suppress_scheduled:
+            self._suppress_scheduled = True
+            self.network.schedule(self.network.now + self.REPLY_JITTER / 10,
+                                  self.suppress_replies)
+
+
+class TestDiscovery(unittest.TestCase):
+    def boot_cluster(self, nr_nodes, boot_window, seed):
+        network = SimNetwork(seed=seed)
+        nodes = [SimDiscovery(network, '10.0.{}.{}'.format(i // 250, i % 250 + 1), 3000)
+                 for i in range(nr_nodes)]
+        network.nodes = nodes
+        for node in nodes:
+            network.schedule(network.random.uniform(0, boot_window), node.boot)
+
+        converged_at = None
+        step = 0.001
+        while converged_at is None and network.now < 10:
+            network.run(network.now + step)
+            network.now += step
+            if all(len(node.members) == nr_nodes for node in nodes):
+                converged_at = network.now
+        network.run(network.now + 1)
+        return network, nodes, converged_at
+
+    def test_50_nodes_converge(self):
+        nr_nodes = 50
+        network, nodes, converged_at = self.boot_cluster(nr_nodes, boot_window=0.05, seed=7)
+        self.assertIsNotNone(converged_at)
+        for node in nodes:
+            self.assertEqual(len(node.members), nr_nodes)
+
+        # The old protocol sends one broadcast response per listening node
+        # for every request: up to N + N * (N - 1) broadcasts, each delivered
+        # to all N nodes
+        legacy = nr_nodes + nr_nodes * (nr_nodes - 1)
+        print('\n{} nodes converged in {:.3f}s with {} datagrams ({} deliveries), '
+              '{} replies suppressed; old protocol: up to {} broadcasts ({} deliveries)'.format(
+                  nr_nodes, converged_at, network.datagrams, network.deliveries,
+                  sum(node.replies_suppressed for node in nodes), legacy, legacy * nr_nodes))
+        self.assertLess(network.datagrams, legacy / 3)
+        self.assertLess(network.deliveries, legacy * nr_nodes / 20)
+
+    def test_repeated_request_ignored(self):
+        network = SimNetwork()
+        node = SimDiscovery(network, '10.0.0.1', 3000)
+        requester = SimDiscovery(network, '10.0.0.2', 3000)
+        network.nodes = [node]
+        node.listening = True
+        requester.boot()
+        requester.start_discovery()
+        network.run(1)
+        self.assertEqual(node.datagrams_sent, 1)
+        self.assertIn(('10.0.0.1', 3000), requester.members)
+
+    def test_client_request(self):
+        network = SimNetwork()
+        node = SimDiscovery(network, '10.0.0.1', 3000)
+        node.set_get_leader(lambda: Address('10.0.0.9', 3000))
+        client = SimDiscovery(network, '10.0.0.2', 40000)
+        request = Message(message=json.dumps({'client': True}), host='10.0.0.2', port=40000,
+                          type=MessageType.DISCOVERY_REQ)
+        responses = []
+        client.receive_response = lambda data: responses.append(wire.loads(data))
+        node.process_message(wire.dumps(request), client.send_address)
+        network.run(1)
+        # Answered at once, and a client is no member
+        self.assertEqual(node.datagrams_sent, 1)
+        self.assertNotIn(('10.0.0.2', 40000), node.members)
+        self.assertEqual(json.loads(responses[0].message)['leader'], ['10.0.0.9', 3000])
+
+    def test_malformed_dropped(self):
+        network = SimNetwork()
+        node = SimDiscovery(network, '10.0.0.1', 3000)
+        client = SimDiscovery(network, '10.0.0.2', 40000)
+        responses = []
+        client.receive_response = lambda data: responses.append(wire.loads(data))
+        no_replica = Message(message=json.dumps({'round': 0, 'known': []}), host='10.0.0.3',
+                             port=3000, type=MessageType.DISCOVERY_REQ)
+        for data in (b'\xdb\x01', b'"[]"', wire.dumps(no_replica)):
+            node.process_message(data, client.send_address)
+        # Still answers
+        request = Message(message=json.dumps({'client': True}), host='10.0.0.2', port=40000,
+                          type=MessageType.DISCOVERY_REQ)
+        node.process_message(wire.dumps(request), client.send_address)
+        network.run(1)
+        self.assertEqual(len(responses), 1)
+
+    def test_find_servers_skips_malformed(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        self.addCleanup(server.close)
+        bad = Message(message='{"members": [1]}', host='127.0.0.1', port=3000,
+                      type=MessageType.DISCOVERY_RES)
+        good = Message(message=json.dumps({'replica': '127.0.0.1:5970', 'members': []}),
+                       host='127.0.0.1', port=3001, type=MessageType.DISCOVERY_RES)
+
+        def answer():
+            address = server.recvfrom(65535)[1]
+            for data in (b'\xff', wire.dumps(bad), wire.dumps(good)):
+                server.sendto(data, address)
+        threading.Thread(target=answer, daemon=True).start()
+        servers = find_servers('127.0.0.1', server.getsockname()[1], wait=2)
+        self.assertEqual(servers, [Address('127.0.0.1', 3001)])
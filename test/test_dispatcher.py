@@ -0,0 +1,67 @@
+# Test replica message dispatcher
+
+import threading
+import unittest
+from lib.dispatcher import Dispatcher, POOL
+from lib.message import Message, MessageType
+
+
+class TestDispatcher(unittest.TestCase):
+    def test_inline_and_default(self):
+        handled = []
+        dispatcher = Dispatcher(workers=0, default=lambda m, a: handled.append(('default', m.message)))
+        dispatcher.register(MessageType.PING_REQ, lambda m, a: handled.append(('ping', m.message)))
+        dispatcher.dispatch(Message('1', MessageType.PING_REQ), None)
+        dispatcher.dispatch(Message('2', MessageType.GET_LEADER), None)
+        self.assertEqual(handled, [('ping', '1'), ('default', '2')])
+
+    def test_ordered_lane_keeps_arrival_order(self):
+        handled = []
+        done = threading.Event()
+
+        def handler(message, address):
+            handled.append(message.message)
+            if len(handled) == 100:
+                done.set()
+
+        dispatcher = Dispatcher(workers=4)
+        dispatcher.register(MessageType.ELECTION_REQ, handler, lane='election')
+        dispatcher.register(MessageType.LEADER_REQ, handler, lane='election')
+        for i in range(100):
+            type = MessageType.ELECTION_REQ if i % 2 else MessageType.LEADER_REQ
+            dispatcher.dispatch(Message(i, type), None)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(handled, list(range(100)))
+        dispatcher.stop()
+
+    def test_default_lane(self):
+        # Messages without a handler keep their order with those of the lane
+        handled = []
+        threads = set()
+        done = threading.Event()
+
+        def handler(message, address):
+            handled.append(message.message)
+            threads.add(threading.current_thread().name)
+            if len(handled) == 100:
+                done.set()
+
+        dispatcher = Dispatcher(workers=4, default=handler, default_lane='election')
+        dispatcher.register(MessageType.ELECTION_REQ, handler, lane='election')
+        for i in range(100):
+            type = MessageType.ELECTION_REQ if i % 2 else MessageType.ELECTION_RES
+            dispatcher.dispatch(Message(i, type), None)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(handled, list(range(100)))
+        self.assertEqual(threads, {'dispatch-election'})
+        dispatcher.stop()
+
+    def test_handler_error_does_not_stop_dispatch(self):
+        done = threading.Event()
+        dispatcher = Dispatcher(workers=2)
+        dispatcher.register(MessageType.MESSAGE, lambda m, a: 1 / 0, lane=POOL)
+        dispatcher.register(MessageType.PING_REQ, lambda m, a: done.set(), lane=POOL)
+        dispatcher.dispatch(Message('', MessageType.MESSAGE), None)
+        dispatcher.dispatch(Message('', MessageType.PING_REQ), None)
+        self.assertTrue(done.wait(2))
+        dispatcher.stop()
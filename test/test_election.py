@@ -0,0 +1,70 @@
+# Test the election strategies with simulated members
+
+import os
+import unittest
+from unittest import mock
+from lib.address import Address
+from lib.election import Node
+from lib.sim import SimLinks, SimRingMember
+
+
+class TestElection(unittest.TestCase):
+    def make_cluster(self, strategy, nr_nodes):
+        with mock.patch.dict(os.environ, {'ELECTION_STRATEGY': strategy}):
+            cluster = SimLinks(latency=0.001)
+            self.addCleanup(cluster.close)
+            table = cluster.table()
+            # Hosts .1 to .N, in shuffled order so the ring is not the join order
+            hosts = [(i * 7) % nr_nodes + 1 for i in range(nr_nodes)]
+            return cluster, [SimRingMember(cluster, Address('10.0.0.{}'.format(i), 3000),
+                                           membership=table) for i in hosts]
+
+    def assertLeader(self, members, host):
+        for member in members:
+            self.assertEqual(Node.fromJSON(member.leader_id[0]).address.host, host)
+            self.assertFalse(member.participant)
+
+    def test_key_is_numeric(self):
+        low = Node(Address('10.0.0.9', 3000))
+        high = Node(Address('10.0.0.10', 3000))
+        self.assertGreater(high.key, low.key)
+        self.assertLess(high.id, low.id)
+
+    def test_highest_live_member_elected(self):
+        for strategy in ('ring', 'bully'):
+            cluster, members = self.make_cluster(strategy, 10)
+            # The leader, 10.0.0.10, crashed
+            dead = next(member for member in members if member.address.host == '10.0.0.10')
+            cluster.down.add(dead.replica_address)
+            dead.nodes.remove(dead)
+            alive = [member for member in members if member is not dead]
+            alive[0].inititate_election()
+            cluster.run()
+            self.assertLeader(alive, '10.0.0.9')
+
+    def test_concurrent_elections_coalesce(self):
+        for strategy in ('ring', 'bully'):
+            cluster, members = self.make_cluster(strategy, 8)
+            for member in members:
+                member.inititate_election()
+            epoch = members[0].election_epoch
+            # Detecting the same failure again during the election
+            members[0].inititate_election()
+            self.assertEqual(members[0].election_epoch, epoch)
+            cluster.run()
+            self.assertLeader(members, '10.0.0.8')
+            self.assertEqual({member.election_epoch for member in members}, {1})
+            if strategy == 'bully':
+                # One takeover request per initiator, one announcement per member
+                self.assertLessEqual(cluster.messages, 2 * len(members))
+
+    def test_messages_of_older_election_ignored(self):
+        cluster, members = self.make_cluster('ring', 3)
+        members[0].inititate_election()
+        cluster.run()
+        leader = members[0].leader_id[0]
+        members[1].inititate_election()
+        cluster.run()
+        members[0].receive_leader({'epoch': 1, 'id': members[1].id})
+        self.assertEqual(members[0].election_epoch, 2)
+        self.assertEqual(members[0].leader_id[0], leader)
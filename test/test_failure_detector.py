@@ -0,0 +1,90 @@
+# Test the phi accrual failure detector and the successor check
+
+from multiprocessing.shared_memory import ShareableList
+import os
+import unittest
+from lib.address import Address
+from lib.election import Node, RingMember
+from lib.failure_detector import PhiAccrualDetector
+from lib.membership import MembershipTable, ALIVE, SUSPECT
+
+
+class TestPhiAccrualDetector(unittest.TestCase):
+    def test_phi_grows_without_heartbeats(self):
+        detector = PhiAccrualDetector(threshold=8, interval=1)
+        self.assertEqual(detector.phi('a', 0), 0)
+        for i in range(20):
+            detector.heartbeat('a', i)
+        self.assertLess(detector.phi('a', 19.5), 1)
+        self.assertTrue(detector.is_available('a', 20.2))
+        self.assertLess(detector.phi('a', 20.5), detector.phi('a', 21))
+        self.assertFalse(detector.is_available('a', 23))
+        detector.remove('a')
+        self.assertEqual(detector.phi('a', 23), 0)
+
+    def test_irregular_heartbeats_raise_tolerance(self):
+        regular = PhiAccrualDetector(interval=1)
+        irregular = PhiAccrualDetector(interval=1)
+        now = 0
+        for i in range(50):
+            regular.heartbeat('a', i)
+            now += 0.5 if i % 2 else 1.5
+            irregular.heartbeat('a', now)
+        self.assertLess(irregular.phi('a', now + 2), regular.phi('a', 49 + 2))
+
+
+class TestCheckNextNode(unittest.TestCase):
+    def setUp(self):
+        port = 40000 + os.getpid() % 20000
+        self.table = MembershipTable('membership{}'.format(port), capacity=2, create=True)
+        self.leader_id = ShareableList([" " * 256], name='leader_id{}'.format(port))
+        self.replies = []
+        self.statuses = []
+        self.clock = 0
+        self.member = RingMember(address=Address('127.0.0.1', port),
+                                 replica_address=Address('127.0.0.1', port + 1),
+                                 send=self.send, membership=self.table,
+                                 election_state=[0, 0, 0, 0.0])
+        self.member._now = lambda: self.clock
+        self.member._sleep = self.sleep
+        self.member.heartbeat_interval = 1
+        self.member.failure_detector = PhiAccrualDetector(interval=1)
+        self.peer = Node(Address('127.0.0.2', port), Address('127.0.0.2', port + 1))
+        self.table.add(self.member)
+        self.table.add(self.peer)
+        # A leader is known, so checking the successor starts no election
+        self.leader_id[0] = self.peer.id
+
+    def tearDown(self):
+        for shared in (self.table, self.leader_id.shm):
+            shared.close()
+            shared.unlink()
+
+    def sleep(self, seconds):
+        self.clock += seconds
+
+    def send(self, message, address):
+        self.clock += 0.01
+        self.statuses.append(self.table.get(self.peer).status)
+        return message if self.replies.pop(0) else None
+
+    def heartbeats(self, replies):
+        self.replies = list(replies)
+        while self.replies and self.peer in self.table:
+            self.sleep(1)
+            self.member.check_next_node()
+
+    def test_lost_ping_is_retried(self):
+        self.heartbeats([True] * 10 + [False, False, True] + [True] * 5)
+        self.assertIn(self.peer, self.table)
+
+    def test_dead_after_retries(self):
+        self.heartbeats([True] * 10 + [False] * 10)
+        self.assertNotIn(self.peer, self.table)
+        # First miss and heartbeat_retries retries, until phi crossed the threshold
+        self.assertGreaterEqual(len(self.statuses), 14)
+
+    def test_suspect_while_retrying(self):
+        self.heartbeats([True] * 10 + [False, False, True])
+        self.assertEqual(self.statuses[-3:], [ALIVE, SUSPECT, SUSPECT])
+        self.assertEqual(self.table.get(self.peer).status, ALIVE)
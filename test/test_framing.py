@@ -0,0 +1,54 @@
+# Test frame codec
+
+import socket
+import unittest
+from lib.framing import FrameDecoder, encode_frame, encode_message
+from lib.message import ChatMessage
+
+
+class TestFraming(unittest.TestCase):
+    def test_coalesced_frames(self):
+        decoder = FrameDecoder()
+        decoder.feed(encode_frame(b'one') + encode_frame(b'two'))
+        self.assertEqual(list(decoder.frames()), [b'one', b'two'])
+        self.assertEqual(len(decoder), 0)
+
+    def test_split_frame(self):
+        decoder = FrameDecoder()
+        data = encode_frame(b'hello world')
+        decoder.feed(data[:2])
+        self.assertEqual(list(decoder.frames()), [])
+        decoder.feed(data[2:7])
+        self.assertEqual(list(decoder.frames()), [])
+        decoder.feed(data[7:])
+        self.assertEqual(list(decoder.frames()), [b'hello world'])
+
+    def test_frame_larger_than_buffer(self):
+        decoder = FrameDecoder(buffer_size=16)
+        payload = bytes(range(256)) * 1024
+        data = encode_frame(payload) + encode_frame(b'tail')
+        for i in range(0, len(data), 1000):
+            decoder.feed(data[i:i + 1000])
+        self.assertEqual(list(decoder.frames()), [payload, b'tail'])
+
+    def test_frame_too_large(self):
+        decoder = FrameDecoder(max_frame_size=8)
+        decoder.feed(encode_frame(b'123456789'))
+        with self.assertRaises(ValueError):
+            list(decoder.frames())
+
+    def test_messages_from_socket(self):
+        reader, writer = socket.socketpair()
+        try:
+            messages = [ChatMessage(sender='alice', message='hi'),
+                        ChatMessage(sender='bob', message='x' * 5000)]
+            writer.sendall(b''.join(encode_message(m) for m in messages))
+            writer.close()
+            decoder = FrameDecoder(buffer_size=1024)
+            received = []
+            while decoder.recv_into(reader):
+                received += list(decoder.messages())
+            self.assertEqual([(m.sender, m.message) for m in received],
+                             [('alice', 'hi'), ('bob', 'x' * 5000)])
+        finally:
+            reader.close()
@@ -0,0 +1,103 @@
+# Test gossip membership with simulated nodes
+
+import math
+import unittest
+from lib.address import Address
+from lib.membership import Member, ALIVE, DEAD, SUSPECT
+from lib.sim import SimGossipMember, SimLinks
+
+
+def _member(i):
+    return Member(Address('10.0.{}.{}'.format(i // 250, i % 250 + 1), 3000),
+                  Address('10.0.{}.{}'.format(i // 250, i % 250 + 1), 20000 + i))
+
+
+def _knows(node, other, status=ALIVE):
+    member = node.nodes.get(other.node)
+    return member is not None and member.status == status
+
+
+class TestGossip(unittest.TestCase):
+    def make_cluster(self, nr_nodes, **kwargs):
+        cluster = SimLinks(**kwargs)
+        self.addCleanup(cluster.close)
+        nodes = [SimGossipMember(cluster, _member(i)) for i in range(nr_nodes)]
+        for node in nodes:
+            for other in nodes:
+                node.nodes.add(other.node)
+        return cluster, nodes
+
+    def rounds_until(self, cluster, done, limit=100):
+        # Every live node probes once per virtual second
+        for rounds in range(1, limit + 1):
+            cluster.sim.sleep(1)
+            for node in list(cluster.members.values()):
+                if node.node.replica_address not in cluster.down:
+                    node.probe()
+            if done():
+                return rounds
+        self.fail('not converged in {} rounds'.format(limit))
+
+    def test_join_spreads_in_log_rounds(self):
+        for nr_nodes in (16, 128):
+            cluster, nodes = self.make_cluster(nr_nodes, seed=nr_nodes)
+            # The new node knows only one member, its own record is gossiped
+            new = SimGossipMember(cluster, _member(nr_nodes))
+            new.nodes.add(nodes[0].node)
+            new.nodes.update(new.node, gossip=new.retransmits())
+            rounds = self.rounds_until(cluster, lambda: all(_knows(node, new) for node in nodes))
+            print('\n{} nodes: join known by all after {} rounds, {} messages'.format(
+                nr_nodes, rounds, cluster.messages))
+            self.assertLessEqual(rounds, 4 * math.log2(nr_nodes))
+
+    def test_failure_detected_by_all(self):
+        nr_nodes = 64
+        cluster, nodes = self.make_cluster(nr_nodes, loss=0.05)
+        self.rounds_until(cluster, lambda: cluster.sim.now >= 5)
+        dead = nodes[10]
+        cluster.down.add(dead.node.replica_address)
+        alive = [node for node in nodes if node is not dead]
+        rounds = self.rounds_until(
+            cluster, lambda: all(not _knows(node, dead) and not _knows(node, dead, SUSPECT)
+                                 for node in alive))
+        print('\n{} nodes, 5% loss: failure known by all after {} rounds, '
+              'ring removal takes {} sequential hops'.format(nr_nodes, rounds, nr_nodes - 1))
+        self.assertLessEqual(rounds, nodes[0].suspicion_timeout() + 4 * math.log2(nr_nodes))
+        # Nobody else was declared dead under the packet loss
+        for node in alive:
+            self.assertFalse(any(m.status == DEAD and m.address != dead.node.address
+                                 for m in node.nodes.members()))
+
+    def test_suspected_node_refutes(self):
+        cluster, nodes = self.make_cluster(8)
+        target = nodes[3]
+        nodes[0].suspect(target.node)
+        self.rounds_until(cluster, lambda: all(_knows(node, target) for node in nodes)
+                          and target.nodes.get(target.node).incarnation == 1)
+
+    def test_tombstone(self):
+        cluster, nodes = self.make_cluster(4)
+        node, dead = nodes[0], nodes[3]
+        node.apply(dead.node, DEAD, 2)
+        node.nodes.update(dead.node, gossip=0)
+        # Gossiped out, but a stale ALIVE of the same incarnation is ignored
+        node.expire_suspects()
+        node.apply(dead.node, ALIVE, 2)
+        self.assertTrue(_knows(node, dead, DEAD))
+        cluster.sim.sleep(node.tombstone_timeout())
+        node.expire_suspects()
+        self.assertIsNone(node.nodes.get(dead.node))
+        # Only a newer incarnation brings it back
+        node.apply(dead.node, DEAD, 2)
+        node.apply(dead.node, ALIVE, 3)
+        self.assertTrue(_knows(node, dead))
+
+    def test_dead_member_refutes(self):
+        # A member declared dead that still pings learns it and refutes
+        cluster, nodes = self.make_cluster(4)
+        dead = nodes[3]
+        for node in nodes[:3]:
+            node.apply(dead.node, DEAD, 0)
+            node.nodes.update(dead.node, gossip=0)
+        self.rounds_until(cluster, lambda: all(_knows(node, dead) for node in nodes[:3]))
+        self.assertEqual(dead.nodes.get(dead.node).incarnation, 1)
@@ -0,0 +1,62 @@
+# Test the load generator
+
+import argparse
+import io
+import time
+import unittest
+from contextlib import redirect_stdout
+from lib.address import Address
+from lib.message import ChatMessage, ChatMessageType
+from loadgen import Histogram, _Worker
+from test.test_client import LocalServer
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+        for ms in range(1, 1001):
+            histogram.add(ms / 1000)
+        # Buckets are 2% wide
+        self.assertAlmostEqual(histogram.percentile(0.5), 500, delta=10)
+        self.assertAlmostEqual(histogram.percentile(0.99), 990, delta=20)
+        self.assertIsNone(Histogram().percentile(0.5))
+
+    def test_merge(self):
+        a, b = Histogram(), Histogram()
+        a.add(0.001)
+        b.add(0.1)
+        b.add(0.1)
+        a.merge(Histogram(b.buckets))
+        self.assertEqual(a.count, 3)
+        self.assertAlmostEqual(a.percentile(1), 100, delta=2)
+
+
+class TestWorker(unittest.TestCase):
+    def test_run(self):
+        server = LocalServer()
+        self.addCleanup(server.stop)
+        args = argparse.Namespace(senders=2, rate=50, size=10, churn=0.5, duration=0.5,
+                                  warmup=0.1, drain=0.2)
+        with redirect_stdout(io.StringIO()):
+            result = _Worker(args, [server.address], range(5)).run()
+        sent = sum(result['sent'].values())
+        self.assertGreater(sent, 10)
+        self.assertGreater(result['reconnects'], 0)
+        # Every receiver connected while a message went through got it
+        self.assertGreater(result['received'], sent)
+        self.assertEqual(set(result['by_sender']), {'u0', 'u1'})
+
+    def test_other_messages(self):
+        # Messages of other clients and room control messages are skipped
+        args = argparse.Namespace(senders=0, rate=1, size=1, churn=0, duration=0,
+                                  warmup=0, drain=0)
+        worker = _Worker(args, [Address('127.0.0.1', 1)], range(1))
+        worker.measure_from = 0
+        user = worker.users[0]
+        user.on_message(ChatMessage('bob', 'hello there'))
+        user.on_message(ChatMessage('bob', 'hi'))
+        user.on_message(ChatMessage('u0', '', type=ChatMessageType.JOIN, room='r'))
+        user.on_message(ChatMessage('u0', '127.0.0.1:3000', type=ChatMessageType.REDIRECT))
+        self.assertEqual(worker.received, 0)
+        user.on_message(ChatMessage('u1', '0 {:.6f} x'.format(time.time())))
+        self.assertEqual(worker.received, 1)
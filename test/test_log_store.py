@@ -0,0 +1,115 @@
+# Test the chat log stores
+
+import os
+import tempfile
+import unittest
+from lib.log_store import MemoryLog, SegmentLog
+from lib.message import ChatMessage
+from lib.replication import ChatLog
+
+
+class TestSegmentLog(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def open(self, **kwargs):
+        # Small segments and index intervals, so every test spans several
+        kwargs.setdefault('segment_bytes', 1024)
+        kwargs.setdefault('index_interval', 128)
+        kwargs.setdefault('write_buffer', 256)
+        log = SegmentLog(self.directory, **kwargs)
+        self.addCleanup(log.close)
+        return log
+
+    def fill(self, log, count, start=0):
+        for i in range(start, start + count):
+            self.assertEqual(log.append(b'message %d' % i, epoch=i // 50, timestamp=1000 + i), i)
+
+    def test_append_and_read(self):
+        log = self.open()
+        self.fill(log, 200)
+        self.assertEqual(len(log), 200)
+        self.assertGreater(len(os.listdir(self.directory)), 10)
+        for i in (0, 1, 49, 50, 123, 198, 199):
+            self.assertEqual(log.read(i), (i // 50, 1000 + i, b'message %d' % i))
+        with self.assertRaises(IndexError):
+            log.read(200)
+
+    def test_replay_from_offset_and_time(self):
+        log = self.open()
+        self.fill(log, 200)
+        self.assertEqual([record[0] for record in log.replay(37)], list(range(37, 200)))
+        self.assertEqual(log.offset_for_time(1123), 123)
+        self.assertEqual(log.offset_for_time(1122.5), 123)
+        self.assertEqual(log.offset_for_time(0), 0)
+        self.assertEqual(log.offset_for_time(5000), 200)
+        self.assertEqual(next(log.replay_since(1150))[3], b'message 150')
+
+    def test_timestamps_never_decrease(self):
+        log = self.open()
+        log.append(b'a', timestamp=10)
+        log.append(b'b', timestamp=5)
+        self.assertEqual(log.read(1)[1], 10)
+
+    def test_reopen(self):
+        log = self.open()
+        self.fill(log, 150)
+        log.close()
+        log = self.open()
+        self.assertEqual(len(log), 150)
+        self.fill(log, 50, start=150)
+        self.assertEqual([record[0] for record in log.replay(140)], list(range(140, 200)))
+        self.assertEqual(log.offset_for_time(1175), 175)
+
+    def test_torn_record_dropped(self):
+        log = self.open(segment_bytes=1 << 20)
+        self.fill(log, 20)
+        log.close()
+        path = os.path.join(self.directory, '{:020d}.log'.format(0))
+        size = os.path.getsize(path)
+        os.truncate(path, size - 3)
+        log = self.open()
+        self.assertEqual(len(log), 19)
+        self.assertEqual(os.path.getsize(path), size - len(b'message 19') - 20)
+        self.assertEqual(log.append(b'again'), 19)
+        self.assertEqual(log.read(19)[2], b'again')
+
+    def test_truncate(self):
+        log = self.open()
+        self.fill(log, 200)
+        log.truncate(77)
+        self.assertEqual(len(log), 77)
+        self.assertEqual(log.append(b'new', epoch=9), 77)
+        self.assertEqual(log.read(76)[2], b'message 76')
+        log.close()
+        log = self.open()
+        self.assertEqual([record[3] for record in log.replay(75)],
+                         [b'message 75', b'message 76', b'new'])
+
+    def test_fsync_batches(self):
+        log = self.open(segment_bytes=1 << 20, fsync_messages=10, fsync_interval=0)
+        synced = []
+        sync = log.sync
+        log.sync = lambda: synced.append(len(log)) or sync()
+        self.fill(log, 35)
+        self.assertEqual(synced[:3], [10, 20, 30])
+
+
+class TestChatLog(unittest.TestCase):
+    def test_stores_agree(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        disk = SegmentLog(directory.name, segment_bytes=512)
+        self.addCleanup(disk.close)
+        for store in (MemoryLog(), disk):
+            log = ChatLog(store)
+            for i in range(30):
+                log.append(i // 10, ChatMessage('alice', 'hello {}'.format(i)).toJSON())
+            self.assertEqual(log.epoch_at(25), 2)
+            self.assertEqual([message.message for message in log.replay(29)],
+                             ['hello 28', 'hello 29'])
+            self.assertEqual(len(log.entries_from(1, 3, 1 << 20)), 3)
+            # The first entry is in, the second one would exceed 50 bytes
+            self.assertEqual(len(log.entries_from(1, 100, 50)), 1)
@@ -0,0 +1,91 @@
+# Test the queue based logging pipeline
+
+import io
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+from lib import logger
+from lib.logger import Logger
+
+
+class Formatted():
+    # Counts how often it is formatted into a message
+    count = 0
+
+    def __format__(self, spec):
+        Formatted.count += 1
+        return 'formatted'
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        # A pipeline of its own, the one of the process is put back after
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'log.jsonl')
+        root = logging.getLogger('chat')
+        self.addCleanup(setattr, root, 'handlers', list(root.handlers))
+        self.addCleanup(root.setLevel, root.level)
+        env = {'LOG_LEVEL': 'INFO', 'LOG_CATEGORIES': 'replica, error', 'LOG_JSON': self.path}
+        with mock.patch.dict(os.environ, env):
+            self.pipeline = logger._Pipeline()
+        self.addCleanup(self.pipeline.stop)
+        patcher = mock.patch.object(logger, '_pipeline', self.pipeline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def records(self):
+        logger.flush()
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_gated(self):
+        log = Logger()
+        Formatted.count = 0
+        with redirect_stdout(io.StringIO()) as out:
+            log.log_sys('left out {}', Formatted())
+            log.debug('replica', 'below the level {}', Formatted())
+            log.log_replica('written {}', Formatted())
+            logger.flush()
+        self.assertEqual(Formatted.count, 1)
+        self.assertFalse(log.enabled('sys'))
+        self.assertFalse(log.enabled('replica', logger.DEBUG))
+        self.assertEqual(out.getvalue().count('\n'), 1)
+        self.assertIn('REPLICA: written formatted', out.getvalue())
+
+    def test_json_sink(self):
+        log = Logger()
+        with redirect_stdout(io.StringIO()):
+            log.log_replica('Leader is {}', 'a')
+            log.log_error('Lost {}', 'b')
+            records = self.records()
+        self.assertEqual([(r['category'], r['level'], r['message']) for r in records],
+                         [('replica', 'INFO', 'Leader is a'), ('error', 'ERROR', 'Lost b')])
+        self.assertEqual(records[0]['pid'], os.getpid())
+
+    def test_child_process_writes_on_exit(self):
+        # multiprocessing children skip atexit, what they logged last is
+        # written all the same
+        def child():
+            log = Logger()
+            for i in range(100):
+                log.log_replica('child {}', i)
+
+        process = multiprocessing.get_context('fork').Process(target=child)
+        with redirect_stdout(io.StringIO()):
+            process.start()
+            process.join()
+        records = [r for r in self.records() if r['pid'] == process.pid]
+        self.assertEqual(len(records), 100)
+        self.assertEqual(records[-1]['message'], 'child 99')
+
+    def test_handlers_once(self):
+        Logger()
+        Logger()
+        self.assertEqual(logging.getLogger('chat').handlers, [self.pipeline.queue_handler])
+        self.assertEqual(logging.getLogger('chat.replica').handlers, [])
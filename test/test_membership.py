@@ -0,0 +1,99 @@
+# Test the shared membership table
+
+from multiprocessing import Process
+import os
+import unittest
+from lib.address import Address
+from lib.election import Node
+from lib.membership import MembershipTable, ALIVE, SUSPECT
+
+
+def _node(i):
+    return Node(Address('10.0.0.{}'.format(i), 3000), Address('10.0.0.{}'.format(i), 5970))
+
+
+class TestMembershipTable(unittest.TestCase):
+    def setUp(self):
+        self.table = MembershipTable('test_membership{}'.format(os.getpid()),
+                                     capacity=4, create=True)
+
+    def tearDown(self):
+        self.table.close()
+        self.table.unlink()
+
+    def test_add_remove(self):
+        self.assertTrue(self.table.add(_node(1)))
+        self.assertFalse(self.table.add(_node(1)))
+        self.assertTrue(self.table.add(_node(2)))
+        self.assertEqual(len(self.table), 2)
+        self.assertIn(_node(2), self.table)
+        self.assertTrue(self.table.remove(_node(1)))
+        self.assertFalse(self.table.remove(_node(1)))
+        self.assertNotIn(_node(1), self.table)
+        self.assertEqual(self.table.nodes(), [_node(2)])
+        self.assertEqual(self.table.nodes()[0].id, _node(2).id)
+
+    def test_grow_and_shrink(self):
+        other = MembershipTable(self.table.name)
+        self.assertEqual(len(other.members()), 0)
+        for i in range(40):
+            self.assertTrue(self.table.add(_node(i)))
+        self.assertEqual(self.table.capacity, 64)
+        # Other processes follow the table to its new data segment
+        self.assertEqual(len(other.members()), 40)
+        self.assertIn(_node(39), other)
+        for i in range(38):
+            self.assertTrue(self.table.remove(_node(i)))
+        self.assertEqual(self.table.capacity, 4)
+        self.assertEqual(sorted(n.address.host for n in other.nodes()),
+                         ['10.0.0.38', '10.0.0.39'])
+        self.assertEqual(other.get(_node(39)).replica_address, Address('10.0.0.39', 5970))
+        other.close()
+
+    def test_status_and_generation(self):
+        self.table.add(_node(1), last_seen=1.0)
+        generation = self.table.generation
+        self.assertEqual(generation % 2, 0)
+        self.table.update(_node(1), status=SUSPECT)
+        self.table.touch(_node(1), now=2.0)
+        member = self.table.get(_node(1))
+        self.assertEqual(member.status, SUSPECT)
+        self.assertEqual(member.last_seen, 2.0)
+        self.assertEqual(member.replica_address, Address('10.0.0.1', 5970))
+        self.assertEqual(self.table.generation, generation + 4)
+        self.assertIsNone(self.table.get(_node(2)))
+
+    def test_index_kept_across_updates(self):
+        # Heartbeats and gossip written by another process do not rebuild
+        # the index of a reader, adds and removes do
+        other = MembershipTable(self.table.name)
+        self.addCleanup(other.close)
+        for i in range(3):
+            self.table.add(_node(i))
+        self.assertIsNotNone(other.get(_node(1)))
+        index = other._index
+        self.table.touch(_node(1), now=5.0)
+        self.table.update(_node(2), status=SUSPECT, gossip=2)
+        self.assertEqual(len(self.table.piggyback(1)), 1)
+        self.assertEqual(other.get(_node(1)).last_seen, 5.0)
+        self.assertEqual(other.get(_node(2)).status, SUSPECT)
+        self.assertEqual(other.get(_node(2)).gossip, 1)
+        self.assertIs(other._index, index)
+        self.table.remove(_node(1))
+        self.assertIsNone(other.get(_node(1)))
+        self.assertNotIn(_node(1), other)
+        self.assertIsNot(other._index, index)
+
+    def test_shared_between_processes(self):
+        def add(table, i):
+            table.add(_node(i), status=ALIVE)
+
+        processes = [Process(target=add, args=(self.table, i)) for i in range(4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        other = MembershipTable(self.table.name)
+        self.assertEqual(sorted(n.address.host for n in other.nodes()),
+                         ['10.0.0.{}'.format(i) for i in range(4)])
+        other.close()
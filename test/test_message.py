@@ -1,7 +1,8 @@
 # Test message class
 
+import json
 import unittest
-from lib.message import Message, MessageType
+from lib.message import Message, MessageDecoder, MessageEncoder, MessageType
 
 
 class TestMessage(unittest.TestCase):
@@ -15,11 +16,17 @@ class TestMessage(unittest.TestCase):
 
     def test_message_to_json(self):
         message = Message('Hello', MessageType.MESSAGE)
-        self.assertEqual(message.toJSON(), {
-                         'message': 'Hello', 'type': MessageType.MESSAGE})
+        self.assertEqual(json.loads(message.toJSON()), {
+                         'message': 'Hello', 'type': 'MESSAGE', 'host': '', 'port': ''})
 
     def test_message_as_tuple(self):
         message = Message(("hello", "world"), MessageType.MESSAGE)
-        print(message.toJSON())
-        self.assertEqual(message.toJSON(), {'message': (
-            'hello', 'world'), 'type': MessageType.MESSAGE})
+        self.assertEqual(json.loads(message.toJSON()), {'message': [
+            'hello', 'world'], 'type': 'MESSAGE', 'host': '', 'port': ''})
+
+    def test_encode_decode(self):
+        message = Message('Hello', MessageType.ELECTION_REQ, '10.0.0.1', 3000, correlation_id=7)
+        decoded = json.loads(json.loads(MessageEncoder().encode(message)), cls=MessageDecoder)
+        self.assertEqual((decoded.message, decoded.type, decoded.host, decoded.port,
+                          decoded.correlation_id),
+                         ('Hello', MessageType.ELECTION_REQ, '10.0.0.1', 3000, 7))
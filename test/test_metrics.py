@@ -0,0 +1,122 @@
+# Test the metrics registry and the admin endpoint
+
+import json
+import multiprocessing
+import os
+import threading
+import unittest
+import urllib.request
+from wsgiref.util import setup_testing_defaults
+from lib import metrics
+from lib.admin import create_admin_server, make_app
+from lib.metrics import Registry
+
+
+def _count(counter, gauge, histogram):
+    for _ in range(100):
+        counter.inc()
+    gauge.inc(2)
+    histogram.observe(0.3)
+
+
+class TestRegistry(unittest.TestCase):
+    def test_processes(self):
+        registry = Registry(processes=4)
+        counter = registry.counter('messages_total')
+        gauge = registry.gauge('clients')
+        histogram = registry.histogram('seconds', buckets=(0.1, 1))
+        counter.inc()
+        gauge.set(1)
+        context = multiprocessing.get_context('fork')
+        # More processes than rows, the rows of exited ones are reused
+        for _ in range(2):
+            processes = [context.Process(target=_count, args=(counter, gauge, histogram))
+                         for _ in range(3)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+        values = registry.collect()
+        self.assertEqual(values['messages_total'], 601)
+        self.assertEqual(values['clients'], 13)
+        self.assertEqual(values['seconds']['buckets'], [(0.1, 0), (1, 6), (float('inf'), 6)])
+        self.assertAlmostEqual(values['seconds']['sum'], 1.8)
+
+    def test_register_again(self):
+        registry = Registry()
+        self.assertIs(registry.counter('a'), registry.counter('a'))
+        with self.assertRaises(ValueError):
+            registry.gauge('a')
+        small = Registry(slots=4)
+        with self.assertRaises(ValueError):
+            small.histogram('h', buckets=(1, 2, 3))
+
+    def test_named(self):
+        name = 'test_metrics{}'.format(os.getpid())
+        registry = Registry(name, create=True)
+        self.addCleanup(registry.unlink)
+        self.addCleanup(registry.close)
+        registry.counter('a').inc(3)
+        # Replaces the stale segment of the same name
+        registry.close()
+        registry = Registry(name, create=True)
+        self.addCleanup(registry.close)
+        other = Registry(name)
+        self.addCleanup(other.close)
+        self.assertEqual(other.rows, registry.rows)
+        registry.counter('a').inc(2)
+        self.assertEqual(registry.collect(), {'a': 2})
+
+    def test_prometheus(self):
+        registry = Registry()
+        registry.counter('messages_total', 'Messages').inc(2)
+        registry.gauge('rtt', 'Round trip').set(0.25)
+        registry.histogram('seconds', 'Time', buckets=(0.5,)).observe(1)
+        self.assertEqual(metrics.prometheus(registry), '\n'.join([
+            '# HELP messages_total Messages',
+            '# TYPE messages_total counter',
+            'messages_total 2',
+            '# HELP rtt Round trip',
+            '# TYPE rtt gauge',
+            'rtt 0.25',
+            '# HELP seconds Time',
+            '# TYPE seconds histogram',
+            'seconds_bucket{le="0.5"} 0',
+            'seconds_bucket{le="+Inf"} 1',
+            'seconds_sum 1',
+            'seconds_count 1',
+        ]) + '\n')
+
+
+class TestAdmin(unittest.TestCase):
+    def request(self, app, path):
+        environ = {'PATH_INFO': path}
+        setup_testing_defaults(environ)
+        status = []
+        body = b''.join(app(environ, lambda s, headers, exc_info=None: status.append(s)))
+        return status[0], body
+
+    def test_app(self):
+        registry = Registry()
+        registry.counter('messages_total').inc()
+        app = make_app(registry)
+        status, body = self.request(app, '/metrics')
+        self.assertEqual(status, '200 OK')
+        self.assertIn(b'messages_total 1\n', body)
+        self.assertEqual(self.request(app, '/nothing')[0], '404 Not Found')
+        status, body = self.request(app, '/metrics.json')
+        values = json.loads(body)
+        self.assertEqual(values['admin_requests_total'], 2)
+        self.assertEqual(values['admin_errors_total'], 1)
+        self.assertEqual(values['admin_request_seconds']['count'], 2)
+
+    def test_http(self):
+        registry = Registry()
+        server = create_admin_server('127.0.0.1', 0, registry)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/health'.format(server.server_address[1])
+        with urllib.request.urlopen(url, timeout=5) as response:
+            self.assertEqual(response.read(), b'ok\n')
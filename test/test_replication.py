@@ -0,0 +1,104 @@
+# Test chat log replication with simulated members
+
+import os
+import unittest
+from unittest import mock
+from lib import wire
+from lib.message import ChatMessage
+from lib.sim import SimLinks, SimReplicators
+
+
+class TestReplication(unittest.TestCase):
+    def make_cluster(self, nr_members, acks='quorum', loss=0.0, seed=1, **kwargs):
+        links = SimLinks(loss=loss, seed=seed)
+        self.addCleanup(links.close)
+        return SimReplicators(links, nr_members, acks=acks, **kwargs)
+
+    def append(self, cluster, count):
+        return [cluster.leader.append('message {}'.format(i)) for i in range(count)]
+
+    def test_followers_get_the_log_in_batches(self):
+        cluster = self.make_cluster(3, window=2)
+        futures = self.append(cluster, 100)
+        cluster.pump()
+        self.assertEqual(cluster.logs()[1], cluster.logs()[0])
+        self.assertEqual(cluster.logs()[2], cluster.logs()[0])
+        self.assertEqual([future.result() for future in futures], list(range(1, 101)))
+        # Appends while the window is full are shipped together
+        self.assertLess(cluster.leader.batches_sent, 20)
+
+    def test_ack_modes(self):
+        for acks, committed in (('leader', True), ('one', True), ('quorum', True), ('all', False)):
+            cluster = self.make_cluster(3, acks=acks)
+            cluster.links.down.add(cluster.ring[2].replica_address)
+            futures = self.append(cluster, 10)
+            cluster.pump()
+            self.assertEqual(all(future.done() for future in futures), committed, acks)
+
+    def test_quorum_of_five(self):
+        cluster = self.make_cluster(5)
+        cluster.links.down.update(node.replica_address for node in cluster.ring[3:])
+        future = cluster.leader.append('hello')
+        cluster.pump()
+        self.assertTrue(future.done())
+        cluster.links.down.add(cluster.ring[2].replica_address)
+        future = cluster.leader.append('hello again')
+        cluster.pump()
+        self.assertFalse(future.done())
+
+    def test_loss_and_reordering(self):
+        cluster = self.make_cluster(3, loss=0.2, window=4, batch=8)
+        futures = self.append(cluster, 200)
+        cluster.pump()
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(cluster.logs()[1], cluster.logs()[0])
+        self.assertGreater(cluster.leader.retransmits, 0)
+
+    def test_entries_of_older_leader_replaced(self):
+        cluster = self.make_cluster(3)
+        self.append(cluster, 3)
+        cluster.pump()
+        # The old leader appended entries nobody else got, then the second
+        # member took over
+        cluster.members[0].log.append(1, 'lost 1')
+        cluster.members[0].log.append(1, 'lost 2')
+        cluster.epoch = 2
+        cluster.leader = cluster.members[1]
+        self.append(cluster, 1)
+        cluster.pump()
+        self.assertEqual(cluster.logs()[0], cluster.logs()[1])
+        self.assertEqual(len(cluster.logs()[0]), 4)
+
+    def test_older_leader_ignored(self):
+        cluster = self.make_cluster(2)
+        follower = cluster.members[1]
+        body = {'epoch': 2, 'prev': 0, 'prev_epoch': 0, 'entries': [[2, 'a']], 'commit': 0}
+        self.assertEqual(follower.receive(body), {'ok': True, 'match': 1})
+        body = {'epoch': 1, 'prev': 1, 'prev_epoch': 2, 'entries': [[1, 'b']], 'commit': 0}
+        self.assertIsNone(follower.receive(body))
+        self.assertEqual(len(follower.log), 1)
+
+    def test_large_entries(self):
+        cluster = self.make_cluster(2)
+        with self.assertRaises(ValueError):
+            cluster.leader.append('x' * (cluster.leader.max_entry + 1))
+        # The largest entries fit in one datagram in either format, even when
+        # every character is escaped
+        data = ChatMessage('ann', '"' * cluster.leader.max_entry).toJSON()
+        data = data[:cluster.leader.max_entry]
+        for _ in range(3):
+            cluster.leader.append(data)
+        for wire_format in ('json', 'binary'):
+            with mock.patch.dict(os.environ, {'WIRE_FORMAT': wire_format}):
+                for message, _, _ in cluster.links.held:
+                    self.assertLess(len(wire.dumps(message)), 65507)
+
+    def test_send_error(self):
+        cluster = self.make_cluster(2)
+        cluster.links.send_errors = 1
+        first = cluster.leader.append('one')
+        self.assertEqual(cluster.leader.batches_sent, 0)
+        second = cluster.leader.append('two')
+        cluster.pump()
+        self.assertEqual([first.result(), second.result()], [1, 2])
+        self.assertEqual(cluster.logs()[1], cluster.logs()[0])
@@ -0,0 +1,55 @@
+# Test the ring view of RingMember
+
+from multiprocessing.shared_memory import ShareableList
+import os
+import unittest
+from lib.address import Address
+from lib.election import Node, RingMember
+from lib.membership import MembershipTable, SUSPECT
+
+
+def _node(i):
+    return Node(Address('10.0.0.{}'.format(i), 3000), Address('10.0.0.{}'.format(i), 5970))
+
+
+class TestRingView(unittest.TestCase):
+    def setUp(self):
+        self.port = 40000 + os.getpid() % 20000
+        self.table = MembershipTable('membership{}'.format(self.port), capacity=8, create=True)
+        self.leader_id = ShareableList([" " * 256], name="leader_id{}".format(self.port))
+        self.node = _node(5)
+        self.node.address.port = self.port
+        self.table.add(self.node)
+        self.member = RingMember(address=self.node.address,
+                                 replica_address=self.node.replica_address,
+                                 membership=self.table)
+
+    def tearDown(self):
+        for shared in (self.table, self.leader_id.shm):
+            shared.close()
+            shared.unlink()
+
+    def test_alone(self):
+        self.assertIsNone(self.member.get_next_node())
+        self.assertIsNone(self.member.get_previous_node())
+
+    def test_successor_and_predecessor(self):
+        for i in (3, 7, 8):
+            self.table.add(_node(i))
+        ring = [node.id for node in self.member.sorted_ring()]
+        self.assertEqual(ring, sorted(ring))
+        position = ring.index(self.member.id)
+        self.assertEqual(self.member.get_next_node().id, ring[(position + 1) % 4])
+        self.assertEqual(self.member.get_previous_node().id, ring[position - 1])
+
+        # The view follows removals
+        next_node = self.member.get_next_node()
+        self.table.remove(next_node)
+        self.assertNotEqual(self.member.get_next_node(), next_node)
+        self.assertEqual(len(self.member.sorted_ring()), 3)
+
+    def test_status_update_keeps_view(self):
+        self.table.add(_node(3))
+        ring = self.member.sorted_ring()
+        self.table.update(_node(3), status=SUSPECT)
+        self.assertIs(self.member.sorted_ring(), ring)
@@ -0,0 +1,191 @@
+# Test room ownership on the hash ring and the room redirects of the server
+
+from collections import Counter
+import itertools
+import os
+import select
+import socket
+import time
+import unittest
+from client import Client
+from lib.address import Address
+from lib.async_server import ChatMetrics
+from lib.election import Node, RingMember
+from lib.framing import FrameDecoder
+from lib.message import ChatMessage, ChatMessageType
+from lib.membership import MembershipTable
+from lib.rooms import HashRing, RoomDirectory
+from lib.send_queue import OverflowPolicy
+from test.test_client import LocalServer
+from test.test_send_queue import _process_server
+
+
+class TestHashRing(unittest.TestCase):
+    nodes = [Address('10.0.0.{}'.format(i), 3000) for i in range(10)]
+    rooms = ['room{}'.format(i) for i in range(20000)]
+
+    def owners(self, ring):
+        return {room: ring.owner(room) for room in self.rooms}
+
+    def test_owner(self):
+        self.assertIsNone(HashRing().owner('room'))
+        ring = HashRing(self.nodes, vnodes=16)
+        # The same on every server, whatever order it knows the members in
+        self.assertEqual(self.owners(ring), self.owners(HashRing(reversed(self.nodes), vnodes=16)))
+
+    def test_balance(self):
+        mean = len(self.rooms) / len(self.nodes)
+        counts = Counter(self.owners(HashRing(self.nodes, vnodes=256)).values())
+        self.assertEqual(len(counts), len(self.nodes))
+        self.assertLess(max(counts.values()) / mean, 1.2)
+        counts = Counter(self.owners(HashRing(self.nodes, vnodes=1)).values())
+        self.assertGreater(max(counts.values()) / mean, 1.5)
+
+    def test_rebalance(self):
+        before = self.owners(HashRing(self.nodes[:-1]))
+        after = self.owners(HashRing(self.nodes))
+        moved = [room for room in self.rooms if before[room] != after[room]]
+        # The new member takes about 1/N of the rooms, the others keep theirs
+        self.assertEqual({after[room] for room in moved}, {self.nodes[-1]})
+        self.assertAlmostEqual(len(moved) / len(self.rooms), 1 / len(self.nodes), delta=0.03)
+
+
+class TestRoomServer(unittest.TestCase):
+    def setUp(self):
+        self.table = MembershipTable('test_rooms{}'.format(os.getpid()), capacity=4, create=True)
+        self.addCleanup(self.table.unlink)
+        self.addCleanup(self.table.close)
+        self.servers = []
+        for i in range(2):
+            server = LocalServer()
+            self.addCleanup(server.stop)
+            member = RingMember(address=server.address, replica_address=Address('127.0.0.1', i + 1),
+                                membership=self.table, leader_id=[' '],
+                                election_state=[0, 0, 0, 0.0])
+            self.table.add(member)
+            server.server.rooms = RoomDirectory(member)
+            self.servers.append(server)
+        self.directory = self.servers[0].server.rooms
+
+    def room_of(self, server):
+        return next(room for room in ('room{}'.format(i) for i in itertools.count())
+                    if self.directory.owner(room) == server.address)
+
+    def make_client(self, server, room):
+        client = Client(server.address.host, server.address.port, 'alice',
+                        broadcast_ip='127.0.0.1', broadcast_port=1, room=room)
+        client.received = []
+        client.on_message = lambda message: client.received.append(message.message)
+        self.addCleanup(client.shutdown)
+        client.connect()
+        return client
+
+    def wait_for(self, client, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            client.poll(0.05)
+        self.assertTrue(condition())
+
+    def test_redirect(self):
+        room = self.room_of(self.servers[1])
+        client = self.make_client(self.servers[0], room)
+        # Held until the room is joined on its server
+        client.send_message('hi')
+        self.wait_for(client, lambda: client.received == ['hi'])
+        self.assertEqual(client.address, self.servers[1].address)
+        self.assertEqual(client.redirects, 1)
+
+    def test_rooms_apart(self):
+        first = self.room_of(self.servers[0])
+        second = next(room for room in ('other{}'.format(i) for i in itertools.count())
+                      if self.directory.owner(room) == self.servers[0].address)
+        alice = self.make_client(self.servers[0], first)
+        bob = self.make_client(self.servers[0], second)
+        legacy = self.make_client(self.servers[0], None)
+        alice.send_message('to first')
+        self.wait_for(alice, lambda: alice.received == ['to first'])
+        bob.send_message('to second')
+        self.wait_for(bob, lambda: bob.received == ['to second'])
+        legacy.send_message('to none')
+        self.wait_for(legacy, lambda: legacy.received == ['to none'])
+        for client in (alice, bob):
+            client.poll(0.1)
+        self.assertEqual(alice.received, ['to first'])
+        self.assertEqual(bob.received, ['to second'])
+
+    def test_member_leaves(self):
+        room = self.room_of(self.servers[1])
+        client = self.make_client(self.servers[1], room)
+        self.wait_for(client, lambda: client.joined)
+        # The second server leaves the ring, its rooms move to the first
+        self.table.remove(Node(self.servers[1].address))
+        server = self.servers[1]
+        server.loop.call_soon_threadsafe(server.server.check_rooms)
+        self.wait_for(client, lambda: client.address == self.servers[0].address and client.joined)
+        client.send_message('moved')
+        self.wait_for(client, lambda: client.received == ['moved'])
+
+
+class _Rooms():
+    # RoomDirectory of a server that serves every room but the remote ones
+    def __init__(self):
+        self.remote = {'elsewhere'}
+        self._ring = object()
+
+    def ring(self):
+        return self._ring
+
+    def owner(self, room):
+        return Address('127.0.0.1', 9) if room in self.remote else Address('127.0.0.1', 1)
+
+    def is_local(self, room):
+        return room not in self.remote
+
+
+class TestProcessRooms(unittest.TestCase):
+    def setUp(self):
+        self.server = _process_server(OverflowPolicy.DROP_OLDEST)
+        self.server._chat_metrics = ChatMetrics()
+        self.server._rooms = _Rooms()
+        self.readers = []
+        for _ in range(3):
+            reader, writer = socket.socketpair()
+            self.addCleanup(reader.close)
+            self.addCleanup(writer.close)
+            self.readers.append(reader)
+            self.server._client_list.append(writer)
+
+    def received(self, n):
+        decoder = FrameDecoder()
+        while select.select([self.readers[n]], [], [], 0.1)[0]:
+            decoder.recv_into(self.readers[n])
+        return [(message.type, message.message) for message in decoder.messages()]
+
+    def join(self, n, room):
+        return self.server._join(ChatMessage('', '', type=ChatMessageType.JOIN, room=room),
+                                 self.server._client_list[n], None)
+
+    def test_fan_out_to_room(self):
+        self.assertEqual(self.join(0, 'one'), 'one')
+        self.assertEqual(self.join(1, 'two'), 'two')
+        self.assertIsNone(self.join(2, 'elsewhere'))
+        self.assertEqual(self.received(0), [(ChatMessageType.JOIN, '')])
+        self.assertEqual(self.received(2), [(ChatMessageType.REDIRECT, '127.0.0.1:9')])
+        self.server.broadcast_client_message(ChatMessage('ann', 'hi', room='one'), None)
+        self.server.broadcast_client_message(ChatMessage('ann', 'all'), None)
+        self.assertEqual(self.received(0), [(ChatMessageType.MESSAGE, 'hi')])
+        self.assertEqual(self.received(1), [(ChatMessageType.JOIN, '')])
+        self.assertEqual(self.received(2), [(ChatMessageType.MESSAGE, 'all')])
+
+    def test_room_moves(self):
+        self.join(0, 'one')
+        self.received(0)
+        writer = self.server._client_list[0]
+        ring = self.server._check_room(writer, 'one', None)
+        self.assertEqual(self.received(0), [])
+        # The room moves with the next ring, the client is told once
+        self.server._rooms.remote.add('one')
+        self.server._rooms._ring = object()
+        ring = self.server._check_room(writer, 'one', ring)
+        self.server._check_room(writer, 'one', ring)
+        self.assertEqual(self.received(0), [(ChatMessageType.REDIRECT, '127.0.0.1:9')])
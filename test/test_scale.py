@@ -0,0 +1,70 @@
+# Scale test: a ring of 500 simulated nodes in one process
+
+import os
+import time
+import unittest
+from lib.address import Address
+from lib.message import MessageType
+from lib.sim import SimLinks, SimRingMember
+
+NR_NODES = int(os.getenv('SCALE_NODES') or 500)
+
+
+def _rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class TestScale(unittest.TestCase):
+    def test_ring_of_500_nodes(self):
+        # Replica messages are delivered by a function call
+        cluster = SimLinks(latency=0)
+        rss = _rss()
+        try:
+            start = time.perf_counter()
+            members = [SimRingMember(cluster, Address('127.0.0.1', 30000 + i),
+                                     Address('127.0.0.1', 40000 + i), cluster.table(capacity=5))
+                       for i in range(NR_NODES)]
+            # Every node learns about every other node, as from discovery,
+            # then builds its ring view
+            for member in members:
+                for other in members:
+                    member.nodes.add(other)
+                member.sorted_ring()
+            formed_in = time.perf_counter() - start
+            memory = _rss() - rss
+            shared = sum(member.nodes.nbytes() for member in members)
+
+            # Every node sees the same ring: following the successors visits
+            # all nodes once
+            successor = {member.id: member.get_next_node().id for member in members}
+            seen = set()
+            node_id = members[0].id
+            while node_id not in seen:
+                seen.add(node_id)
+                node_id = successor[node_id]
+            self.assertEqual(len(seen), NR_NODES)
+            self.assertGreaterEqual(members[7].nodes.capacity, NR_NODES)
+
+            # Heartbeat rounds, every node pings its successor
+            rounds = 5
+            cpu = time.process_time()
+            for _ in range(rounds):
+                for member in members:
+                    self.assertIsNotNone(member.send_next_node(MessageType.PING_REQ, member.id))
+            per_heartbeat = (time.process_time() - cpu) / (rounds * NR_NODES)
+            self.assertTrue(all(member.pings == rounds for member in members))
+
+            # A node leaves, the others shrink their view without a restart
+            leaving = members.pop()
+            for member in members:
+                member.nodes.remove(leaving)
+            self.assertEqual(len(members[0].sorted_ring()), NR_NODES - 1)
+
+            print('\n{} nodes: ring formed in {:.2f}s, memory {:.1f} MB '
+                  '({:.1f} KB/node), shared memory {:.1f} KB/node, '
+                  '{:.1f} us CPU per heartbeat'.format(
+                      NR_NODES, formed_in, memory / 2 ** 20, memory / NR_NODES / 1024,
+                      shared / NR_NODES / 1024, per_heartbeat * 1e6))
+        finally:
+            cluster.close()
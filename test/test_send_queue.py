@@ -0,0 +1,179 @@
+# Test bounded send queue
+
+import multiprocessing
+import socket
+import time
+import unittest
+from lib import metrics
+from lib.async_server import ChatMetrics
+from lib.framing import FrameDecoder, encode_frame, encode_message
+from lib.logger import Logger
+from lib.message import ChatMessage
+from lib.send_queue import OverflowPolicy, SendQueue, config_from_env
+from server import CLIENT_LOCKS, CLIENT_SLOTS, Server
+from test.test_client import LocalServer
+
+
+def _process_server(policy, send_timeout=1):
+    # Just the client fan-out of a process mode Server
+    server = Server.__new__(Server)
+    server._logger = Logger()
+    server._chat_metrics = ChatMetrics()
+    server._client_list = []
+    server._send_queue_config = dict(config_from_env(), policy=policy)
+    server._client_locks = [multiprocessing.Lock() for _ in range(CLIENT_LOCKS)]
+    server.send_timeout = send_timeout
+    server._client_rooms = multiprocessing.Array('Q', CLIENT_SLOTS, lock=False)
+    server.room_check_interval = 1
+    return server
+
+
+def _fan_out(server, client, sender, count):
+    for i in range(count):
+        message = ChatMessage(sender, '{} {}'.format(i, 'x' * 100000))
+        server._send_frame(client, encode_message(message))
+
+
+class TestSendQueue(unittest.TestCase):
+    def test_coalesce(self):
+        queue = SendQueue(max_write=10)
+        for frame in (b'aaaa', b'bbbb', b'cccc'):
+            queue.push(frame)
+        self.assertEqual(queue.pop_batch(), b'aaaabbbb')
+        self.assertEqual(queue.pop_batch(), b'cccc')
+        self.assertEqual(queue.nbytes, 0)
+
+    def test_drop_oldest(self):
+        queue = SendQueue(high_watermark=10, low_watermark=5,
+                          policy=OverflowPolicy.DROP_OLDEST)
+        for frame in (b'aaaa', b'bbbb', b'cccc'):
+            self.assertTrue(queue.push(frame))
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(queue.pop_batch(), b'bbbbcccc')
+
+    def test_disconnect(self):
+        queue = SendQueue(high_watermark=10, low_watermark=5,
+                          policy=OverflowPolicy.DISCONNECT)
+        queue.push(b'aaaaaa')
+        self.assertFalse(queue.push(b'bbbbbb'))
+        self.assertTrue(queue.evicted)
+        self.assertEqual(len(queue), 0)
+
+    def test_pause_until_low_watermark(self):
+        queue = SendQueue(high_watermark=10, low_watermark=4,
+                          policy=OverflowPolicy.PAUSE, max_write=4)
+        for frame in (b'aaaa', b'bbbb', b'cccc'):
+            queue.push(frame)
+        self.assertTrue(queue.paused)
+        queue.pop_batch()
+        self.assertTrue(queue.paused)
+        queue.pop_batch()
+        self.assertFalse(queue.paused)
+
+    def test_partial_flush_keeps_order(self):
+        reader, writer = socket.socketpair()
+        try:
+            writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            queue = SendQueue(high_watermark=10 * 1024 * 1024,
+                              low_watermark=1024, max_write=64 * 1024)
+            frames = [bytes([i]) * 10000 for i in range(50)]
+            for frame in frames:
+                queue.push(frame)
+            self.assertFalse(queue.flush(writer))
+            received = b''
+            while len(received) < len(b''.join(frames)):
+                received += reader.recv(65536)
+                queue.flush(writer)
+            self.assertEqual(received, b''.join(frames))
+            self.assertEqual(queue.bytes_sent, len(received))
+        finally:
+            reader.close()
+            writer.close()
+
+
+class TestProcessModeSend(unittest.TestCase):
+    def setUp(self):
+        self.reader, self.writer = socket.socketpair()
+        self.writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.addCleanup(self.reader.close)
+        self.addCleanup(self.writer.close)
+
+    def test_senders_write_whole_frames(self):
+        # Client processes fan out to the same slow client at once
+        server = _process_server(OverflowPolicy.PAUSE, send_timeout=10)
+        context = multiprocessing.get_context('fork')
+        senders = [context.Process(target=_fan_out, args=(server, self.writer, str(n), 50))
+                   for n in range(3)]
+        for sender in senders:
+            sender.start()
+        decoder = FrameDecoder()
+        received = []
+        self.reader.settimeout(10)
+        while len(received) < 150:
+            time.sleep(0.001)
+            decoder.recv_into(self.reader)
+            received += list(decoder.messages())
+        for sender in senders:
+            sender.join()
+        for n in range(3):
+            self.assertEqual([m.message.split(' ')[0] for m in received if m.sender == str(n)],
+                             [str(i) for i in range(50)])
+
+    def test_full_client(self):
+        frame = b'x' * 100000
+        server = _process_server(OverflowPolicy.DROP_OLDEST)
+        with self.assertRaises(socket.timeout):
+            # Cut off inside the frame
+            server._send_frame(self.writer, frame)
+        dropped = metrics.registry().collect()['chat_send_dropped_total']
+        self.assertFalse(server._send_frame(self.writer, frame))
+        self.assertEqual(metrics.registry().collect()['chat_send_dropped_total'], dropped + 1)
+        # The client's socket buffer is its queue
+        reported = server._report_queue(self.writer, (0, False))
+        self.assertGreater(reported[0], 0)
+        self.assertEqual(server._report_queue(self.writer, reported), reported)
+        server = _process_server(OverflowPolicy.DISCONNECT)
+        with self.assertRaises(socket.timeout):
+            server._send_frame(self.writer, frame)
+
+    def test_malformed_frame_drops_client(self):
+        server = _process_server(OverflowPolicy.PAUSE)
+        self.reader.sendall(encode_frame(b'not json') + encode_frame(b'{}'))
+        # Returns instead of killing the client process
+        server._msgHandler(self.writer, ('127.0.0.1', 1), None)
+        self.reader.settimeout(1)
+        self.assertEqual(self.reader.recv(1), b'')
+
+
+class TestQueueMetrics(unittest.TestCase):
+    def test_asyncio_eviction(self):
+        # A client that does not read is evicted, which shows in the metrics
+        server = LocalServer()
+        self.addCleanup(server.stop)
+        server.server.send_queue_config = dict(
+            config_from_env(), high_watermark=200000, low_watermark=100000,
+            policy=OverflowPolicy.DISCONNECT)
+        before = metrics.registry().collect()
+        clients = []
+        for _ in range(2):
+            client = socket.create_connection(tuple(server.address))
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            self.addCleanup(client.close)
+            clients.append(client)
+        deadline = time.monotonic() + 5
+        while server.server.client_count() < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        frame = encode_message(ChatMessage('ann', 'x' * 100000))
+        try:
+            for _ in range(100):
+                clients[0].sendall(frame)
+        except OSError:
+            pass  # Evicted itself
+        while server.server.client_count() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        after = metrics.registry().collect()
+        self.assertEqual(after['chat_evictions_total'] - before['chat_evictions_total'], 2)
+        self.assertGreater(after['chat_bytes_sent_total'], before['chat_bytes_sent_total'])
+        server.loop.call_soon_threadsafe(server.server.sample_queues)
+        time.sleep(0.1)
+        self.assertEqual(metrics.registry().collect()['chat_send_queue_bytes'], 0)
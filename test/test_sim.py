@@ -0,0 +1,115 @@
+# Test the cluster simulator with the real discovery, ring and gossip code
+
+import contextlib
+import io
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+from lib.address import Address
+from lib.sim import SimCluster, SimLinks
+
+
+class TestSimCluster(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        # The components print every step
+        quiet = contextlib.redirect_stdout(io.StringIO())
+        quiet.__enter__()
+        self.addCleanup(quiet.__exit__, None, None, None)
+
+    def make_cluster(self, nr_nodes, **kwargs):
+        kwargs.setdefault('heartbeat_interval', 1)
+        kwargs.setdefault('gossip_interval', 1)
+        cluster = SimCluster(nr_nodes, **kwargs)
+        self.addCleanup(cluster.close)
+        return cluster
+
+    def crash_leader(self, cluster):
+        leader = next(node for node in cluster.nodes if node.election.is_leader())
+        leader.crash()
+        return leader
+
+    def test_join_converges(self):
+        # Started within one discovery period, so nobody is alone at first
+        cluster = self.make_cluster(8, seed=1)
+        cluster.start(stagger=0.05)
+        self.assertIsNotNone(cluster.run_until(cluster.converged, timeout=30))
+        report = cluster.report()
+        self.assertEqual(report['messages']['DISCOVERY_REQ'], 16)
+        self.assertGreater(report['cpu_ms_per_node'], 0)
+
+    def test_log_in_memory(self):
+        # Nodes keep their chat log in memory, also with CHAT_LOG_DIR set
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.dict(os.environ, {'CHAT_LOG_DIR': directory}):
+                cluster = SimCluster(3, heartbeat_interval=1)
+                cluster.start()
+                cluster.sim.run(until=3)
+                cluster.close()
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_same_seed_same_run(self):
+        runs = []
+        for _ in range(2):
+            cluster = self.make_cluster(6, seed=3, loss=0.05, jitter=0.001)
+            cluster.start(stagger=0.3)
+            converged = cluster.run_until(cluster.converged, timeout=60)
+            report = cluster.report()
+            del report['cpu_ms_per_node'], report['cpu_ms_max_node']
+            runs.append((converged, report, [node.leader_id for node in cluster.nodes]))
+        self.assertEqual(runs[0], runs[1])
+
+    def test_leader_crash(self):
+        for mode in ('ring', 'gossip'):
+            cluster = self.make_cluster(8, seed=2, mode=mode)
+            cluster.bootstrap()
+            cluster.sim.run(until=3)
+            leader = self.crash_leader(cluster)
+            self.assertIsNotNone(cluster.run_until(cluster.converged, timeout=120))
+            live = cluster.live_nodes()
+            highest = max(live, key=lambda node: node.election.key)
+            self.assertTrue(all(node.leader_id == highest.election.id for node in live))
+            self.assertTrue(all(leader.election not in node.membership for node in live))
+
+    def test_partition(self):
+        cluster = self.make_cluster(6, seed=4, mode='gossip')
+        cluster.bootstrap()
+        cluster.sim.run(until=3)
+        hosts = [node.address.host for node in cluster.nodes]
+        cluster.network.partition(hosts[:3], hosts[3:])
+        cluster.sim.run(until=30)
+        self.assertGreater(cluster.network.dropped, 0)
+        # Each side declared the other one dead, the tombstones stay until
+        # the grace period is over. In ring mode only the members whose
+        # successor is on the other side notice.
+        self.assertTrue(all(len(node.membership.nodes()) == 3 for node in cluster.nodes))
+        cluster.sim.run(until=30 + cluster.nodes[0].handler.gossip.tombstone_timeout())
+        self.assertTrue(all(len(node.membership) == 3 for node in cluster.nodes))
+
+
+class TestSimLinks(unittest.TestCase):
+    def test_call_and_post(self):
+        links = SimLinks(latency=0.01, timeout=0.5)
+        self.addCleanup(links.close)
+        received = []
+        links.add(('10.0.0.1', 5970), received)
+
+        def echo(member, message):
+            member.append(message)
+            return message
+
+        self.assertEqual(links.call('a', ('10.0.0.1', 5970), echo), 'a')
+        self.assertAlmostEqual(links.sim.now, 0.02)
+        # A down member costs the sender the timeout
+        links.down.add(Address('10.0.0.1', 5970))
+        self.assertIsNone(links.call('b', ('10.0.0.1', 5970), echo))
+        self.assertAlmostEqual(links.sim.now, 0.52)
+        links.down.clear()
+        links.post('c', ('10.0.0.1', 5970), echo).result()
+        self.assertEqual(received, ['a'])
+        links.run()
+        self.assertEqual(received, ['a', 'c'])
+        self.assertEqual(links.messages, 3)
@@ -0,0 +1,97 @@
+# Test trace propagation and the span buffer
+
+import socket
+import time
+import unittest
+from unittest import mock
+from client import Client
+from lib import trace, wire
+from lib.channel import ReplicaChannel
+from lib.dispatcher import Dispatcher
+from lib.message import ChatMessage, Message, MessageEncoder, MessageType
+from lib.framing import encode_message
+from lib.trace import SpanBuffer, Trace
+from test.test_client import LocalServer
+
+
+class TestTrace(unittest.TestCase):
+    def test_wire(self):
+        sent = Trace(0x1234, [('a recv', 1.5), ('a submit', 2.25)])
+        message = Message('hi', MessageType.MESSAGE, '10.0.0.1', 3000, clock=b'\x01\x02',
+                          trace=sent)
+        for decoded in (wire.decode(wire.encode(message)),
+                        wire.loads(str.encode(MessageEncoder().encode(message)))):
+            self.assertEqual(decoded.trace.id, 0x1234)
+            self.assertEqual(decoded.trace.hops, sent.hops)
+            self.assertEqual(decoded.clock, b'\x01\x02')
+        self.assertIsNone(wire.decode(wire.encode(Message('hi', MessageType.MESSAGE))).trace)
+
+    def test_chat_message(self):
+        chat = ChatMessage('ann', 'hi', Trace(7, [('recv', 1.0)]))
+        decoded = ChatMessage.fromJSON(chat.toJSON())
+        self.assertEqual((decoded.trace.id, decoded.trace.hops), (7, [('recv', 1.0)]))
+        self.assertIsNone(ChatMessage.fromJSON(ChatMessage('ann', 'hi').toJSON()).trace)
+
+    def test_sample(self):
+        self.assertIsNone(trace.start(0))
+        self.assertIsNotNone(trace.start(1))
+
+    def test_span_buffer(self):
+        spans = SpanBuffer(capacity=3)
+        for n in range(5):
+            spans.record(n % 2 + 1, 'hop {}'.format(n), n, n + 0.5)
+        self.assertEqual([span['name'] for span in spans.spans()], ['hop 2', 'hop 3', 'hop 4'])
+        traces = spans.traces()
+        self.assertEqual([span['name'] for span in traces['{:016x}'.format(1)]],
+                         ['hop 2', 'hop 4'])
+        self.assertEqual(traces['{:016x}'.format(2)][0]['ms'], 500)
+
+    def test_dispatcher(self):
+        seen = []
+        dispatcher = Dispatcher(workers=0)
+        dispatcher.register(MessageType.PING_REQ, lambda message, address: seen.append(
+            trace.current()))
+        traced = Trace(9)
+        dispatcher.dispatch(Message('', MessageType.PING_REQ, trace=traced), None)
+        dispatcher.dispatch(Message('', MessageType.PING_REQ), None)
+        self.assertEqual(seen, [traced, None])
+        self.assertIsNone(trace.current())
+
+    def test_channel(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+        self.addCleanup(receiver.close)
+        channel = ReplicaChannel('127.0.0.1')
+        self.addCleanup(channel.close)
+        with trace.use(Trace(11, [('recv', 1.0)])):
+            channel.send(Message('x', MessageType.MESSAGE), receiver.getsockname())
+        received = wire.loads(receiver.recvfrom(65535)[0]).trace
+        self.assertEqual(received.id, 11)
+        self.assertEqual([hop[0] for hop in received.hops], ['recv', 'send MESSAGE'])
+        # Outside of a traced handler nothing is attached
+        channel.send(Message('y', MessageType.MESSAGE), receiver.getsockname())
+        self.assertIsNone(wire.loads(receiver.recvfrom(65535)[0]).trace)
+
+    def test_client_trace(self):
+        # The server samples on its own and keeps its trace from the clients
+        server = LocalServer()
+        self.addCleanup(server.stop)
+        traces = []
+        server.server.on_message = lambda message, address: traces.append(message.trace)
+        client = Client(server.address.host, server.address.port, 'alice')
+        received = []
+        client.on_message = received.append
+        self.addCleanup(client.shutdown)
+        client.connect()
+        for sample in (0, 1):
+            with mock.patch.object(trace, '_sample', sample):
+                client.send(encode_message(ChatMessage('alice', str(sample), Trace(5))))
+                deadline = time.monotonic() + 5
+                while len(received) <= sample and time.monotonic() < deadline:
+                    client.poll(0.05)
+        self.assertEqual([message.message for message in received], ['0', '1'])
+        self.assertEqual([message.trace for message in received], [None, None])
+        self.assertIsNone(traces[0])
+        self.assertNotEqual(traces[1].id, 5)
+        self.assertTrue(traces[1].hops[0][0].endswith('recv'))
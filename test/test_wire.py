@@ -0,0 +1,80 @@
+# Test binary wire format
+
+import unittest
+from lib import trace, wire
+from lib.message import Message, MessageEncoder, MessageType
+
+
+class TestWire(unittest.TestCase):
+    def test_round_trip(self):
+        message = Message(message='{"address": "x"}', type=MessageType.ELECTION_REQ,
+                          host='10.0.0.1', port=3000)
+        decoded = wire.decode(wire.encode(message))
+        self.assertEqual(decoded.message, message.message)
+        self.assertEqual(decoded.type, MessageType.ELECTION_REQ)
+        self.assertEqual(decoded.host, '10.0.0.1')
+        self.assertEqual(decoded.port, 3000)
+
+    def test_empty_fields(self):
+        decoded = wire.decode(wire.encode(Message('', MessageType.PING_RES)))
+        self.assertEqual(decoded.message, '')
+        self.assertEqual(decoded.host, '')
+        self.assertEqual(decoded.port, '')
+
+    def test_json_body(self):
+        message = Message(['hello', 'world'], MessageType.MESSAGE)
+        self.assertEqual(wire.decode(wire.encode(message)).message, ['hello', 'world'])
+
+    def test_loads_detects_format(self):
+        message = Message('127.0.0.1:5970', MessageType.DISCOVERY_REQ,
+                          host='127.0.0.1', port=3000)
+        legacy = str.encode(MessageEncoder().encode(message))
+        self.assertFalse(wire.is_binary(legacy))
+        self.assertTrue(wire.is_binary(wire.encode(message)))
+        for data in (legacy, wire.encode(message)):
+            decoded = wire.loads(data)
+            self.assertEqual(decoded.message, '127.0.0.1:5970')
+            self.assertEqual(decoded.type, MessageType.DISCOVERY_REQ)
+            self.assertEqual(decoded.port, 3000)
+
+    def test_clock_trailer(self):
+        message = Message('hi', MessageType.MESSAGE, correlation_id=7, clock=b'\x01' * 9)
+        legacy = str.encode(MessageEncoder().encode(message))
+        for data in (legacy, wire.encode(message)):
+            decoded = wire.loads(data)
+            self.assertEqual(decoded.correlation_id, 7)
+            self.assertEqual(decoded.clock, b'\x01' * 9)
+        self.assertIsNone(wire.decode(wire.encode(Message('hi', MessageType.MESSAGE))).clock)
+
+    def test_unknown_version(self):
+        data = bytearray(wire.encode(Message('', MessageType.PING_REQ)))
+        data[1] = 99
+        with self.assertRaises(ValueError):
+            wire.decode(data)
+
+    def test_truncated(self):
+        data = wire.encode(Message('hello', MessageType.PING_REQ))
+        with self.assertRaises(ValueError):
+            wire.decode(data[:-2])
+
+    def test_malformed(self):
+        # Every way a datagram can be broken ends in ValueError
+        unknown_code = bytearray(wire.encode(Message('', MessageType.PING_REQ)))
+        unknown_code[2] = 250
+        legacy = str.encode(MessageEncoder().encode(Message('', MessageType.PING_REQ)))
+        for data in (b'', b'123', b'"[]"', b'"{}"', b'\xff', b'\xdb\x01', bytes(unknown_code),
+                     legacy[:-3], wire.encode(Message('hi', MessageType.MESSAGE,
+                                                      correlation_id=1))[:-2]):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                wire.loads(data)
+
+    def test_truncated_trailers(self):
+        # A clock or trace trailer cut short or followed by garbage is not decoded
+        message = Message('hi', MessageType.MESSAGE, clock=b'\x01\x02\x03',
+                          trace=trace.Trace(7, [('a', 1.0)]))
+        data = wire.encode(message)
+        for cut in range(1, len(data) - len(wire.encode(Message('hi', MessageType.MESSAGE)))):
+            with self.subTest(cut=cut), self.assertRaises(ValueError):
+                wire.loads(data[:-cut])
+        with self.assertRaises(ValueError):
+            wire.loads(data + b'\x00')